@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Fleet-wide package report of check_updates.py ("--package-report" and
+"--package NAME").
+
+PackageIndex is an inverted index from package names to the hosts they
+are pending on, fed with results.HostResult objects as hosts finish:
+
+    index = aggregate.PackageIndex(groups=inventory.groups)
+    for result in results:
+        index.add(result)
+    aggregate.report(index, top=20, names=['openssl'])
+
+Hosts are numbered once, and each package holds compact arrays of host
+numbers and of version numbers (See results.Tables) instead of strings,
+so that 10k hosts with hundreds of pending packages each fit in
+some tens of MB.
+'''
+
+from __future__ import print_function
+
+from array import array
+import heapq
+
+from results import UNKNOWN_VERSION
+
+
+DEFAULT_TOP = 20
+# Versions and groups shown per package in the top list.
+_BREAKDOWN = 3
+
+
+class PackageIndex(object):
+    '''
+    groups maps group names to hosts, as get_host_groups() of hosts.py.
+    Results of failed hosts and of hosts checked without
+    --show-packages are counted but not indexed.
+    '''
+    def __init__(self, groups=None):
+        self.hosts = []
+        # results.Tables of the first result. Numbers of results using
+        # other tables are translated into these.
+        self.tables = None
+        # Package number -> host numbers, and version numbers in the
+        # same order.
+        self._members = {}
+        self._member_versions = {}
+        self._groups_of_host = {}
+        for (name, members) in sorted((groups or {}).items()):
+            for host in members:
+                self._groups_of_host.setdefault(host, []).append(name)
+        self.results = 0
+        self.indexed = 0
+
+    def _numbers(self, result):
+        '''
+        Returns numbers of packages and versions of result in self.tables.
+        '''
+        version_ids = (result.version_ids
+                       or [UNKNOWN_VERSION] * len(result.package_ids))
+        if self.tables is None:
+            self.tables = result.tables
+        if result.tables is self.tables:
+            return (result.package_ids, version_ids)
+        (names, versions) = (result.tables.package_names,
+                             result.tables.versions)
+        return ([self.tables.package_names.id(names[package_id])
+                 for package_id in result.package_ids],
+                [UNKNOWN_VERSION if version_id == UNKNOWN_VERSION
+                 else self.tables.versions.id(versions[version_id])
+                 for version_id in version_ids])
+
+    def _package_id(self, name):
+        if self.tables is None:
+            return None
+        return self.tables.package_names.get(name)
+
+    def add(self, result):
+        self.results += 1
+        if not result.succeeded or result.package_ids is None:
+            return
+        self.indexed += 1
+        if not result.package_ids:
+            return
+        host_id = len(self.hosts)
+        self.hosts.append(result.host)
+        (package_ids, version_ids) = self._numbers(result)
+        seen = set()
+        for (package_id, version_id) in zip(package_ids, version_ids):
+            if package_id in seen:
+                continue
+            seen.add(package_id)
+            members = self._members.get(package_id)
+            if members is None:
+                members = self._members[package_id] = array('i')
+                self._member_versions[package_id] = array('i')
+            members.append(host_id)
+            self._member_versions[package_id].append(version_id)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, name):
+        return self._package_id(name) in self._members
+
+    def count(self, name):
+        '''
+        Number of hosts name is pending on.
+        '''
+        return len(self._members.get(self._package_id(name), ()))
+
+    def top(self, n=DEFAULT_TOP):
+        '''
+        Returns [(name, number of hosts)] of the n packages pending on
+        the most hosts, ties broken by name.
+        '''
+        if not self._members:
+            return []
+        names = self.tables.package_names.values
+        return [(names[package_id], len(members))
+                for (package_id, members) in heapq.nsmallest(
+                    n, self._members.items(),
+                    key=lambda item: (-len(item[1]), names[item[0]]))]
+
+    def lookup(self, name):
+        '''
+        Returns a dict like:
+
+            {"package": "openssl", "hosts": ["web1", ...],
+             "versions": {"1.0.1e-2+deb7u7": 120, None: 3},
+             "groups": {"web": 80, "db": 43}}
+
+        where versions and groups count hosts (None == unknown version).
+        Returns None when name is not pending anywhere.
+        '''
+        package_id = self._package_id(name)
+        members = self._members.get(package_id)
+        if members is None:
+            return None
+        versions = {}
+        for version_id in self._member_versions[package_id]:
+            version = (None if version_id == UNKNOWN_VERSION
+                       else self.tables.versions[version_id])
+            versions[version] = versions.get(version, 0) + 1
+        hosts = [self.hosts[host_id] for host_id in members]
+        groups = {}
+        for host in hosts:
+            for group in self._groups_of_host.get(host, ()):
+                groups[group] = groups.get(group, 0) + 1
+        return {'package': name, 'hosts': hosts, 'versions': versions,
+                'groups': groups}
+
+
+def _breakdown(counts, limit=None):
+    items = sorted(counts.items(), key=lambda item: (-item[1],
+                                                     item[0] is None,
+                                                     item[0]))
+    shown = ['{} ({})'.format('?' if key is None else key, count)
+             for (key, count) in items[:limit]]
+    if limit is not None and len(items) > limit:
+        shown.append('...')
+    return ', '.join(shown) or '-'
+
+
+def report(index, top=DEFAULT_TOP, names=None):
+    '''
+    Prints the top packages of index by number of hosts, followed by
+    all hosts of each package in names.
+    '''
+    print('Packages: {} pending on {} of {} hosts'
+          .format(len(index), len(index.hosts), index.indexed))
+    if index.results > index.indexed:
+        print('({} hosts failed or were not listed)'
+              .format(index.results - index.indexed))
+    if top:
+        print('{:<30}{:>7}  {}'.format('package', 'hosts',
+                                       'versions / groups'))
+    for (name, _) in index.top(top):
+        found = index.lookup(name)
+        print('{:<30}{:>7}  {}'.format(name, len(found['hosts']),
+                                       _breakdown(found['versions'],
+                                                  _BREAKDOWN)))
+        if found['groups']:
+            print('{:<37}  {}'.format('', _breakdown(found['groups'],
+                                                     _BREAKDOWN)))
+    for name in names or ():
+        found = index.lookup(name)
+        if not found:
+            print('{}: not pending on any host'.format(name))
+            continue
+        print('{}: {} hosts'.format(name, len(found['hosts'])))
+        print('  versions: {}'.format(_breakdown(found['versions'])))
+        print('  groups: {}'.format(_breakdown(found['groups'])))
+        print('  hosts: {}'.format(', '.join(sorted(found['hosts']))))
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Library API for programs that check hosts without going through
+check_updates.py's command line:
+
+    import api
+    for result in api.check(['web1', 'db1'], jobs=64):
+        if result.needs_attention():
+            print(result.host, result.updates, result.sec_updates)
+
+Results are results.HostResult objects, yielded as soon as each host is
+finished. Hosts are checked on threads (See engine.py), each connection
+carrying its own options, so no per-run state is kept in Fabric's env
+and one long-lived process can call check() as often as it likes.
+Fabric's output and prompt settings are process-wide though: check()
+hides output only while it waits for hosts, not while the caller handles
+a result, and makes prompts abort until the run is over (or the
+generator is closed), restoring env.abort_on_prompts afterwards.
+'''
+
+import argparse
+import time
+
+from fabric.api import hide
+from fabric import state
+from fabric.state import env
+
+import check_updates
+import engine
+import fabwrap
+import replay
+import results
+from results import HostResult
+
+
+# Options the per-host checks look at (conn.args) and their defaults.
+# See check_updates.py --help for what they mean.
+DEFAULT_OPTIONS = {'refresh': False,
+                   'show_packages': False,
+                   'prefer_aptitude': False,
+                   'probe': False,
+                   'forget_facts': False,
+                   'verbose': False,
+                   # Path of a check_updates.py --record archive.
+                   'replay': None}
+
+
+def make_options(**kwargs):
+    '''
+    Returns an object usable as conn.args, like check_updates.py's
+    parsed command line. Raises TypeError on unknown options.
+    '''
+    unknown = set(kwargs) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise TypeError('Unknown options: {}'
+                        .format(', '.join(sorted(unknown))))
+    options = dict(DEFAULT_OPTIONS)
+    options.update(kwargs)
+    options['quiet'] = not options['verbose']
+    if options['replay']:
+        # Facts are replayed too.
+        options['forget_facts'] = True
+    return argparse.Namespace(**options)
+
+
+def _setup():
+    # Keep the connection cache (and its ssh config) between calls.
+    if not isinstance(state.connections, fabwrap.CustomHostConnectionCache):
+        fabwrap.setup()
+
+
+def check_host(conn):
+    '''
+    Checks a single host over conn (See remote.py) and returns
+    a HostResult. Failures of the check are raised as SystemExit
+    by fabric.utils.abort(), like in check_updates.py.
+    '''
+    started = time.time()
+    checked = check_updates.check_host(conn)
+    if not checked:
+        result = HostResult(conn.host_string, error='Check failed.')
+    else:
+        (apt_command, (updates, sec_updates, reboot_required,
+                       packages, versions)) = checked
+        result = HostResult(conn.host_string, apt_command=apt_command,
+                            updates=updates, sec_updates=sec_updates,
+                            reboot_required=reboot_required,
+                            packages=packages, versions=versions)
+    result.started = started
+    result.elapsed = time.time() - started
+    return result
+
+
+def _failed(host_string, message):
+    return HostResult(host_string, error=message)
+
+
+def check(hosts, jobs=None, connect=None, **options):
+    '''
+    Checks hosts with at most jobs (engine.DEFAULT_JOBS by default)
+    hosts in flight and yields a HostResult for each as soon as the host
+    is finished. Unreachable or failed hosts are yielded with error set.
+
+    options are the ones in DEFAULT_OPTIONS. Nothing is printed unless
+    verbose is set.
+    connect(host_string) returns the connection to a host, which must
+    carry the options (See make_options()). By default hosts are
+    connected directly, like "--engine thread" does, or served from
+    the archive when replay is given (Raises replay.ReplayError when it
+    can't be loaded).
+    e.g. broker.broker_connector(broker.BrokerClient(), make_options())
+    '''
+    args = make_options(**options)
+    _setup()
+    # Names and versions of earlier calls go away with their results.
+    results.new_tables()
+    if not connect and args.replay:
+        connect = replay.Replay(args.replay).connector(args)
+    if not connect:
+        connect = lambda host_string: engine.open_connection(host_string,
+                                                             args=args)
+    output_groups = () if args.verbose else ('everything',)
+    finished = engine.iter_threaded(check_host, hosts, jobs=jobs,
+                                    connect=connect, on_failure=_failed)
+    # Nobody is there to answer prompts on worker threads, which keep
+    # connecting while the caller handles a result.
+    abort_on_prompts = env.abort_on_prompts
+    env.abort_on_prompts = True
+    try:
+        while True:
+            with hide(*output_groups):
+                try:
+                    (_, result) = next(finished)
+                except StopIteration:
+                    return
+            yield result
+    finally:
+        env.abort_on_prompts = abort_on_prompts
+        finished.close()
@@ -0,0 +1,623 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Offline load benchmark for check_updates.py.
+
+Starts a fleet of local paramiko servers pretending to be debian-like
+or redhat-like hosts (answering apt-check, yum, rpm, uname, ... with
+canned outputs after a configurable latency, sometimes failing or
+hanging), then runs check_updates.main() against all of them once per
+mode and reports:
+
+ * hosts per second
+ * p50/p99 of per-host latency (elapsed of each "--format jsonl" record)
+ * peak RSS of the checking process and of its children
+ * peak number of open fds of the checking process
+
+Each mode runs in a fresh process with HOME pointing to a temporary
+directory, so caches and ssh keys of the user are not touched.
+A throw-away ssh-agent holding a throw-away key is started for the run,
+so that the agent and identity cache paths of fabwrap.py are measured
+as in production.
+
+    $ ./benchmark.py --hosts 200 --latency 0.05 --modes serial,fork,thread
+    $ ./benchmark.py --hosts 1000 --modes thread --check-args "--probe"
+
+"--memory-model" skips the fleet and instead compares how much memory
+results of --hosts hosts with --packages pending packages each take,
+kept as plain lists of names (what HostResult used to keep) and as
+interned package numbers (See results.py), and how large they are
+as JSON rows and as results.to_columns().
+
+    $ ./benchmark.py --memory-model --hosts 10000 --packages 200
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import select
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+MODES = {'serial': ['--serial'],
+         'fork': [],
+         'thread': ['--engine', 'thread']}
+
+DEBIAN_KERNEL = '3.2.0-4-amd64'
+REDHAT_KERNEL = '2.6.32-431.11.2.el6.x86_64'
+
+
+class FakeHost(object):
+    '''
+    What a simulated host answers to the commands check_updates.py runs.
+    '''
+    def __init__(self, index, redhat, rng):
+        self.index = index
+        self.redhat = redhat
+        self.packages = ['package{}'.format(i)
+                         for i in range(rng.randint(0, 20))]
+        self.sec_updates = rng.randint(0, len(self.packages))
+        self.reboot_required = rng.random() < 0.2
+
+    def _yum_list(self, packages):
+        return '\n'.join('{}.x86_64    1.0-1.el6    updates'.format(package)
+                         for package in packages)
+
+    def _yum_security(self):
+        listed = self._yum_list(self.packages[:self.sec_updates])
+        return (listed + '\n{} package(s) needed for security, out of {}'
+                ' available'.format(self.sec_updates, len(self.packages)))
+
+    def _apt_simulation(self):
+        lines = ['NOTE: This is only a simulation!']
+        for (i, package) in enumerate(self.packages):
+            origin = ('Debian-Security:7.0/oldstable' if i < self.sec_updates
+                      else 'Debian:7.8/stable')
+            lines.append('Inst {} [1.0-1] (1.0-2 {} [amd64])'
+                         .format(package, origin))
+        return '\n'.join(lines)
+
+    def _apt_check(self):
+        # Like apt-check, without a trailing newline.
+        return '{};{}'.format(len(self.packages), self.sec_updates)
+
+    def _kernel_latest(self):
+        if self.reboot_required:
+            return 'kernel-2.6.32-504.el6.x86_64'
+        return 'kernel-' + REDHAT_KERNEL
+
+    def _probe(self, show_packages):
+        import probe
+        eof = probe.EOF_MARKER
+        lines = ['{}=1'.format(probe.PROBE_MARKER)]
+        if self.redhat:
+            rc = 100 if self.packages else 0
+            lines += ['pm=yum', 'kernel=' + REDHAT_KERNEL,
+                      'yum_security_status={}'.format(rc),
+                      'yum_security_output<<' + eof, self._yum_security(), eof]
+            # The security summary is always there.
+            if show_packages:
+                lines += ['yum_status={}'.format(rc),
+                          'yum_output<<' + eof, self._yum_list(self.packages),
+                          eof]
+            lines += ['kernel_latest=' + self._kernel_latest()]
+        else:
+            lines += ['pm=apt-get', 'kernel=' + DEBIAN_KERNEL,
+                      'apt_check=1', 'apt_check_status=0',
+                      'counts=' + self._apt_check(),
+                      'reboot={}'.format(int(self.reboot_required))]
+            if show_packages:
+                lines += ['apt_simulation<<' + eof, self._apt_simulation(),
+                          eof]
+        return '\n'.join(lines)
+
+    def _facts(self):
+        return '\n'.join(['aptitude=0',
+                          'apt-get={}'.format(int(not self.redhat)),
+                          'yum={}'.format(int(self.redhat)),
+                          'apt_check={}'.format(int(not self.redhat)),
+                          'distro_family={}'.format(
+                              'redhat' if self.redhat else 'debian'),
+                          'kernel={}'.format(REDHAT_KERNEL if self.redhat
+                                             else DEBIAN_KERNEL)])
+
+    def respond(self, command):
+        '''
+        Returns (output, return_code) for command.
+        '''
+        import probe
+        if probe.PROBE_MARKER in command:
+            show_packages = re.search(r'^show_packages=1$', command, re.M)
+            return (self._probe(bool(show_packages)), 0)
+        if 'distro_family' in command:
+            return (self._facts(), 0)
+        if 'stat -c' in command:
+            return ('/var/lib/dpkg/status:1400000000:{}\n{}'
+                    .format(1000 + len(self.packages), DEBIAN_KERNEL), 0)
+        if 'test -e' in command:
+            exists = ((not self.redhat and probe.APT_CHECK_FILE in command)
+                      or (self.reboot_required
+                          and probe.REBOOT_REQUIRED_FILE in command))
+            return ('', 0 if exists else 1)
+        if probe.EOF_MARKER in command:
+            # probe.APT_CHECK_AND_SIMULATE_SCRIPT, where the newline after
+            # the counts comes from the script.
+            newline = '\n' if '\necho\n' in command else ''
+            return ('{}{}{} 0\n{}'.format(
+                self._apt_check(), newline, probe.EOF_MARKER,
+                self._apt_simulation()), 0)
+        if 'apt-check' in command:
+            return (self._apt_check(), 0)
+        if ' -s upgrade' in command:
+            return (self._apt_simulation(), 0)
+        if 'yum --security check-update' in command:
+            return (self._yum_security(), 100 if self.packages else 0)
+        if 'yum check-update' in command:
+            return (self._yum_list(self.packages),
+                    100 if self.packages else 0)
+        if 'rpm -q --last kernel' in command:
+            return (self._kernel_latest() + '    Mon 01 Jan 2015', 0)
+        if 'uname -s' in command:
+            return ('Linux', 0)
+        if 'uname -r' in command:
+            return (REDHAT_KERNEL if self.redhat else DEBIAN_KERNEL, 0)
+        for ok in ('apt-get update', '-y upgrade', '-y dist-upgrade',
+                   'reboot', 'true'):
+            if ok in command:
+                return ('', 0)
+        return ('bash: command not found', 127)
+
+
+def _make_server_interface(fake_host, options, rng):
+    import paramiko
+
+    class Server(paramiko.ServerInterface):
+        def get_allowed_auths(self, username):
+            return 'publickey,password'
+
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_pty_request(self, *args):
+            return True
+
+        def check_channel_exec_request(self, channel, command):
+            thread = threading.Thread(target=self._respond,
+                                      args=(channel, command))
+            thread.daemon = True
+            thread.start()
+            return True
+
+        def _respond(self, channel, command):
+            delay = options.latency * rng.uniform(1 - options.jitter,
+                                                  1 + options.jitter)
+            if rng.random() < options.hang_rate:
+                delay += options.hang_seconds
+            time.sleep(delay)
+            if rng.random() < options.fail_rate:
+                (output, return_code) = ('simulated failure', 1)
+            else:
+                (output, return_code) = fake_host.respond(command)
+            try:
+                channel.sendall(output)
+                channel.send_exit_status(return_code)
+                channel.close()
+            except Exception:
+                # The client gave up on us.
+                pass
+
+    return Server()
+
+
+def serve_fleet(options, ready_fd):
+    '''
+    Runs the simulated hosts until killed. Writes the list of their
+    ports to ready_fd as JSON when they are ready.
+    '''
+    import paramiko
+    rng = random.Random(options.seed)
+    host_key = paramiko.RSAKey.generate(1024)
+    listeners = {}
+    for index in range(options.hosts):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(16)
+        redhat = rng.random() < options.redhat_ratio
+        listeners[sock] = FakeHost(index, redhat, rng)
+    ports = [sock.getsockname()[1] for sock in
+             sorted(listeners, key=lambda s: listeners[s].index)]
+    os.write(ready_fd, json.dumps(ports) + '\n')
+    os.close(ready_fd)
+    while True:
+        (readable, _, _) = select.select(list(listeners), [], [])
+        for sock in readable:
+            (client, _) = sock.accept()
+            if rng.random() < options.refuse_rate:
+                client.close()
+                continue
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.start_server(
+                server=_make_server_interface(listeners[sock], options, rng))
+
+
+def _count_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def run_mode(mode, hosts, inventory_path, options):
+    '''
+    Runs check_updates.main() in this process and returns metrics.
+    '''
+    records_file = tempfile.TemporaryFile()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(records_file.fileno(), 1)
+    os.dup2(devnull, 2)
+    peak_fds = [_count_fds()]
+
+    def sample_fds():
+        while True:
+            peak_fds[0] = max(peak_fds[0], _count_fds())
+            time.sleep(0.05)
+    sampler = threading.Thread(target=sample_fds)
+    sampler.daemon = True
+    sampler.start()
+
+    sys.argv = (['check_updates.py', '-q', '--format', 'jsonl',
+                 '--inventory', inventory_path, 'all']
+                + MODES[mode] + shlex.split(options.check_args))
+    if options.jobs and mode != 'serial':
+        sys.argv += ['--jobs', str(options.jobs)]
+    import check_updates
+    start = time.time()
+    try:
+        check_updates.main()
+    except SystemExit:
+        pass
+    elapsed = time.time() - start
+
+    records_file.seek(0)
+    records = []
+    for line in records_file:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    import profiling
+    latencies = sorted(record['elapsed'] for record in records
+                       if record.get('elapsed') is not None)
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'mode': mode,
+            'hosts': len(hosts),
+            'records': len(records),
+            'errors': len([record for record in records
+                           if record.get('error')]),
+            'seconds': elapsed,
+            'hosts_per_second': len(hosts) / elapsed if elapsed else None,
+            'p50': profiling.percentile(latencies, 50),
+            'p99': profiling.percentile(latencies, 99),
+            # kilobytes on Linux
+            'peak_rss_kb': usage_self.ru_maxrss,
+            'peak_children_rss_kb': usage_children.ru_maxrss,
+            'peak_fds': peak_fds[0]}
+
+
+class _PlainHostResult(object):
+    '''
+    A results.HostResult as it was before package names were interned.
+    '''
+    def __init__(self, host, packages, versions):
+        self.host = host
+        self.apt_command = 'apt-get'
+        self.updates = len(packages)
+        self.sec_updates = 0
+        self.reboot_required = False
+        self.packages = packages
+        self.versions = versions
+        self.source = 'check'
+        self.started = None
+        self.elapsed = None
+        self.error = None
+        self.upgraded = False
+        self.rebooted = False
+        self.rebooted_at = None
+        self.downtime = None
+        self.phases = {}
+
+
+def measure_results_memory(model, options):
+    '''
+    Builds results of options.hosts hosts in this process the way parsers
+    would (new strings for each host), keeping them all, and returns
+    metrics. model is "plain" or "interned".
+    '''
+    import results
+    results.new_tables()
+    rng = random.Random(options.seed)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kept = []
+    for i in range(options.hosts):
+        numbers = rng.sample(range(options.distinct_packages),
+                             min(options.packages,
+                                 options.distinct_packages))
+        packages = ['package{}'.format(number) for number in numbers]
+        versions = dict((name, '1.{}-{}'.format(number % 7, number % 3))
+                        for (name, number) in zip(packages, numbers))
+        host = 'host{}.example.com'.format(i)
+        if model == 'plain':
+            kept.append(_PlainHostResult(host, packages, versions))
+        else:
+            kept.append(results.HostResult(host, apt_command='apt-get',
+                                           updates=len(packages),
+                                           sec_updates=0,
+                                           reboot_required=False,
+                                           packages=packages,
+                                           versions=versions))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if model == 'plain':
+        serialized = json.dumps([result.__dict__ for result in kept])
+    else:
+        serialized = json.dumps(results.to_columns(kept))
+    return {'model': model,
+            'hosts': options.hosts,
+            'packages': options.packages,
+            # kilobytes on Linux
+            'rss_kb': after - before,
+            'json_kb': len(serialized) / 1024.0}
+
+
+def print_memory_report(all_metrics):
+    print('{:<10}{:>8}{:>10}{:>10}{:>10}'
+          .format('model', 'hosts', 'packages', 'rss(MB)', 'json(MB)'))
+    for metrics in all_metrics:
+        if 'error' in metrics:
+            print('{:<10} failed: {}'.format(metrics['model'],
+                                             metrics['error']))
+            continue
+        print('{:<10}{:>8}{:>10}{:>10.1f}{:>10.1f}'
+              .format(metrics['model'], metrics['hosts'],
+                      metrics['packages'], metrics['rss_kb'] / 1024.0,
+                      metrics['json_kb'] / 1024.0))
+
+
+def run_mode_in_child(mode, hosts, inventory_path, options):
+    return _run_in_child({'mode': mode}, run_mode, mode, hosts,
+                         inventory_path, options)
+
+
+def _run_in_child(name, function, *args):
+    '''
+    Returns what function(*args) returns, calling it in a forked process
+    so that each run starts from the same memory usage.
+    Failures are returned as name plus "error".
+    '''
+    (read_fd, write_fd) = os.pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            metrics = function(*args)
+        except Exception as e:
+            metrics = dict(name)
+            metrics['error'] = '{}: {}'.format(e.__class__.__name__, e)
+        os.write(write_fd, json.dumps(metrics))
+        os._exit(0)
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def _prepare_home(home):
+    '''
+    Makes a throw-away ssh key for wrap_connect() under home.
+    '''
+    import paramiko
+    ssh_dir = os.path.join(home, '.ssh')
+    os.makedirs(ssh_dir, 0o700)
+    key = paramiko.RSAKey.generate(1024)
+    key_path = os.path.join(ssh_dir, 'id_rsa')
+    key.write_private_key_file(key_path)
+    with open(key_path + '.pub', 'w') as f:
+        f.write('{} {} benchmark\n'.format(key.get_name(), key.get_base64()))
+    return key_path
+
+
+def _start_ssh_agent(key_path):
+    '''
+    Starts an ssh-agent holding key_path for this process and its
+    children. Returns its pid, or None when it could not be started.
+    '''
+    devnull = open(os.devnull, 'w')
+    try:
+        output = subprocess.check_output(['ssh-agent', '-s'], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('ssh-agent is not available ({}).'
+              ' Identity files are used directly.'.format(e),
+              file=sys.stderr)
+        return None
+    pid = None
+    # e.g. "SSH_AUTH_SOCK=/tmp/ssh-XXX/agent.123; export SSH_AUTH_SOCK;"
+    for statement in output.split(';'):
+        (name, _, value) = statement.strip().partition('=')
+        if name == 'SSH_AUTH_SOCK':
+            os.environ['SSH_AUTH_SOCK'] = value
+        elif name == 'SSH_AGENT_PID':
+            pid = int(value)
+    try:
+        subprocess.check_call(['ssh-add', key_path], stdin=devnull,
+                              stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('ssh-add failed ({}).'.format(e), file=sys.stderr)
+        if pid:
+            os.kill(pid, signal.SIGTERM)
+        os.environ.pop('SSH_AUTH_SOCK', None)
+        return None
+    return pid
+
+
+def _format_value(value, spec):
+    return 'n/a' if value is None else spec.format(value)
+
+
+def print_report(all_metrics):
+    print('{:<8}{:>7}{:>7}{:>9}{:>9}{:>9}{:>9}{:>10}{:>10}{:>7}'
+          .format('mode', 'hosts', 'errors', 'sec', 'hosts/s', 'p50',
+                  'p99', 'rss(MB)', 'child(MB)', 'fds'))
+    for metrics in all_metrics:
+        if 'error' in metrics:
+            print('{:<8} failed: {}'.format(metrics['mode'],
+                                            metrics['error']))
+            continue
+        print('{:<8}{:>7}{:>7}{:>9.2f}{:>9}{:>9}{:>9}{:>10.1f}{:>10.1f}{:>7}'
+              .format(metrics['mode'], metrics['hosts'], metrics['errors'],
+                      metrics['seconds'],
+                      _format_value(metrics['hosts_per_second'], '{:.1f}'),
+                      _format_value(metrics['p50'], '{:.3f}'),
+                      _format_value(metrics['p99'], '{:.3f}'),
+                      metrics['peak_rss_kb'] / 1024.0,
+                      metrics['peak_children_rss_kb'] / 1024.0,
+                      _format_value(metrics['peak_fds'], '{}')))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u'Benchmarks check_updates.py against simulated hosts.')
+    parser.add_argument('--hosts', type=int, default=50,
+                        help=u'Number of simulated hosts. Default: %(default)s')
+    parser.add_argument('--modes', default='serial,fork,thread',
+                        help=(u'Comma separated modes to run, out of {}.'
+                              u' Default: %(default)s'
+                              .format(', '.join(sorted(MODES)))))
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help=u'--jobs for parallel modes.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help=(u'Seconds each command takes.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help=(u'Randomize latency by +/- this ratio.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help=u'Ratio of commands that fail.')
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help=(u'Ratio of commands that hang for'
+                              u' --hang-seconds.'))
+    parser.add_argument('--hang-seconds', type=float, default=30,
+                        help=u'Default: %(default)s')
+    parser.add_argument('--refuse-rate', type=float, default=0.0,
+                        help=u'Ratio of ssh connections dropped at once.')
+    parser.add_argument('--redhat-ratio', type=float, default=0.3,
+                        help=(u'Ratio of redhat-like hosts.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check-args', default='',
+                        help=(u'Extra arguments for check_updates.py,'
+                              u' e.g. "--probe".'))
+    parser.add_argument('--json', metavar='PATH',
+                        help=u'Also write the results to PATH as JSON.')
+    parser.add_argument('--memory-model', action='store_true',
+                        help=(u'Instead of checking the simulated fleet,'
+                              u' compare memory taken by results of --hosts'
+                              u' hosts kept as plain lists and as interned'
+                              u' package numbers.'))
+    parser.add_argument('--packages', type=int, default=200,
+                        help=(u'Pending packages per host with'
+                              u' --memory-model. Default: %(default)s'))
+    parser.add_argument('--distinct-packages', type=int, default=2000,
+                        help=(u'Distinct package names over all hosts with'
+                              u' --memory-model. Default: %(default)s'))
+    options = parser.parse_args()
+    if options.memory_model:
+        all_metrics = [_run_in_child({'model': model},
+                                     measure_results_memory, model, options)
+                       for model in ('plain', 'interned')]
+        print_memory_report(all_metrics)
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(all_metrics, f, indent=2, sort_keys=True)
+        return
+    modes = [mode.strip() for mode in options.modes.split(',')]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('Unknown mode "{}"'.format(mode))
+
+    home = tempfile.mkdtemp(prefix='check_updates_benchmark.')
+    # Before importing anything of check_updates.py; see utils.CACHE_DIR.
+    os.environ['HOME'] = home
+    os.environ.pop('SSH_AUTH_SOCK', None)
+    agent_pid = _start_ssh_agent(_prepare_home(home))
+    try:
+        run_benchmark(modes, options, home)
+    finally:
+        if agent_pid:
+            os.kill(agent_pid, signal.SIGTERM)
+
+
+def run_benchmark(modes, options, home):
+    '''
+    Runs the simulated fleet and checks it once per mode.
+    '''
+    (read_fd, write_fd) = os.pipe()
+    sys.stdout.flush()
+    fleet_pid = os.fork()
+    if fleet_pid == 0:
+        os.close(read_fd)
+        try:
+            serve_fleet(options, write_fd)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    try:
+        ports = json.loads(os.fdopen(read_fd).readline())
+        hosts = ['127.0.0.1:{}'.format(port) for port in ports]
+        inventory_path = os.path.join(home, 'inventory.json')
+        with open(inventory_path, 'w') as f:
+            json.dump({'hosts': hosts}, f)
+        all_metrics = []
+        for mode in modes:
+            all_metrics.append(run_mode_in_child(mode, hosts, inventory_path,
+                                                 options))
+    finally:
+        os.kill(fleet_pid, signal.SIGTERM)
+        os.waitpid(fleet_pid, 0)
+    print_report(all_metrics)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(all_metrics, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Persistent ssh session broker, in the spirit of OpenSSH's ControlMaster.
+
+Run this once in the background:
+
+    $ broker.py &
+
+and let check_updates.py use it ("--broker"). The broker keeps
+authenticated paramiko transports open and runs each requested command
+on a new channel of the matching transport, so successive check_updates
+runs skip TCP, key exchange and authentication entirely.
+
+Requests come over a Unix socket only accessible by the user.
+One JSON line per request, one JSON line per response:
+
+    {"op": "connect", "host_string": "user@host:22"}
+    {"op": "exec", "host_string": "user@host:22", "command": "uname -r"}
+    {"op": "ping"}
+    -> {"return_code": 0, "output": "3.2.0-4-amd64"}
+    -> {"error": "...", "network_error": true}
+'''
+
+from fabric.exceptions import NetworkError
+from fabric.network import normalize, normalize_to_string
+from fabric import state
+from fabric.state import env
+
+import argparse
+import json
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+import fabwrap
+from remote import SSHConnection, exec_command
+from utils import CACHE_DIR
+
+
+DEFAULT_SOCKET = os.path.join(CACHE_DIR, 'broker.sock')
+DEFAULT_IDLE_TIMEOUT = 1800
+DEFAULT_MAX_SESSIONS = 1000
+
+
+class BrokerError(Exception):
+    pass
+
+
+class _Session(object):
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.last_used = time.time()
+        # Number of requests using the session. Protected by the
+        # broker-wide lock.
+        self.users = 0
+        # Serializes (re)connection of this host.
+        self.lock = threading.Lock()
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SessionBroker(object):
+    '''
+    Keeps at most max_sessions ssh clients, closing ones idle for
+    more than idle_timeout seconds and, when full, the least recently
+    used one. Sessions running a command are never closed, so there may
+    be more than max_sessions while all of them are in use.
+    '''
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_sessions=DEFAULT_MAX_SESSIONS, opener=None):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        # opener(host_string) returns a connected paramiko.SSHClient.
+        self.opener = opener
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _close(self, key):
+        session = self.sessions.pop(key, None)
+        if session and session.client:
+            session.client.close()
+
+    def evict_idle(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            for key in [key for (key, session) in self.sessions.items()
+                        if not session.users
+                        and now - session.last_used > self.idle_timeout]:
+                self._close(key)
+
+    def _reserve(self, key):
+        with self.lock:
+            session = self.sessions.get(key)
+            if not session:
+                if len(self.sessions) >= self.max_sessions:
+                    unused = [k for (k, s) in self.sessions.items()
+                              if not s.users]
+                    if unused:
+                        oldest = min(unused,
+                                     key=lambda k: self.sessions[k].last_used)
+                        self._close(oldest)
+                session = _Session(key, None)
+                self.sessions[key] = session
+            session.users += 1
+            session.last_used = time.time()
+            return session
+
+    def _checkout(self, host_string):
+        '''
+        Returns the connected session of host_string, which is not
+        evicted until it is given to _checkin().
+        '''
+        key = normalize_to_string(host_string)
+        while True:
+            session = self._reserve(key)
+            # Connect outside of the broker-wide lock; other hosts must
+            # not wait for a slow handshake.
+            with session.lock:
+                with self.lock:
+                    removed = self.sessions.get(key) is not session
+                if removed:
+                    # Another request failed to connect it meanwhile.
+                    # Start over rather than reopen a session nobody
+                    # would close.
+                    self._checkin(session)
+                    continue
+                if session.client is None or not session.is_active():
+                    try:
+                        session.client = self.opener(host_string)
+                    except:
+                        with self.lock:
+                            if self.sessions.get(key) is session:
+                                del self.sessions[key]
+                        self._checkin(session)
+                        raise
+            return session
+
+    def _checkin(self, session):
+        '''
+        Closes the client of a session removed while it was in use once
+        its last user is done.
+        '''
+        with self.lock:
+            session.users -= 1
+            session.last_used = time.time()
+            orphaned = (not session.users
+                        and self.sessions.get(session.key) is not session)
+        if orphaned and session.client:
+            session.client.close()
+
+    def get_transport(self, host_string):
+        session = self._checkout(host_string)
+        self._checkin(session)
+        return session.client.get_transport()
+
+    def execute(self, host_string, command):
+        session = self._checkout(host_string)
+        try:
+            return exec_command(session.client.get_transport(), command)
+        finally:
+            self._checkin(session)
+
+    def close(self):
+        with self.lock:
+            for key in list(self.sessions):
+                self._close(key)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        try:
+            request = json.loads(self.rfile.readline())
+            if request['op'] == 'ping':
+                self.wfile.write(json.dumps({}) + '\n')
+                return
+            host_string = request['host_string']
+            if request['op'] == 'connect':
+                broker.get_transport(host_string)
+                response = {}
+            elif request['op'] == 'exec':
+                (output, return_code) = broker.execute(host_string,
+                                                       request['command'])
+                response = {'output': output.decode('utf-8', 'replace'),
+                            'return_code': return_code}
+            else:
+                response = {'error': 'unknown op "{}"'.format(request['op'])}
+        except NetworkError as e:
+            response = {'error': str(e), 'network_error': True}
+        except SystemExit:
+            # fabric.utils.abort(), e.g. a password prompt was needed.
+            response = {'error': 'Aborted while handling the request'}
+        except Exception as e:
+            response = {'error': '{}: {}'.format(e.__class__.__name__, e)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=DEFAULT_SOCKET, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+          max_sessions=DEFAULT_MAX_SESSIONS, opener=None):
+    '''
+    Serves requests on the Unix socket at path until interrupted.
+    '''
+    broker = SessionBroker(idle_timeout=idle_timeout,
+                           max_sessions=max_sessions, opener=opener)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    if os.path.exists(path):
+        os.unlink(path)
+    original_umask = os.umask(0o077)
+    try:
+        server = _Server(path, _RequestHandler)
+    finally:
+        os.umask(original_umask)
+    server.broker = broker
+
+    def evictor():
+        while True:
+            time.sleep(min(60, idle_timeout))
+            broker.evict_idle()
+    thread = threading.Thread(target=evictor)
+    thread.daemon = True
+    thread.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+        broker.close()
+
+
+class BrokerClient(object):
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = path
+
+    def _request(self, request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request) + '\n')
+            response = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        if not response:
+            raise BrokerError('No response from broker')
+        response = json.loads(response)
+        if response.get('network_error'):
+            raise NetworkError(response['error'])
+        if 'error' in response:
+            raise BrokerError(response['error'])
+        return response
+
+    def is_available(self):
+        '''
+        True when a broker answers on the socket. A socket file left by
+        a dead broker is not enough.
+        '''
+        try:
+            self._request({'op': 'ping'})
+        except (socket.error, BrokerError, ValueError):
+            return False
+        return True
+
+    def connect(self, host_string):
+        self._request({'op': 'connect', 'host_string': host_string})
+
+    def execute(self, host_string, command):
+        response = self._request({'op': 'exec', 'host_string': host_string,
+                                  'command': command})
+        return (response['output'].encode('utf-8'),
+                response['return_code'])
+
+
+class BrokerConnection(SSHConnection):
+    '''
+    SSHConnection whose commands run through the broker.
+    '''
+    def __init__(self, broker_client, host_string, args):
+        (_, host, port) = normalize(host_string)
+        super(BrokerConnection, self).__init__(None, host, port, args,
+                                               host_string=host_string)
+        self.broker_client = broker_client
+
+    def _exec_command(self, command):
+        return self.broker_client.execute(self.host_string, command)
+
+    def close(self):
+        # The session is kept warm by the broker.
+        pass
+
+
+def broker_connector(broker_client, args):
+    '''
+    Returns a "connect" function for engine.execute_threaded().
+    '''
+    def connect(host_string):
+        try:
+            broker_client.connect(host_string)
+        except (socket.error, BrokerError) as e:
+            # Let engine.py treat the host as unreachable.
+            raise NetworkError('Broker failed: {}'.format(e))
+        return BrokerConnection(broker_client, host_string, args)
+    return connect
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u'Keeps ssh sessions open for check_updates.py.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help=u'Unix socket to listen on.'
+                        u' Default: %(default)s')
+    parser.add_argument('--idle-timeout', type=int,
+                        default=DEFAULT_IDLE_TIMEOUT,
+                        help=(u'Close sessions unused for this many seconds.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--max-sessions', type=int,
+                        default=DEFAULT_MAX_SESSIONS,
+                        help=(u'Maximum number of sessions kept open.'
+                              u' Default: %(default)s'))
+    args = parser.parse_args()
+    fabwrap.setup()
+    # Nobody is there to answer prompts.
+    env.abort_on_prompts = True
+    try:
+        serve(args.socket, idle_timeout=args.idle_timeout,
+              max_sessions=args.max_sessions,
+              opener=state.connections.open)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
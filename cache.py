@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Local caches of per-host information.
+
+Each host has its own JSON file, written atomically, so forked or
+threaded workers can update their hosts concurrently without locking.
+'''
+
+import json
+import os
+import time
+import urllib
+
+from utils import CACHE_DIR, atomic_write
+
+
+class _HostCache(object):
+    '''
+    One JSON file per host under directory.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, host):
+        # Host strings may contain "@", ":" and alike.
+        return os.path.join(self.directory,
+                            urllib.quote(host, safe='') + '.json')
+
+    def _load(self, host):
+        try:
+            with open(self._path(host)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, host, entry):
+        atomic_write(self._path(host), json.dumps(entry))
+
+    def invalidate(self, host):
+        try:
+            os.unlink(self._path(host))
+        except OSError:
+            pass
+
+
+class ResultCache(_HostCache):
+    '''
+    Entries are dicts like:
+
+        {"timestamp": 1400000000.0, "apt_command": "apt-get",
+         "updates": 6, "sec_updates": 6, "reboot_required": true,
+         "packages": ["bash", "openssl"],
+         "versions": {"bash": "4.2+dfsg-0.1+deb7u3", "openssl": "..."},
+         "fingerprint": "..."}
+
+    apt_command is None on redhat-like hosts,
+    packages and versions are None unless they were asked for,
+    fingerprint is None unless --incremental was used.
+    '''
+    def __init__(self, directory=None):
+        super(ResultCache, self).__init__(
+            directory or os.path.join(CACHE_DIR, 'results'))
+
+    def get(self, host, max_age=None, now=None):
+        '''
+        Returns the entry for host, or None when there's none or it is
+        older than max_age seconds.
+        '''
+        entry = self._load(host)
+        if entry and max_age is not None:
+            now = now or time.time()
+            if now - entry.get('timestamp', 0) > max_age:
+                return None
+        return entry
+
+    def put(self, result, fingerprint=None):
+        '''
+        Remembers counts and packages of a results.HostResult.
+        '''
+        entry = {'timestamp': time.time(),
+                 'apt_command': result.apt_command,
+                 'updates': result.updates,
+                 'sec_updates': result.sec_updates,
+                 'reboot_required': result.reboot_required,
+                 'packages': result.packages,
+                 'versions': result.versions,
+                 'fingerprint': fingerprint}
+        self._save(result.host, entry)
+        return entry
+
+
+class FactsCache(_HostCache):
+    '''
+    Facts about hosts that rarely change. Entries are dicts like:
+
+        {"timestamp": 1400000000.0, "distro_family": "debian",
+         "has_aptitude": false, "has_apt_get": true, "has_yum": false,
+         "has_apt_check": true, "kernel": "3.2.0-4-amd64"}
+
+    distro_family is "debian", "redhat" or None (unknown).
+    Entries don't expire; invalidate() them when they turn out wrong.
+    '''
+    def __init__(self, directory=None):
+        super(FactsCache, self).__init__(
+            directory or os.path.join(CACHE_DIR, 'facts'))
+
+    def get(self, host):
+        return self._load(host)
+
+    def put(self, host, facts):
+        entry = dict(facts)
+        entry['timestamp'] = time.time()
+        self._save(host, entry)
+        return entry
+
+
+class IdentityCache(_HostCache):
+    '''
+    Which identity file authenticated each "user@host:port" last time.
+    Entries are dicts like:
+
+        {"timestamp": 1400000000.0, "identity_file": "/home/me/.ssh/id_rsa",
+         "fingerprint": "..."}
+
+    Entries older than max_age seconds are stale and dropped,
+    so keys removed from hosts are forgotten eventually.
+    '''
+    def __init__(self, directory=None, max_age=30 * 24 * 3600):
+        super(IdentityCache, self).__init__(
+            directory or os.path.join(CACHE_DIR, 'identities'))
+        self.max_age = max_age
+
+    def get(self, host, now=None):
+        entry = self._load(host)
+        now = now or time.time()
+        if entry and now - entry.get('timestamp', 0) > self.max_age:
+            self.invalidate(host)
+            return None
+        return entry
+
+    def put(self, host, identity_file, fingerprint):
+        entry = {'timestamp': time.time(),
+                 'identity_file': identity_file,
+                 'fingerprint': fingerprint}
+        self._save(host, entry)
+        return entry
@@ -42,7 +42,10 @@ except:
         def emit(self, record):
             pass
 
+import json
 import os
+import re
+import time
 
 from subprocess import Popen, PIPE, STDOUT
 import shlex
@@ -52,15 +55,133 @@ ERROR_EXCEPTION_RAISED = 60002
 ERROR_FAILED_TO_DETECT_SYSTEM = 60003
 ERROR_MISC_ERROR = 60100
 
+# Printed by yum-plugin-security (or yum >= 3.4 itself) with "--security".
+YUM_SECURITY_SUMMARY = re.compile(
+    r'(\d+) package\(s\) needed for security, out of (\d+) available')
+YUM_NO_SECURITY_SUMMARY = re.compile(
+    r'No packages needed for security; (\d+) packages available')
+# Packages are listed as "name.arch", with any arch
+# (x86_64, noarch, armv7hl, ppc64le, ...).
+YUM_PACKAGE_NAME = re.compile(r'^(\S+)\.([A-Za-z0-9_]+)$')
+
 logger = getLogger(__name__)
 
+
+def strip_arch(package):
+    '''
+    "openssl.x86_64" -> "openssl"
+    '''
+    match = YUM_PACKAGE_NAME.match(package)
+    if match:
+        return match.group(1)
+    return package
+
+
+def parse_yum_check_update(output):
+    '''
+    Parses the output of "yum [--security] check-update".
+    Returns (updates, sec_updates, packages, versions).
+    Also used by check_updates.py (See parsers.py), so keep this file
+    free of other dependencies.
+
+    With "--security", the summary line yum prints gives both counts
+    while the listed packages are limited to security relevant ones.
+    Without it (or with a yum too old to print the summary),
+    updates is the number of listed packages and sec_updates is None.
+    versions maps listed packages to their available versions.
+    '''
+    updates = None
+    sec_updates = None
+    packages = []
+    versions = {}
+    # yum puts a long package name alone on a line, and its version and
+    # repository on the next line.
+    pending_name = None
+    for line in output.split('\n'):
+        match = YUM_SECURITY_SUMMARY.search(line)
+        if match:
+            (sec_updates, updates) = (int(match.group(1)),
+                                      int(match.group(2)))
+            continue
+        match = YUM_NO_SECURITY_SUMMARY.search(line)
+        if match:
+            (sec_updates, updates) = (0, int(match.group(1)))
+            continue
+        if line.startswith('Obsoleting Packages'):
+            # Packages below are listed again with what they obsolete.
+            break
+        words = line.split()
+        if pending_name:
+            if len(words) == 2 and line[0].isspace():
+                name = strip_arch(pending_name)
+                packages.append(name)
+                versions[name] = words[0]
+            pending_name = None
+            continue
+        if not words or line[0].isspace():
+            continue
+        if not YUM_PACKAGE_NAME.match(words[0]):
+            continue
+        if len(words) == 3:
+            name = strip_arch(words[0])
+            packages.append(name)
+            versions[name] = words[1]
+        elif len(words) == 1:
+            pending_name = words[0]
+    if updates is None:
+        updates = len(packages)
+    return (updates, sec_updates, packages, versions)
+
+
 class TesterBase(object):
+    def __init__(self):
+        # (updates, sec_updates), or the exception counting them raised.
+        self._counts = None
+
     def needs_reboot(self):
         raise NotImplementedError()
 
+    def _count_updates(self):
+        raise NotImplementedError()
+
+    def get_update_counts(self):
+        '''
+        Returns (updates, sec_updates) of _count_updates(), running
+        the package manager once however often it is called. When it
+        failed, later calls raise the same error without running it again.
+        '''
+        if self._counts is None:
+            try:
+                self._counts = self._count_updates()
+            except Exception as e:
+                self._counts = e
+                raise
+        if isinstance(self._counts, Exception):
+            raise self._counts
+        return self._counts
+
     def get_update_count(self, is_security_updates):
         raise NotImplementedError()
 
+    def get_status(self):
+        '''
+        Returns a dict with "updates", "sec_updates" and "reboot_required",
+        running the package manager at most once. A value that could not
+        be computed is ERROR_EXCEPTION_RAISED instead.
+        '''
+        status = {}
+        for (key, getter) in (
+                ('updates', lambda: self.get_update_count(False)),
+                ('sec_updates', lambda: self.get_update_count(True)),
+                ('reboot_required', lambda: int(self.needs_reboot()))):
+            try:
+                status[key] = getter()
+            except Exception:
+                import traceback
+                logger.error(traceback.format_exc())
+                status[key] = ERROR_EXCEPTION_RAISED
+        return status
+
     @classmethod
     def get_instance(cls, args):
         '''
@@ -139,22 +260,28 @@ class DebianTester(TesterBase):
         else:
             return False
 
-    def get_update_count(self, is_security_updates=False):
+    def _count_updates(self):
+        '''
+        Returns (updates, sec_updates) of a single apt-check run.
+        '''
         # Run apt-file command, expecting "updates;sec-updates" string.
         p = Popen([self.APT_CHECK_FILE], stderr=STDOUT, stdout=PIPE)
-        p.wait()
+        stdout_str = p.communicate()[0]
         if (p.returncode > 0):
             raise RuntimeError('apt-check failed with {0}. err:\n{1}'
-                               .format(p.returncode, p.stdout.read()))
+                               .format(p.returncode, stdout_str))
 
         # '18;2' -> update 18, sec-update 2
-        stdout_str = p.stdout.read()
         logger.debug('stdout: {0}'.format(stdout_str))
         (updates, sec_updates) = stdout_str.split(';')
+        return (int(updates), int(sec_updates))
+
+    def get_update_count(self, is_security_updates=False):
+        (updates, sec_updates) = self.get_update_counts()
         if is_security_updates:
-            return int(sec_updates)
+            return sec_updates
         else:
-            return int(updates)
+            return updates
 
 
 class RedhatTester(TesterBase):
@@ -188,25 +315,284 @@ class RedhatTester(TesterBase):
         # date and other info, don't use "!=" but "not in". 
         return current_kernel not in latest_kernel_line
 
-    def get_update_count(self, is_security_updates=False):
-        if is_security_updates:
-            cmd = 'yum --security check-update'
-        else:
-            cmd = 'yum check-update'
-        p = Popen(shlex.split(cmd), stderr=PIPE, stdout=PIPE)
-        p.wait()
+    def _run_check_update(self, cmd):
+        p = Popen(shlex.split(cmd), stderr=STDOUT, stdout=PIPE)
+        output = p.communicate()[0]
 
         # yum returns 0 when there's no update and returns 100
         # when there are update(s).
         # Will return 1 on error, but be a bit more pessimistic here.
         if p.returncode != 0 and p.returncode != 100:
-            raise RuntimeError('Failed to run "{0}" (ret: {1}). stderr:\n{2}'
-                               .format(cmd, p.returncode,
-                                       p.stderr.read().rstrip()))
-        output = p.stdout.read()
-        update_lines = filter(lambda x: x.rstrip().endswith('updates'),
-                              output.split('\n'))
-        return len(update_lines)
+            raise RuntimeError('Failed to run "{0}" (ret: {1}). output:\n{2}'
+                               .format(cmd, p.returncode, output.rstrip()))
+        return output
+
+    def _count_updates(self):
+        '''
+        Returns (updates, sec_updates). sec_updates is None when yum
+        can't tell (e.g. yum-plugin-security is not installed).
+
+        A single "yum --security check-update" tells both numbers,
+        so yum's metadata loading and dependency resolution run once.
+        '''
+        try:
+            output = self._run_check_update('yum --security check-update')
+            (updates, sec_updates, listed,
+             _) = parse_yum_check_update(output)
+        except RuntimeError:
+            logger.debug('"yum --security" failed. Trying without it.')
+            (updates, sec_updates, listed) = (None, None, None)
+        if sec_updates is None:
+            # Older yum does not print the summary; its list is limited
+            # to security updates though.
+            if listed is not None:
+                sec_updates = len(listed)
+            output = self._run_check_update('yum check-update')
+            updates = parse_yum_check_update(output)[0]
+        return (updates, sec_updates)
+
+    def get_update_count(self, is_security_updates=False):
+        (updates, sec_updates) = self.get_update_counts()
+        if is_security_updates:
+            if sec_updates is None:
+                raise RuntimeError('Failed to count security updates.')
+            return sec_updates
+        return updates
+
+
+STATUS_KEYS = ('updates', 'sec_updates', 'reboot_required')
+
+
+def get_status(args):
+    '''
+    Returns TesterBase.get_status() of this system.
+    All values are error numbers when the system can't be detected.
+    '''
+    try:
+        tester = TesterBase.get_instance(args)
+    except Exception:
+        import traceback
+        logger.error(traceback.format_exc())
+        return dict((key, ERROR_EXCEPTION_RAISED) for key in STATUS_KEYS)
+    if not tester:
+        logger.error('Failed to find appropriate tester')
+        return dict((key, ERROR_FAILED_TO_DETECT_SYSTEM)
+                    for key in STATUS_KEYS)
+    return tester.get_status()
+
+
+def format_status(status, output_format):
+    '''
+    "json" -> {"reboot_required": 1, "sec_updates": 1, "updates": 2}
+    "keyvalue" -> "updates=2\nsec_updates=1\nreboot_required=1"
+    '''
+    if output_format == 'json':
+        return json.dumps(dict((key, status[key]) for key in STATUS_KEYS),
+                          sort_keys=True)
+    return '\n'.join('{0}={1}'.format(key, status[key])
+                     for key in STATUS_KEYS)
+
+
+# Files/directories whose changes may change get_status() results.
+# Directories are watched because package managers replace files
+# (write a new one and rename it) rather than modifying them.
+# None means any entry in the directory.
+# Only the rpmdb itself is watched in /var/lib/rpm; yum and rpm of
+# the agent write its "__db.*" and lock files on every run.
+WATCHED_PATHS = (('/var/lib/dpkg', ('status',)),
+                 ('/var/lib/apt/lists', None),
+                 ('/var/lib/rpm', ('Packages', 'rpmdb.sqlite')),
+                 ('/var/run', ('reboot-required',)))
+
+DEFAULT_STATE_FILE = '/var/lib/check_update_local/state'
+# Even without changes the agent recomputes this often (seconds),
+# e.g. to notice updates yum finds on mirrors.
+DEFAULT_AGENT_INTERVAL = 3600
+DEFAULT_AGENT_DEBOUNCE = 10
+
+
+def write_state(path, status, now=None):
+    '''
+    Atomically writes status (plus a timestamp) in "keyvalue" format.
+    '''
+    import tempfile
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    content = '{0}\ntimestamp={1}\n'.format(
+        format_status(status, 'keyvalue'), int(now or time.time()))
+    (fd, tmp_path) = tempfile.mkstemp(dir=directory, prefix='.state-')
+    try:
+        os.write(fd, content)
+        os.close(fd)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_state(path, max_age, now=None):
+    '''
+    Returns status written by write_state(), or None when the file
+    does not exist, is broken or is older than max_age seconds.
+    '''
+    try:
+        f = open(path)
+        try:
+            lines = f.read().split('\n')
+        finally:
+            f.close()
+        values = dict(line.split('=', 1) for line in lines if '=' in line)
+        if (now or time.time()) - int(values['timestamp']) > max_age:
+            logger.debug('{0} is too old'.format(path))
+            return None
+        return dict((key, int(values[key])) for key in STATUS_KEYS)
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+class _InotifyWatcher(object):
+    '''
+    Waits for changes under WATCHED_PATHS with Linux inotify (via ctypes).
+    '''
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    def __init__(self, watched_paths):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        # watch descriptor -> names we care about (None: any)
+        self.names = {}
+        for (path, names) in watched_paths:
+            if not os.path.isdir(path):
+                continue
+            wd = libc.inotify_add_watch(self.fd, path, self.MASK)
+            if wd < 0:
+                logger.warning('Failed to watch {0}'.format(path))
+                continue
+            self.names[wd] = names
+
+    def _read_relevant(self, timeout):
+        import select
+        import struct
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return None
+        data = os.read(self.fd, 65536)
+        relevant = False
+        offset = 0
+        # struct inotify_event { int wd; uint32_t mask, cookie, len;
+        #                        char name[len]; }
+        while offset < len(data):
+            (wd, _, _, length) = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            names = self.names.get(wd)
+            if names is None or name in names:
+                relevant = True
+        return relevant
+
+    def drain(self):
+        '''
+        Forgets events queued so far, e.g. ones caused by the agent's own
+        yum/apt-check runs.
+        '''
+        while self._read_relevant(0) is not None:
+            pass
+
+    def wait(self, timeout, debounce):
+        '''
+        Returns after something relevant changed and nothing more changed
+        for debounce seconds, or after timeout seconds.
+        '''
+        deadline = time.time() + timeout
+        changed = False
+        while True:
+            remaining = deadline - time.time()
+            if changed:
+                remaining = debounce
+            elif remaining <= 0:
+                return
+            relevant = self._read_relevant(remaining)
+            if relevant is None:
+                if changed:
+                    return
+                continue
+            changed = changed or relevant
+
+
+class _PollingWatcher(object):
+    '''
+    Fallback of _InotifyWatcher looking at mtimes every few seconds.
+    '''
+    POLL_INTERVAL = 5
+
+    def __init__(self, watched_paths):
+        self.paths = []
+        for (path, names) in watched_paths:
+            if names is None:
+                self.paths.append(path)
+            else:
+                self.paths.extend(os.path.join(path, name) for name in names)
+
+    def _snapshot(self):
+        snapshot = {}
+        for path in self.paths:
+            try:
+                snapshot[path] = os.stat(path).st_mtime
+            except OSError:
+                snapshot[path] = None
+        return snapshot
+
+    def drain(self):
+        # wait() compares against mtimes taken when it is called.
+        pass
+
+    def wait(self, timeout, debounce):
+        deadline = time.time() + timeout
+        last = self._snapshot()
+        changed_at = None
+        while time.time() < deadline or changed_at:
+            time.sleep(self.POLL_INTERVAL)
+            current = self._snapshot()
+            if current != last:
+                changed_at = time.time()
+                last = current
+            elif changed_at and time.time() - changed_at >= debounce:
+                return
+
+
+def run_agent(args):
+    '''
+    Keeps args.state_file up to date, recomputing the status only when
+    package manager state changes (or every args.agent_interval seconds).
+    '''
+    try:
+        watcher = _InotifyWatcher(WATCHED_PATHS)
+    except (OSError, AttributeError) as e:
+        logger.warning('inotify is not available ({0}). Polling instead.'
+                       .format(e))
+        watcher = _PollingWatcher(WATCHED_PATHS)
+    while True:
+        status = get_status(args)
+        write_state(args.state_file, status)
+        logger.debug('Wrote {0}: {1}'.format(args.state_file, status))
+        # Don't let the recompute trigger the next one.
+        watcher.drain()
+        watcher.wait(args.agent_interval, args.agent_debounce)
 
 
 def main():
@@ -224,6 +610,35 @@ def main():
                         action='store_true',
                         help=('Instead of showing num of updates,'
                               ' return 1 if reboot is required'))
+    parser.add_argument('-f', '--format', default='number',
+                        choices=('number', 'json', 'keyvalue'),
+                        help=('"number" (default) shows a single number.'
+                              ' "json" and "keyvalue" show num of updates,'
+                              ' num of security updates and reboot status'
+                              ' at once (-s and -r are ignored).'
+                              ' Errors are shown as the same error numbers.'))
+    parser.add_argument('--agent', action='store_true',
+                        help=('Keep running, writing the status to'
+                              ' --state-file whenever package state'
+                              ' changes.'))
+    parser.add_argument('--from-state', action='store_true',
+                        help=('Read the status --agent wrote instead of'
+                              ' running apt-check/yum. Falls back to'
+                              ' computing it when the file is missing'
+                              ' or outdated.'))
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE,
+                        help=('State file for --agent and --from-state.'
+                              ' Default: %(default)s'))
+    parser.add_argument('--agent-interval', type=int,
+                        default=DEFAULT_AGENT_INTERVAL,
+                        help=('Seconds after which --agent recomputes the'
+                              ' status even without changes.'
+                              ' Default: %(default)s'))
+    parser.add_argument('--agent-debounce', type=int,
+                        default=DEFAULT_AGENT_DEBOUNCE,
+                        help=('Seconds without further changes --agent'
+                              ' waits for before recomputing.'
+                              ' Default: %(default)s'))
     parser.add_argument('-q', '--quiet',
                         action='store_true',
                         help='Logging will be disabled entirely.')
@@ -258,6 +673,29 @@ def main():
     handler.setLevel(level)
     logger.addHandler(handler)
     logger.debug('Started.')
+    if args.agent:
+        try:
+            run_agent(args)
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.from_state:
+        # Outdated when the agent missed two recomputations.
+        status = read_state(args.state_file, 2 * args.agent_interval)
+        if status:
+            if args.format != 'number':
+                print(format_status(status, args.format))
+            elif args.reboot_required:
+                print(status['reboot_required'])
+            elif args.security_updates:
+                print(status['sec_updates'])
+            else:
+                print(status['updates'])
+            return
+    if args.format != 'number':
+        print(format_status(get_status(args), args.format))
+        logger.debug('Finished')
+        return
     try:
         tester = TesterBase.get_instance(args)
         if not tester:
@@ -9,42 +9,53 @@ need to be updated or not.
 from __future__ import print_function
 
 import argparse
+import sys
+import time
 
-from fabric.api import hide,sudo,run
+from fabric.api import hide
 from fabric.context_managers import shell_env
-from fabric.contrib.files import exists
+from fabric.exceptions import NetworkError
+from fabric.network import normalize
 from fabric.tasks import execute
+from fabric import state
 from fabric.state import env
 from fabric.utils import abort,error,puts,warn
 
-import paramiko
-import socket
-
+import aggregate
+import broker
+import engine
 import fabwrap
-
-# Prepare those function by yourself.
-from hosts import get_hosts, get_host_groups
-
+import liveness
+import parsers
+import probe
+import profiling
+import replay
+import rolling
+from cache import FactsCache, ResultCache
+from inventory import InventoryError, load_inventory
+from remote import FabricConnection
+from results import HostResult, JsonlWriter
 from utils import query_yes_no
 
 
-# http://stackoverflow.com/questions/1956777/
-def _is_host_up(host, port):
-    original_timeout = socket.getdefaulttimeout()
-    new_timeout = 3
-    socket.setdefaulttimeout(new_timeout)
+def _connect(host_string):
+    '''
+    Opens the ssh connection for host_string and keeps it in Fabric's
+    connection cache, where later run()/sudo() calls pick it up.
+    Returns None when connected, or why the host is not reachable.
+    '''
     try:
-        paramiko.Transport((host, port))
-        return True
-    except:
-        return False
-    finally:
-        socket.setdefaulttimeout(original_timeout)
+        state.connections.connect(host_string)
+    except NetworkError as e:
+        warn('Host {} is down. ({})'.format(host_string, e))
+        return 'Host is down. ({})'.format(e)
+    return None
 
 
 def _get_update_line(host, updates, sec_updates, reboot_required,
                      packages=None):
-    updates_str = '{}({})'.format(updates, sec_updates)
+    updates_str = '{}({})'.format(updates,
+                                  '?' if sec_updates is None else sec_updates)
     ret = ((u'{:<%d}: {:>6}' % env.host_column_size)
            .format(host, updates_str))
     if reboot_required:
@@ -62,73 +73,123 @@ def _print_update_line(host, updates, sec_updates, reboot_required,
                            packages))
 
 
-def check_reboot_required_debian():
-    return exists('/var/run/reboot-required')
+def report_result(result, args, record='check'):
+    '''
+    Shows the result of a host as soon as the host is finished,
+    in the format --format asks for. record is for "--format jsonl"
+    (See results.JsonlWriter).
+    '''
+    if args.format == 'jsonl':
+        # None in forked processes. See check_hosts().
+        if env.jsonl_writer:
+            env.jsonl_writer.write(result, record=record)
+        return
+    if not (result.needs_attention()
+            or (result.succeeded and args.verbose)):
+        return
+    if result.apt_command and args.show_packages and not result.packages:
+        warn('No packages found for {}'.format(result.host))
+    else:
+        _print_update_line(result.host, result.updates, result.sec_updates,
+                           result.reboot_required, result.packages)
 
 
-def check_updates_debian(apt_command):
+def _report_failure(host_string, message):
     '''
-    Returns (updates, sec_updates, reboot_required) when successful.
+    "on_failure" function for engine.execute_threaded().
+    '''
+    result = HostResult(host_string, error=message)
+    result.phases = profiling.take()
+    report_result(result, env.args)
+    return result
+
+
+def print_summary(results):
+    '''
+    Prints one line per host, sorted by host, after all hosts are finished.
+    '''
+    print('Summary:')
+    for result in sorted(results, key=lambda result: result.host):
+        if result.succeeded:
+            _print_update_line(result.host, result.updates,
+                               result.sec_updates, result.reboot_required,
+                               result.packages)
+        else:
+            print((u'{:<%d}: (ERROR) {}' % env.host_column_size)
+                  .format(result.host, result.error))
+
+
+def check_reboot_required_debian(conn):
+    with profiling.phase('reboot check'):
+        return conn.exists('/var/run/reboot-required')
+
+
+def check_updates_debian(conn, apt_command, has_apt_check=None):
+    '''
+    Returns (updates, sec_updates, reboot_required, packages, versions)
+    when successful. packages and versions are None unless
+    --show-packages is set.
     Returns None on failure.
+    has_apt_check tells if apt-check is known to exist. None means unknown.
     '''
-    quiet = not env.args.verbose
-    if env.args.refresh:
-        result = sudo('apt-get update', warn_only=True, quiet=quiet)
+    quiet = not conn.args.verbose
+    if conn.args.refresh:
+        with profiling.phase('apt-get update'):
+            result = conn.sudo('apt-get update', warn_only=True,
+                               quiet=quiet)
         if result.failed:
-            error('{}: apt-get update failed.'.format(env.host))
+            error('{}: apt-get update failed.'.format(conn.host))
             return
 
     # Ubuntu or Debian with additional apt-check
-    if not exists('/usr/lib/update-notifier/apt-check'):
-        print((u'{:<%d}: (apt-check is not available)'
-               % env.host_column_size)
-              .format(env.host))
+    if has_apt_check is None:
+        has_apt_check = conn.exists('/usr/lib/update-notifier/apt-check')
+    if not has_apt_check:
+        # host_column_size is not there when used via api.py.
+        puts((u'{:<%d}: (apt-check is not available)'
+              % env.get('host_column_size', 0))
+             .format(conn.host), show_prefix=False)
         return None
-    result = run('/usr/lib/update-notifier/apt-check',
-                 warn_only=True,
-                 quiet=quiet)
-    if result.failed:
-        error('{}: apt-check failed.'.format(env.host))
+    packages = None
+    versions = None
+    if conn.args.show_packages:
+        # "apt-get -s" lists packages for aptitude users too,
+        # without root privileges.
+        with profiling.phase('apt-check + apt-get -s'):
+            result = conn.run(probe.APT_CHECK_AND_SIMULATE_SCRIPT,
+                              warn_only=True, quiet=quiet)
+        (status, counts, listed) = probe.parse_apt_check_and_simulate_output(
+            str(result.stdout))
+        if status == '0' and result.succeeded:
+            with profiling.phase('show packages'):
+                (packages,
+                 versions) = parsers.apt_packages_and_versions(listed)
+    else:
+        with profiling.phase('apt-check'):
+            result = conn.run('/usr/lib/update-notifier/apt-check',
+                              warn_only=True,
+                              quiet=quiet)
+        status = '0' if result.succeeded else None
+        counts = str(result.stdout)
+    if status != '0':
+        error('{}: apt-check failed.'.format(conn.host))
         return None
-    (updates, sec_updates) = map(lambda x: int(x),
-                                 str(result.stdout).split(';'))
-    reboot_required = check_reboot_required_debian()
-    if updates or sec_updates or reboot_required or env.args.verbose:
-        if env.args.show_packages:
-            result = sudo('{} -s upgrade'.format(apt_command),
-                          warn_only=True, quiet=quiet)
-            if result.succeeded:
-                do_check_next = False
-                packages = None
-                for line in str(result.stdout).split('\n'):
-                    if do_check_next:
-                        packages = line.split()
-                        break
-                    elif 'The following packages will be upgraded' in line:
-                        do_check_next = True
-                        pass
-                    pass
-                if packages:
-                    _print_update_line(env.host, updates, sec_updates,
-                                       reboot_required, packages)
-                else:
-                    warn('No packages found for {}'.format(env.host))
-
-        else:
-            _print_update_line(env.host, updates, sec_updates, reboot_required)
+    (updates, sec_updates) = map(lambda x: int(x), counts.split(';'))
+    reboot_required = check_reboot_required_debian(conn)
 
-    return (updates, sec_updates, reboot_required)
+    return (updates, sec_updates, reboot_required, packages, versions)
 
 
-def check_reboot_required_centos():
+def check_reboot_required_centos(conn):
     '''
     * True == Reboote Required
     * False == Reboot not Required
     * None == unknown
     '''
-    quiet = not env.args.verbose
-    result_1 = run('rpm -q --last kernel', quiet=quiet)
-    result_2 = run('uname -r', quiet=quiet)
+    quiet = not conn.args.verbose
+    with profiling.phase('reboot check'):
+        result_1 = conn.run('rpm -q --last kernel', quiet=quiet)
+        result_2 = conn.run('uname -r', quiet=quiet)
     if result_1.succeeded and result_2.succeeded:
         # e.g. "kernel-2.6.32-431.11.2.el6.x86_64"
         latest_line = str(result_1.stdout).split()[0]
@@ -139,159 +200,655 @@ def check_reboot_required_centos():
         reboot_required = None
     return reboot_required
 
-def run_yum_check_update(security=False):
+def run_yum_check_update(conn, security=False):
     '''
-    Returns (updates, packages).
-    Note packages will be useful only when env.args.show_packages is set.
+    Returns (updates, sec_updates, packages, versions), or None on failure.
+    See parsers.parse_yum_check_update() for what they mean.
     '''
-    quiet = env.args.quiet
-    options = []
-    if security: options.append('--security')
-    if quiet:    options.append('--quiet')
-    cmd = 'yum {} check-update'.format(' '.join(options))
+    # "--quiet" would hide the summary line "--security" prints.
+    if security:
+        cmd = 'yum --security check-update'
+    else:
+        cmd = 'yum check-update'
 
     # yum returns 0 when there's no update and returns 100 there are updates.
     # On the other hand Fabric treats the return code 100 as "error".
     # To suppress meaningless warning, refrain using "warn_only" flag here.
-    result = run(cmd, quiet=True)
+    with profiling.phase(cmd):
+        result = conn.run(cmd, quiet=True)
 
     # yum returns 1 on error.
     # Here, treat non-0 and non-100 as an error just in case.
     if result.return_code != 0 and result.return_code != 100:
-        error('yum failed with return_code "{}"'.format(result.return_code))
         return None
+    return parsers.parse_yum_check_update(str(result.stdout))
 
-    output = str(result.stdout)
-    update_lines = filter(lambda x: x.rstrip().endswith('updates'),
-                          output.split('\n'))
-    # Count the number of lines that contain "update" at the end.
-    updates = len(update_lines)
-    if env.args.show_packages:
-        packages = []
-        for update in update_lines:
-            packages.append(update.split()[0]
-                            .rstrip('.x86_64')
-                            .rstrip('.x386')
-                            .rstrip('.noarch'))
-    else:
-        packages = None
-    return (updates, packages)
 
-def check_updates_centos():
+def check_updates_centos(conn):
     '''
-    Returns (updates, sec_updates, reboot_required) when successful.
+    Returns (updates, sec_updates, reboot_required, packages, versions)
+    when successful. packages and versions are None unless
+    --show-packages is set.
     Returns None on failure.
     '''
-    (updates, packages) = run_yum_check_update(False)
-    (sec_updates, _) = run_yum_check_update(True)
-    reboot_required = check_reboot_required_centos()
+    # A single "yum --security check-update" tells both counts.
+    # It lists security relevant packages only though, so another run
+    # without "--security" is needed for --show-packages,
+    # or when the security plugin doesn't tell the total.
+    security_result = run_yum_check_update(conn, security=True)
+    plain_result = None
+    if (not security_result or security_result[1] is None
+        or conn.args.show_packages):
+        plain_result = run_yum_check_update(conn)
+        if not plain_result:
+            error('{}: yum check-update failed.'.format(conn.host))
+            return None
+    (updates, sec_updates, packages, versions) = parsers.combine_yum_results(
+        security_result, plain_result)
+    if not conn.args.show_packages:
+        packages = None
+        versions = None
+    reboot_required = check_reboot_required_centos(conn)
+    return (updates, sec_updates, reboot_required, packages, versions)
 
-    # Note: reboot_required == None means 'Unknown',
-    # in which case we want to show the line.
-    if (updates or reboot_required or reboot_required == None
-        or env.args.verbose):
-        _print_update_line(env.host, updates, sec_updates, reboot_required,
-                           packages)
 
-    return (updates, 0, reboot_required)
+def upgrade_debian(conn, apt_command):
+    # Show updates by default.
+    quiet = conn.args.quiet
+    if conn.args.dist_upgrade:
+        return conn.sudo('{} -y dist-upgrade'.format(apt_command),
+                         warn_only=True, quiet=quiet)
+    else:
+        return conn.sudo('{} -y upgrade'.format(apt_command),
+                         warn_only=True, quiet=quiet)
 
 
-def upgrade_debian(apt_command):
+def upgrade_centos(conn):
     # Show updates by default.
-    quiet = env.args.quiet
-    if env.args.dist_upgrade:
-        sudo('{} -y dist-upgrade'.format(apt_command),
-             warn_only=True, quiet=quiet)
+    quiet = conn.args.quiet
+    return conn.sudo('yum -y upgrade', warn_only=True, quiet=quiet)
+
+
+def check_updates_probe(conn):
+    '''
+    Same as check_updates_debian()/check_updates_centos(), but asks
+    everything with a single remote command (See probe.py).
+    Returns (apt_command,
+             (updates, sec_updates, reboot_required, packages, versions))
+    when successful. Returns None on failure.
+    '''
+    quiet = not conn.args.verbose
+    script = probe.build_probe_script(
+        prefer_aptitude=conn.args.prefer_aptitude,
+        refresh=conn.args.refresh,
+        show_packages=conn.args.show_packages)
+    # "apt-get update" needs root privilege. "apt-get -s upgrade"
+    # (--show-packages) does not.
+    if conn.args.refresh:
+        with profiling.phase('probe'):
+            result = conn.sudo(script, warn_only=True, quiet=quiet)
     else:
-        sudo('{} -y upgrade'.format(apt_command),
-             warn_only=True, quiet=quiet)
+        with profiling.phase('probe'):
+            result = conn.run(script, warn_only=True, quiet=quiet)
+    info = probe.parse_probe_output(str(result.stdout))
+    if not info:
+        error('{}: probe failed.'.format(conn.host))
+        return None
+    try:
+        (apt_command, updates, sec_updates, reboot_required, packages,
+         versions) = probe.interpret_probe(
+             info, show_packages=conn.args.show_packages)
+    except ValueError as e:
+        error('{}: {}'.format(conn.host, e))
+        return None
 
+    if conn.args.prefer_aptitude and apt_command == 'apt-get':
+        warn(('Host {} does not have aptitude command'
+              ' while aptitude is preferred.'
+              ' Will use apt-get instead.')
+             .format(conn.host))
+    return (apt_command,
+            (updates, sec_updates, reboot_required, packages, versions))
 
-def upgrade_centos():
-    # Show updates by default.
-    quiet = env.args.quiet
-    sudo('yum -y upgrade', warn_only=True, quiet=quiet)
 
+def check_host(conn):
+    '''
+    Detects the package manager and checks updates of the host.
+    Returns (apt_command,
+             (updates, sec_updates, reboot_required, packages, versions))
+    when successful. apt_command is None on redhat-like hosts.
+    Returns None on failure.
+    '''
+    if conn.args.probe:
+        return check_updates_probe(conn)
 
-def do_check_updates():
-    quiet = not env.args.verbose
-    if not _is_host_up(env.host, int(env.port)):
-        warn('Host {} on port {} is down.'.format(env.host, env.port))
-        return
+    facts = get_host_facts(conn)
+    if not facts:
+        error('{}: failed to detect the package manager.'.format(conn.host))
+        return None
 
     # Contains apt_get/aptitude command. None on CentOS
     apt_command = None
 
-    if env.args.prefer_aptitude:
-        result_aptitude = run('command -v aptitude >& /dev/null', quiet=True)
-        result_aptget = run('command -v apt-get >& /dev/null', quiet=True)
-        if result_aptitude.succeeded:
-            apt_command = 'aptitude'
-        elif result_aptget.succeeded:
+    if conn.args.prefer_aptitude and facts['has_aptitude']:
+        apt_command = 'aptitude'
+    elif facts['has_apt_get']:
+        if conn.args.prefer_aptitude:
             warn(('Host {} does not have aptitude command'
                   ' while aptitude is preferred.'
                   ' Will use apt-get instead.')
-                 .format(env.host))
-            apt_command = 'apt-get'
-    else:
-        result_aptget = run('command -v apt-get >& /dev/null', quiet=True)
-        if result_aptget.succeeded:
-            apt_command = 'apt-get'
-    if not apt_command:
-        result = run('command -v yum >& /dev/null', quiet=quiet)
-        if result.failed:
-            error('Host {} does not have apt or yum. Exitting.'
-                  .format(env.host))
-            return
+                 .format(conn.host))
+        apt_command = 'apt-get'
+    elif not facts['has_yum']:
+        _invalidate_facts(conn)
+        error('Host {} does not have apt or yum. Exitting.'
+              .format(conn.host))
+        return None
+
+    result = None
+    try:
+        if apt_command:
+            result = check_updates_debian(
+                conn, apt_command, has_apt_check=facts['has_apt_check'])
+        else:
+            result = check_updates_centos(conn)
+    finally:
+        # Also reached when error() aborted the check.
+        if not result:
+            # Maybe the host has changed. Detect facts again next time.
+            _invalidate_facts(conn)
+    if not result:
+        return None
+    return (apt_command, result)
+
+
+def _invalidate_facts(conn):
+    # Replays don't touch the facts of the real host.
+    if not conn.args.replay:
+        FactsCache().invalidate(conn.host_string)
+
+
+def get_host_facts(conn):
+    '''
+    Returns facts of the host (See cache.FactsCache), detecting them
+    with a single command unless they are remembered already.
+    Returns None on failure.
+    '''
+    facts_cache = FactsCache()
+    if not conn.args.forget_facts:
+        facts = facts_cache.get(conn.host_string)
+        if facts:
+            return facts
+    with profiling.phase('facts'):
+        result = conn.run(probe.FACTS_SCRIPT, warn_only=True, quiet=True)
+    if result.failed:
+        return None
+    facts = probe.parse_facts_output(str(result.stdout))
+    if conn.args.replay:
+        # Recorded facts are not the hosts' current ones.
+        return facts
+    return facts_cache.put(conn.host_string, facts)
+
+
+def get_fingerprint(conn):
+    '''
+    Returns a string that changes whenever the check result of the host
+    may change (See probe.FINGERPRINT_FILES), or None on failure.
+    '''
+    with profiling.phase('fingerprint'):
+        result = conn.run(probe.FINGERPRINT_SCRIPT, warn_only=True,
+                          quiet=True)
+    if result.failed:
+        return None
+    return str(result.stdout).strip()
+
+
+def _get_unchanged_result(conn, result_cache, fingerprint):
+    '''
+    Returns the cache entry of the host when its fingerprint did not change
+    since the entry was stored, refreshing the entry's timestamp.
+    '''
+    previous = result_cache.get(conn.host_string)
+    if (not fingerprint or not previous
+        or previous.get('fingerprint') != fingerprint):
+        return None
+    if conn.args.show_packages and previous['packages'] is None:
+        return None
+    return result_cache.put(HostResult.from_cache_entry(conn.host_string,
+                                                        previous),
+                            fingerprint=fingerprint)
+
+
+def _get_cached_result(host_string, args):
+    '''
+    Returns the cache entry of host_string if --max-age allows using it.
+    '''
+    if args.max_age is None or args.refresh:
+        return None
+    entry = ResultCache().get(host_string, max_age=args.max_age)
+    if entry and args.show_packages and entry['packages'] is None:
+        return None
+    return entry
+
+
+def do_check_updates(conn=None):
+    '''
+    Checks (and upgrades/reboots when requested) a single host.
+    Without conn, works on the host Fabric is currently working on.
+    Reports and returns a results.HostResult.
+    '''
+    started = time.time()
+    host_string = conn.host_string if conn else env.host_string
+    args = conn.args if conn else env.args
+    if not conn:
+        profiling.reset()
+    try:
+        result = _do_check_updates(conn)
+    except SystemExit as e:
+        # fabric.utils.abort()/error() was called for this host.
+        if args.format != 'jsonl':
+            raise
+        result = HostResult(host_string,
+                            error=getattr(e, 'message', None) or 'Aborted')
+    result.started = started
+    result.elapsed = time.time() - started
+    result.phases = profiling.take()
+    report_result(result, args)
+    return result
 
-    if apt_command:
-        result = check_updates_debian(apt_command)
+
+def _do_check_updates(conn):
+    if not conn:
+        # Being able to connect is what "up" means here.
+        with profiling.phase('connect'):
+            reason = _connect(env.host_string)
+        if reason:
+            return HostResult(env.host_string, error=reason)
+        conn = FabricConnection()
+    quiet = not conn.args.verbose
+
+    result_cache = ResultCache()
+    entry = _get_cached_result(conn.host_string, conn.args)
+    source = 'cache'
+    fingerprint = None
+    if not entry and conn.args.incremental and not conn.args.refresh:
+        # Taken before the check, so that changes made during the check
+        # show up as a different fingerprint next time.
+        fingerprint = get_fingerprint(conn)
+        entry = _get_unchanged_result(conn, result_cache, fingerprint)
+        source = 'fingerprint'
+    if entry:
+        result = HostResult.from_cache_entry(conn.host_string, entry,
+                                             source=source)
     else:
-        result = check_updates_centos()
-
-    if result:
-        upgrade_done = False
-        (updates, sec_updates, reboot_required) = result
-        if (updates or sec_updates):
-            do_upgrade = False
-            if env.args.auto_upgrade:
-                do_upgrade = True
-            elif env.args.ask_upgrade:
-                do_upgrade = ('yes' == query_yes_no('Upgrade "{}"? '
-                                                    .format(env.host)))
-
-            if do_upgrade:
-                puts('Upgrading {}'.format(env.host))
-                if apt:
-                    upgrade_debian(apt)
-                else:
-                    upgrade_centos()
-                upgrade_done = True
+        checked = check_host(conn)
+        if not checked:
+            return HostResult(conn.host_string, error='Check failed.')
+        (apt_command, (updates, sec_updates, reboot_required,
+                       packages, versions)) = checked
+        result = HostResult(conn.host_string, apt_command=apt_command,
+                            updates=updates, sec_updates=sec_updates,
+                            reboot_required=reboot_required,
+                            packages=packages, versions=versions)
+        if not conn.args.replay:
+            result_cache.put(result, fingerprint=fingerprint)
+
+    if conn.args.deferred:
+        # Upgrades come after all hosts are checked. See rolling_upgrade()
+        # and ask_upgrades().
+        return result
+
+    apt_command = result.apt_command
+    reboot_required = result.reboot_required
+    if result.has_updates():
+        do_upgrade = False
+        if conn.args.auto_upgrade:
+            do_upgrade = True
+        elif conn.args.ask_upgrade:
+            do_upgrade = ('yes' == query_yes_no('Upgrade "{}"? '
+                                                .format(conn.host)))
 
+        if do_upgrade:
+            puts('Upgrading {}'.format(conn.host))
+            with profiling.phase('upgrade'):
                 if apt_command:
-                    reboot_required = check_reboot_required_debian(apt_command)
+                    upgrade_debian(conn, apt_command)
                 else:
-                    reboot_required = check_reboot_required_centos()
-
-        if upgrade_done or reboot_required:
-            do_reboot = False
-            if env.args.auto_upgrade_restart:
-                do_reboot = True
-            elif reboot_required and env.args.ask_upgrade:
-                do_reboot = ('yes' == query_yes_no('Reboot "{}"? '
-                                                   .format(env.host)))
-            if do_reboot:
-                puts('Rebooting {}'.format(env.host))
-                sudo('reboot', warn_only=True, quiet=quiet)
-
-    if env.args.verbose:
+                    upgrade_centos(conn)
+            result.upgraded = True
+            # What we remember is not true anymore.
+            result_cache.invalidate(conn.host_string)
+
+            if apt_command:
+                reboot_required = check_reboot_required_debian(conn)
+            else:
+                reboot_required = check_reboot_required_centos(conn)
+
+    if result.upgraded or reboot_required:
+        do_reboot = False
+        if conn.args.auto_upgrade_restart:
+            do_reboot = True
+        elif reboot_required and conn.args.ask_upgrade:
+            do_reboot = ('yes' == query_yes_no('Reboot "{}"? '
+                                               .format(conn.host)))
+        if do_reboot:
+            puts('Rebooting {}'.format(conn.host))
+            result.rebooted_at = time.time()
+            conn.sudo('reboot', warn_only=True, quiet=quiet)
+            result.rebooted = True
+
+    if conn.args.verbose:
         puts('Finished')
+    return result
+
+
+def serve_cached_hosts(hosts, args):
+    '''
+    Reports results of hosts checked within --max-age seconds.
+    Returns (results, the other hosts). Hosts with fresh results are
+    still returned as other hosts when an upgrade or reboot may be
+    needed on them.
+    '''
+    upgrading = args.auto_upgrade or args.ask_upgrade
+    served = []
+    remaining = []
+    for host_string in hosts:
+        entry = _get_cached_result(host_string, args)
+        result = entry and HostResult.from_cache_entry(host_string, entry)
+        if not result or (upgrading and (result.has_updates()
+                                         or result.reboot_required)):
+            remaining.append(host_string)
+        else:
+            result.started = time.time()
+            result.elapsed = 0.0
+            report_result(result, args)
+            served.append(result)
+    return (served, remaining)
 
 
-def do_sanity_check():
-    result = run('uname -s')
+def prescan_hosts(hosts, args):
+    '''
+    Probes ssh ports of all hosts at once.
+    Returns (results of hosts that are down, hosts that are up).
+    '''
+    targets = []
+    for host_string in hosts:
+        (_, host, port) = normalize(host_string)
+        targets.append((host_string, host, port))
+    negative_cache = liveness.NegativeCache(ttl=args.down_cache_ttl)
+    started = time.time()
+    scan = liveness.scan(targets, timeout=args.prescan_timeout,
+                         negative_cache=negative_cache)
+    down = []
+    for host_string in scan.down:
+        if host_string in scan.cached:
+            warn('Host {} is down. (cached)'.format(host_string))
+            reason = 'Host is down. (cached)'
+        else:
+            warn('Host {} is down.'.format(host_string))
+            reason = 'Host is down.'
+        result = HostResult(host_string, started=started,
+                            elapsed=scan.elapsed, error=reason)
+        report_result(result, args)
+        down.append(result)
+    puts('Liveness scan: {} up, {} down ({} cached) in {:.2f} sec'
+         .format(len(scan.up), len(scan.down), len(scan.cached),
+                 scan.elapsed))
+    return (down, scan.up)
+
+
+def do_sanity_check(conn=None):
+    conn = conn or FabricConnection()
+    result = conn.run('uname -s')
     if str(result.stdout) != 'Linux':
-        abort('{} is Non-Linux machine.'.format(env.host))
+        abort('{} is Non-Linux machine.'.format(conn.host))
+
+
+def _get_broker_connector(args):
+    if not args.broker:
+        return None
+    broker_client = broker.BrokerClient(args.broker)
+    if not broker_client.is_available():
+        warn('Broker is not running at {}. Connecting directly.'
+             .format(args.broker))
+        return None
+    args.engine = 'thread'
+    return broker.broker_connector(broker_client, args)
+
+
+def _get_connector(args):
+    '''
+    Returns a "connect" function for engine.execute_threaded()
+    when --replay, --record or --broker is used, otherwise None.
+    '''
+    if args.replay:
+        args.engine = 'thread'
+        return env.replay.connector(args)
+    connect = _get_broker_connector(args)
+    if args.record:
+        # Recordings are not collected from forked processes.
+        args.engine = 'thread'
+        return env.recorder.connector(connect or engine.open_connection)
+    return connect
+
+
+def check_hosts(hosts, args):
+    '''
+    Runs do_check_updates() on hosts and returns their results.
+    '''
+    if args.sanity_check:
+        puts('Start sanity check')
+        execute(do_sanity_check, hosts=hosts)
+    connect = _get_connector(args)
+    if args.engine == 'thread':
+        returned = engine.execute_threaded(do_check_updates, hosts,
+                                           jobs=args.jobs,
+                                           connect=connect,
+                                           on_failure=_report_failure)
+    elif env.parallel and args.format == 'jsonl':
+        # Records written by forked processes may interleave;
+        # write them here when all of them are finished instead.
+        writer = env.jsonl_writer
+        env.jsonl_writer = None
+        try:
+            returned = execute(do_check_updates, hosts=hosts)
+        finally:
+            env.jsonl_writer = writer
+        for result in returned.values():
+            if isinstance(result, HostResult):
+                report_result(result, args)
+    else:
+        returned = execute(do_check_updates, hosts=hosts)
+    return [result for result in returned.values() if result]
+
+
+def _upgrade_hosts(targets, by_host, args, needs_upgrade, needs_reboot,
+                   **kwargs):
+    '''
+    Upgrades (and reboots) targets that were checked already,
+    with rolling.RollingUpgrade on the thread engine. by_host maps hosts
+    to their HostResult, which is updated and reported as soon as
+    each host is finished. kwargs go to RollingUpgrade.
+    Returns what RollingUpgrade.run() returns.
+    '''
+    def upgrade(conn):
+        puts('Upgrading {}'.format(conn.host))
+        apt_command = by_host[conn.host_string].apt_command
+        if apt_command:
+            result = upgrade_debian(conn, apt_command)
+        else:
+            result = upgrade_centos(conn)
+        # What we remember is not true anymore.
+        ResultCache().invalidate(conn.host_string)
+        return result.succeeded
+
+    def report(rolled):
+        result = by_host[rolled.host]
+        result.upgraded = rolled.upgraded
+        result.rebooted = rolled.rebooted
+        result.rebooted_at = rolled.rebooted_at
+        result.downtime = rolled.downtime
+        result.error = rolled.error
+        if args.format == 'jsonl':
+            report_result(result, args, record='upgrade')
+        elif rolled.error:
+            warn('{}: {}'.format(rolled.host, rolled.error))
+        elif rolled.rebooted:
+            puts('Rebooted {}'.format(rolled.host))
+
+    scheduler = rolling.RollingUpgrade(
+        _get_connector(args) or engine.open_connection,
+        upgrade, needs_upgrade, needs_reboot, report=report, **kwargs)
+    return scheduler.run(targets)
+
+
+def rolling_upgrade(hosts, results, args, groups):
+    '''
+    Upgrades (and reboots) hosts that need it after checking,
+    a few at a time (See rolling.py).
+    '''
+    by_host = dict((result.host, result) for result in results
+                   if result.succeeded)
+
+    def needs_upgrade(host_string):
+        result = by_host[host_string]
+        return result.has_updates()
+
+    def needs_reboot(conn, upgraded):
+        return bool(args.auto_upgrade_restart
+                    and (upgraded
+                         or by_host[conn.host_string].reboot_required))
+
+    targets = [host_string for host_string in hosts
+               if host_string in by_host
+               and (needs_upgrade(host_string)
+                    or (args.auto_upgrade_restart
+                        and by_host[host_string].reboot_required))]
+    if not targets:
+        return
+    (rolled, not_started) = _upgrade_hosts(
+        targets, by_host, args, needs_upgrade, needs_reboot, groups=groups,
+        batch_size=args.batch_size, max_rebooting=args.max_rebooting,
+        health_timeout=args.health_timeout,
+        max_failure_rate=args.max_failure_rate)
+    failed = len([result for result in rolled if result.error])
+    puts('Rolling upgrade: {} done, {} failed, {} not started'
+         .format(len(rolled) - failed, failed, len(not_started)))
+    if not_started:
+        warn('Stopped: more than {:.0%} of hosts failed.'
+             .format(args.max_failure_rate))
+
+
+def ask_upgrades(hosts, results, args):
+    '''
+    --ask-upgrade on parallel mode. Shows hosts that were checked and need
+    an upgrade or reboot, asks about all of them at once, then upgrades
+    and reboots approved hosts in parallel.
+    '''
+    by_host = dict((result.host, result) for result in results
+                   if result.succeeded)
+    candidates = [host_string for host_string in hosts
+                  if host_string in by_host
+                  and (by_host[host_string].has_updates()
+                       or by_host[host_string].reboot_required)]
+    if not candidates:
+        return
+    print_summary([by_host[host_string] for host_string in candidates])
+
+    to_upgrade = set()
+    to_reboot = set()
+    for host_string in candidates:
+        result = by_host[host_string]
+        if result.has_updates():
+            if 'yes' == query_yes_no('Upgrade "{}"? '.format(host_string)):
+                to_upgrade.add(host_string)
+        if result.reboot_required:
+            question = 'Reboot "{}"? '
+        elif host_string in to_upgrade:
+            question = 'Reboot "{}" if the upgrade requires it? '
+        else:
+            continue
+        if 'yes' == query_yes_no(question.format(host_string)):
+            to_reboot.add(host_string)
+
+    def needs_reboot(conn, upgraded):
+        result = by_host[conn.host_string]
+        if conn.host_string not in to_reboot:
+            return False
+        if result.reboot_required or not upgraded:
+            return bool(result.reboot_required)
+        if result.apt_command:
+            return check_reboot_required_debian(conn)
+        return bool(check_reboot_required_centos(conn))
+
+    targets = [host_string for host_string in candidates
+               if host_string in to_upgrade or host_string in to_reboot]
+    if targets:
+        _upgrade_hosts(targets, by_host, args, to_upgrade.__contains__,
+                       needs_reboot,
+                       batch_size=args.jobs or engine.DEFAULT_JOBS,
+                       health_timeout=None)
+
+
+def verify_reboots(results, args):
+    '''
+    Waits for rebooted hosts in results to come back, confirms they don't
+    require a reboot anymore and reports their downtime.
+    Hosts not back within --health-timeout are reported as errors.
+    '''
+    rebooted = [result for result in results
+                if result.rebooted and result.succeeded]
+    if not rebooted:
+        return
+    # Hosts rebooted by --rolling were waited for already.
+    waiting = [result for result in rebooted if result.downtime is None]
+    if waiting:
+        puts('Waiting for {} rebooted hosts'.format(len(waiting)))
+        targets = []
+        for result in waiting:
+            (_, host, port) = normalize(result.host)
+            targets.append((result.host, host, port, result.rebooted_at))
+        watches = liveness.wait_for_reboot(targets,
+                                           timeout=args.health_timeout)
+        for result in waiting:
+            result.downtime = watches[result.host].downtime
+            if result.downtime is None:
+                result.error = ('Host did not come back within {} sec.'
+                                .format(args.health_timeout))
+                _report_verified(result, args)
+
+    by_host = dict((result.host, result) for result in rebooted
+                   if result.succeeded)
+
+    def verify(conn):
+        result = by_host[conn.host_string]
+        if result.apt_command:
+            result.reboot_required = check_reboot_required_debian(conn)
+        else:
+            result.reboot_required = check_reboot_required_centos(conn)
+        if result.reboot_required:
+            result.error = 'Still requires a reboot.'
+        return result
+
+    def failed(host_string, message):
+        by_host[host_string].error = message
+        return by_host[host_string]
+
+    for (_, result) in engine.iter_threaded(verify, list(by_host),
+                                            jobs=args.jobs,
+                                            connect=_get_connector(args),
+                                            on_failure=failed):
+        _report_verified(result, args)
+
+
+def _report_verified(result, args):
+    if args.format == 'jsonl':
+        report_result(result, args, record='verify')
+    elif result.error:
+        warn('{}: {}'.format(result.host, result.error))
+    else:
+        puts('{} is back after {:.1f} sec down'
+             .format(result.host, result.downtime))
 
 
 def main():
@@ -301,7 +858,15 @@ def main():
                         help=(u'Host names or host groups. If not specified,'
                               u' default hosts configuration will be used.'
                               u' This may allow special command "all" "list",'
-                              u' "groups" (= "list_groups").'))
+                              u' "groups" (= "list_groups").'
+                              u' Globs ("web*") and regexes ("re:^db[0-9]")'
+                              u' select all matching hosts.'))
+    parser.add_argument('--inventory', metavar='SOURCE',
+                        help=(u'Where hosts and host groups come from:'
+                              u' a JSON or YAML file, or "ssh-config[:PATH]"'
+                              u' for "Host" entries of ~/.ssh/config.'
+                              u' Default: get_hosts()/get_host_groups()'
+                              u' of hosts.py'))
     parser.add_argument('-s', '--serial', action='store_true',
                         help=u'Executes check in serial manner')
     parser.add_argument('-q', '--quiet', action='store_true',
@@ -313,8 +878,10 @@ def main():
     parser.add_argument('--ask-upgrade', action='store_true',
                         help=(u'Asks if upgrade should be done when'
                               u' appropriate.'
-                              u' Only effective when --serial (-s) option'
-                              u' is set'))
+                              u' Without --serial (-s), asks about all hosts'
+                              u' after checking them in parallel, then'
+                              u' upgrades approved hosts in parallel,'
+                              u' which requires password-less sudo.'))
     parser.add_argument('--auto-upgrade', action='store_true',
                         help=(u'Requests hosts to upgrade itself'
                               u' when necessary.'))
@@ -331,10 +898,12 @@ def main():
                               u' This will execute "dist-upgrade"'
                               u' on debian(-like) OSes, not "upgrade.'))
     parser.add_argument('--refresh', action='store_true',
-                        help=(u'Run "apt-get update" on debian-like systems.'))
+                        help=(u'Run "apt-get update" on debian-like systems.'
+                              u' Also ignores results cached for --max-age.'))
     parser.add_argument('--show-packages', action='store_true',
                         help=(u'This will show names of packages'
-                              u' to be upgraded.'))
+                              u' to be upgraded, including new and held back'
+                              u' ones on debian-like systems.'))
     parser.add_argument('--sanity-check', action='store_true',
                         help=(u'First executes sanity check toward each host'
                               u' serially (not in parallel).'
@@ -347,6 +916,143 @@ def main():
                         help=(u'Try using "aptitude" instead of "apt-get"'
                               u' on debian-like systems.'
                               u' If not available, use "apt-get" anyway.'))
+    parser.add_argument('--engine', choices=('fork', 'thread'),
+                        default='fork',
+                        help=(u'How hosts are checked in parallel.'
+                              u' "fork" (default) lets Fabric fork'
+                              u' one process per host.'
+                              u' "thread" checks all hosts in this process'
+                              u' with at most --jobs concurrent sessions.'
+                              u' "thread" requires password-less sudo.'))
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help=(u'Maximum number of hosts checked at once.'
+                              u' Default: all hosts with "fork" engine,'
+                              u' {} with "thread" engine.'
+                              .format(engine.DEFAULT_JOBS)))
+    parser.add_argument('--broker', nargs='?', const=broker.DEFAULT_SOCKET,
+                        metavar='SOCKET',
+                        help=(u'Run commands through ssh sessions kept open'
+                              u' by broker.py listening on SOCKET'
+                              u' (Default: {}).'
+                              u' Implies "--engine thread".'
+                              .format(broker.DEFAULT_SOCKET)))
+    parser.add_argument('--max-age', type=int, default=None,
+                        metavar='SECONDS',
+                        help=(u'Use results of hosts checked within SECONDS'
+                              u' instead of connecting to them again.'
+                              u' Ignored with --refresh.'))
+    parser.add_argument('--incremental', action='store_true',
+                        help=(u'Reuse the last result of a host when files'
+                              u' of its package manager and its kernel'
+                              u' did not change since then. One cheap'
+                              u' "stat" instead of apt-check/yum.'
+                              u' Changes on mirrors are not noticed until'
+                              u' the host refreshes its package lists.'))
+    parser.add_argument('--prescan', action='store_true',
+                        help=(u'Before checking, probe ssh ports of all hosts'
+                              u' at once and skip hosts that are down.'))
+    parser.add_argument('--prescan-timeout', type=float,
+                        default=liveness.DEFAULT_TIMEOUT,
+                        help=(u'Seconds to wait for each host'
+                              u' during --prescan. Default: %(default)s'))
+    parser.add_argument('--down-cache-ttl', type=int,
+                        default=liveness.DEFAULT_NEGATIVE_TTL,
+                        help=(u'Seconds --prescan remembers hosts that'
+                              u' were down and skips them without probing.'
+                              u' 0 disables it. Default: %(default)s'))
+    parser.add_argument('--forget-facts', action='store_true',
+                        help=(u'Detect package managers etc. of hosts again'
+                              u' instead of using ones remembered from'
+                              u' previous runs.'))
+    parser.add_argument('--probe', action='store_true',
+                        help=(u'Check each host with a single remote command'
+                              u' instead of several separate ones.'
+                              u' Saves ssh round trips on slow networks.'))
+    parser.add_argument('--rolling', action='store_true',
+                        help=(u'With --auto-upgrade(-restart), upgrade'
+                              u' hosts a batch at a time after checking'
+                              u' all of them, waiting for rebooted hosts'
+                              u' to come back before the next batch.'
+                              u' Requires password-less sudo.'))
+    parser.add_argument('--batch-size', type=int,
+                        default=rolling.DEFAULT_BATCH_SIZE,
+                        help=(u'Maximum number of hosts upgrading at once'
+                              u' with --rolling. Default: %(default)s'))
+    parser.add_argument('--max-rebooting', type=int,
+                        default=rolling.DEFAULT_MAX_REBOOTING,
+                        help=(u'Maximum number of hosts rebooting at once'
+                              u' in each host group with --rolling.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--health-timeout', type=int,
+                        default=rolling.DEFAULT_HEALTH_TIMEOUT,
+                        metavar='SECONDS',
+                        help=(u'Seconds to wait for a rebooted host to'
+                              u' accept ssh sessions again with --rolling'
+                              u' or --verify-reboot.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--max-failure-rate', type=float, default=None,
+                        metavar='RATE',
+                        help=(u'Stop --rolling before the next batch when'
+                              u' more than RATE (0.0-1.0) of upgraded hosts'
+                              u' failed.'))
+    parser.add_argument('--verify-reboot', action='store_true',
+                        help=(u'After rebooting hosts, wait for them to'
+                              u' come back (up to --health-timeout),'
+                              u' confirm they no longer require a reboot'
+                              u' and show how long they were down.'))
+    parser.add_argument('--profile', action='store_true',
+                        help=(u'When all hosts are finished, show'
+                              u' percentiles of the time spent in each phase'
+                              u' (connect, apt-check, ...) and the slowest'
+                              u' hosts.'))
+    parser.add_argument('--profile-top', type=int,
+                        default=profiling.DEFAULT_TOP, metavar='N',
+                        help=(u'Number of slowest hosts --profile shows.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--profile-json', metavar='PATH',
+                        help=(u'Also write the --profile report and phases'
+                              u' of every host to PATH as JSON.'))
+    parser.add_argument('--package-report', action='store_true',
+                        help=(u'When all hosts are finished, show packages'
+                              u' pending on the most hosts, with their'
+                              u' versions and host groups.'
+                              u' Implies --show-packages.'))
+    parser.add_argument('--package-top', type=int,
+                        default=aggregate.DEFAULT_TOP, metavar='N',
+                        help=(u'Number of packages --package-report shows.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--package', action='append', dest='package_queries',
+                        metavar='NAME',
+                        help=(u'When all hosts are finished, show every host'
+                              u' NAME is pending on, with versions and host'
+                              u' groups. Can be given more than once.'
+                              u' Implies --show-packages.'))
+    parser.add_argument('--format', choices=('text', 'jsonl'), default='text',
+                        help=(u'"jsonl" writes one JSON object per host'
+                              u' to stdout as soon as the host is finished,'
+                              u' including timing and errors.'
+                              u' With the (parallel) "fork" engine, records'
+                              u' are written when all hosts are finished.'
+                              u' Hosts upgraded or verified later get'
+                              u' another record; see its "record" field.'
+                              u' Other messages go to stderr then.'
+                              u' Default: %(default)s'))
+    parser.add_argument('--summary', action='store_true',
+                        help=(u'When all hosts are finished, show results'
+                              u' of all hosts again, sorted by host name.'))
+    parser.add_argument('--record', metavar='PATH',
+                        help=(u'Save every command run on each host with'
+                              u' its output to PATH (gzipped JSON), for'
+                              u' --replay. Implies "--engine thread" and'
+                              u' --forget-facts, and ignores --max-age'
+                              u' and --incremental so that the full check'
+                              u' is recorded.'))
+    parser.add_argument('--replay', metavar='PATH',
+                        help=(u'Check hosts recorded with --record PATH'
+                              u' using the recorded outputs instead of'
+                              u' connecting to them. Nothing is cached.'
+                              u' Can\'t be combined with upgrades,'
+                              u' --prescan or --sanity-check.'))
     args = parser.parse_args()
     output_groups = ()
     if args.verbose:
@@ -367,6 +1073,12 @@ def main():
                   u' Consider using "all" for host param,'
                   u' which will do what you want.')
 
+        try:
+            inventory = load_inventory(args.inventory)
+        except InventoryError as e:
+            abort(str(e))
+        groups = inventory.groups
+
         # If there are one ore more "host" arguments are available,
         # Try the following;
         # 1. If the *first* argument is actually a special sequence like "all",
@@ -377,18 +1089,19 @@ def main():
         #       mark all hosts in the group as check targets.
         #   2.2 if it looks registered host name,
         #       mark it as a check target.
-        #   2.3 if it looks part of a *single* registered host name,
+        #   2.3 if it looks a glob or a regex (prefixed with "re:"),
+        #       mark all matching hosts as targets.
+        #   2.4 if it looks part of a *single* registered host name,
         #       mark it as a target.
-        #   2.4 if there are multiple candidates for the argument,
+        #   2.5 if there are multiple candidates for the argument,
         #       show an error and exit the app without actual check.
-        #   2.5 if "-n" option is set, mark the host name as a target silently.
+        #   2.6 if "-n" option is set, mark the host name as a target silently.
         if args.hosts:
-            groups = get_host_groups()
             if len(args.hosts) == 1 and args.hosts[0] == 'all':
-                hosts = get_hosts()
+                hosts = list(inventory.hosts)
                 args.hosts = []
             elif len(args.hosts) == 1 and args.hosts[0] == 'list':
-                print('\n'.join(get_hosts()))
+                print('\n'.join(inventory.hosts))
                 return
             elif (len(args.hosts) == 1
                   and (args.hosts[0] == 'list-groups'
@@ -400,26 +1113,14 @@ def main():
                     print((u'{:<%d}: {}' % column_size)
                           .format(key, ', '.join(value)))
                 return
-
-            hosts = []
-            for host in args.hosts:
-                if groups.has_key(host):
-                    hosts.extend(groups[host])
-                elif host in get_hosts():
-                    hosts.append(host)
-                else:
-                    filtered = filter(lambda x: host in x, get_hosts())
-                    if len(filtered) == 1:
-                        hosts.append(filtered[0])
-                    elif len(filtered) > 1:
-                        abort('Multiple candidates for "{}"'.format(host))
-                    elif args.nonregistered:
-                        hosts.append(host)
-                    else:
-                        abort('No idea how to handle "{}"'.format(host))
-                
+            else:
+                try:
+                    hosts = inventory.resolve(
+                        args.hosts, allow_unregistered=args.nonregistered)
+                except InventoryError as e:
+                    abort(str(e))
         else:
-            hosts = get_hosts()
+            hosts = list(inventory.hosts)
         if not hosts:
             abort('No hosts provided.')
 
@@ -432,26 +1133,93 @@ def main():
 
         if args.auto_upgrade_restart:
             args.auto_upgrade = True
+        if args.package_report or args.package_queries:
+            args.show_packages = True
 
         # On serial execution there's no need to abort on prompts.
         # Also assume serial execution when there's just one host.
         if len(hosts) == 1:
             args.serial = True
+        if args.serial:
+            args.jobs = 1
         env.parallel = not args.serial
+        env.pool_size = args.jobs or 0
         env.abort_on_prompts = not args.serial
 
+        if args.rolling and not args.auto_upgrade:
+            abort('--rolling needs --auto-upgrade'
+                  ' or --auto-upgrade-restart.')
+        if args.batch_size < 1 or args.max_rebooting < 1:
+            abort('--batch-size and --max-rebooting must be 1 or more.')
+
         if args.ask_upgrade:
-            if not args.serial:
-                abort('--ask-upgrade is useless on parallel mode.')
             if args.auto_upgrade:
                 abort('--ask-upgrade is useless when auto-upgrade is enabled.')
 
+        if args.record and args.replay:
+            abort('--record and --replay are exclusive.')
+        if args.replay and (args.auto_upgrade or args.ask_upgrade
+                            or args.verify_reboot or args.prescan
+                            or args.sanity_check):
+            abort('--replay only replays checks.')
+        env.recorder = None
+        if args.record or args.replay:
+            # Run exactly the commands of a full check each time.
+            args.forget_facts = True
+            args.max_age = None
+            args.incremental = False
+        if args.record:
+            env.recorder = replay.Recorder()
+        if args.replay:
+            try:
+                env.replay = replay.Replay(args.replay)
+            except replay.ReplayError as e:
+                abort(str(e))
+
+        if args.format == 'jsonl':
+            # Keep stdout for the records only.
+            env.jsonl_writer = JsonlWriter(sys.stdout)
+            sys.stdout = sys.stderr
+
+        # Upgrade after checking all hosts, instead of from each check.
+        args.deferred = args.rolling or (args.ask_upgrade and not args.serial)
+
         # Remember our args.
         env.args = args
-        if args.sanity_check:
-            puts('Start sanity check')
-            execute(do_sanity_check, hosts=hosts)
-        execute(do_check_updates, hosts=hosts)
+        finished = []
+        targets = hosts
+        if args.max_age is not None:
+            (served, hosts) = serve_cached_hosts(hosts, args)
+            finished.extend(served)
+        if hosts:
+            if args.prescan:
+                (down, hosts) = prescan_hosts(hosts, args)
+                finished.extend(down)
+                if not hosts:
+                    abort('No hosts are up.')
+            finished.extend(check_hosts(hosts, args))
+        if args.rolling:
+            rolling_upgrade(targets, finished, args, groups)
+        elif args.ask_upgrade and not args.serial:
+            ask_upgrades(targets, finished, args)
+        if args.verify_reboot:
+            verify_reboots(finished, args)
+        if env.recorder:
+            env.recorder.save(args.record)
+        if args.summary:
+            print_summary(finished)
+        if args.package_report or args.package_queries:
+            index = aggregate.PackageIndex(groups=groups)
+            for result in finished:
+                index.add(result)
+            top = args.package_top if args.package_report else 0
+            aggregate.report(index, top=top, names=args.package_queries)
+        if args.profile or args.profile_json:
+            profile = profiling.summarize(finished, top=args.profile_top)
+            if args.profile:
+                profiling.report(profile)
+            if args.profile_json:
+                profiling.export(profile, finished, args.profile_json)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+In-process execution engine for check_updates.py.
+
+fabric.tasks.execute() with env.parallel forks one process per host,
+which does not scale to thousands of hosts (memory, fds, fork storms).
+execute_threaded() instead runs each host's task on one of a bounded
+number of worker threads, talking to the host via remote.SSHConnection.
+'''
+
+from fabric.exceptions import NetworkError
+from fabric.network import normalize
+from fabric import state
+from fabric.state import env
+from fabric.utils import warn
+
+import Queue
+import threading
+
+import profiling
+from remote import SSHConnection
+
+
+DEFAULT_JOBS = 32
+
+
+def open_connection(host_string, args=None):
+    '''
+    Default "connect" function for execute_threaded().
+    The connection carries args, env.args by default.
+    Raises NetworkError when the host is not reachable.
+    '''
+    (user, host, port) = normalize(host_string)
+    client = state.connections.open(host_string)
+    return SSHConnection(client, host, port,
+                         env.args if args is None else args,
+                         host_string=host_string)
+
+
+def _run_task(task, host_string, connect, on_failure):
+    profiling.reset()
+    try:
+        with profiling.phase('connect'):
+            conn = connect(host_string)
+    except NetworkError as e:
+        warn('Host {} is down. ({})'.format(host_string, e))
+        return on_failure(host_string, 'Host is down. ({})'.format(e))
+    except SystemExit as e:
+        # e.g. abort_on_prompts met a password prompt.
+        return on_failure(host_string,
+                          getattr(e, 'message', None) or 'Aborted')
+    except Exception as e:
+        # e.g. the broker or an identity file failed.
+        message = '{}: {}'.format(e.__class__.__name__, e)
+        warn('{}: {}'.format(host_string, message))
+        return on_failure(host_string, message)
+    try:
+        return task(conn)
+    except SystemExit as e:
+        # fabric.utils.abort() was called for this host.
+        # Don't let it stop the other hosts.
+        return on_failure(host_string,
+                          getattr(e, 'message', None) or 'Aborted')
+    except Exception as e:
+        message = '{}: {}'.format(e.__class__.__name__, e)
+        warn('{}: {}'.format(conn.host, message))
+        return on_failure(host_string, message)
+    finally:
+        conn.close()
+
+
+def _ignore_failure(host_string, message):
+    return None
+
+
+def iter_threaded(task, hosts, jobs=None, connect=None, on_failure=None):
+    '''
+    Runs task(conn) for each host with at most "jobs" hosts in flight,
+    yielding (host, return value of the task) as soon as each host is
+    finished. conn is made by connect(host), open_connection() by default.
+    When the host was not reachable or the task failed, the value is
+    on_failure(host, message), None by default.
+    '''
+    jobs = jobs or DEFAULT_JOBS
+    connect = connect or open_connection
+    on_failure = on_failure or _ignore_failure
+    queue = Queue.Queue()
+    for host in hosts:
+        queue.put(host)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                host = queue.get_nowait()
+            except Queue.Empty:
+                return
+            # Exactly one result per host, or iter_threaded() would wait
+            # for it forever.
+            value = None
+            try:
+                value = _run_task(task, host, connect, on_failure)
+            except (Exception, SystemExit) as e:
+                warn('{}: {}: {}'.format(host, e.__class__.__name__, e))
+            finally:
+                finished.put((host, value))
+
+    for _ in range(min(jobs, len(hosts))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    for _ in range(len(hosts)):
+        while True:
+            # get() without timeout can't be interrupted by Ctrl-C
+            # on Python 2.
+            try:
+                item = finished.get(True, 1)
+                break
+            except Queue.Empty:
+                pass
+        yield item
+
+
+def execute_threaded(task, hosts, jobs=None, connect=None, on_failure=None):
+    '''
+    Like fabric.tasks.execute(), returns a dict mapping each host to
+    the return value of the task. See iter_threaded() for the arguments.
+    '''
+    return dict(iter_threaded(task, hosts, jobs=jobs, connect=connect,
+                              on_failure=on_failure))
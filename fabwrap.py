@@ -16,6 +16,9 @@ from fabric.state import env, output
 from fabric import state
 from logging import getLogger
 
+from cache import IdentityCache
+import profiling
+
 # from logging import StreamHandler
 from logging import NullHandler, DEBUG
 
@@ -27,6 +30,7 @@ import paramiko
 import paramiko as ssh
 import socket
 import sys
+import threading
 import time
 
 
@@ -42,6 +46,71 @@ def get_fingerprint(line):
     return hashlib.md5(key).hexdigest()
 
 
+class KeyIndex(object):
+    '''
+    Process-wide index of fingerprints of identity files and of keys
+    ssh-agent has, so that connecting to thousands of hosts does not
+    read and hash the same .pub files and ask the agent for its keys
+    thousands of times.
+
+    Agent keys sign through the agent connection they came from, which
+    paramiko doesn't let concurrent users share. So each thread (and each
+    forked process) keeps its own agent connection and fingerprint map,
+    asking the agent again only when SSH_AUTH_SOCK changed, or when a
+    fingerprint is not known (a key may have been added) and the map is
+    older than refresh_interval seconds.
+    '''
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # path -> (mtime, fingerprint)
+        self._identity_fingerprints = {}
+        self._local = threading.local()
+
+    def identity_fingerprint(self, identity_file):
+        '''
+        Returns the fingerprint of identity_file (from its ".pub" file).
+        '''
+        path = '{}.pub'.format(identity_file)
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            cached = self._identity_fingerprints.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path) as f:
+            fingerprint = get_fingerprint(f.readline().rstrip())
+        with self._lock:
+            self._identity_fingerprints[path] = (mtime, fingerprint)
+        return fingerprint
+
+    def _load_agent_keys(self):
+        local = self._local
+        local.agent = paramiko.Agent()
+        local.keys = dict((hexlify(key.get_fingerprint()), key)
+                          for key in local.agent.get_keys())
+        local.loaded_at = time.time()
+        local.pid = os.getpid()
+        local.auth_sock = os.environ.get('SSH_AUTH_SOCK')
+
+    def agent_key(self, fingerprint):
+        '''
+        Returns the agent key with fingerprint (in hex), or None.
+        '''
+        local = self._local
+        if (getattr(local, 'pid', None) != os.getpid()
+            or local.auth_sock != os.environ.get('SSH_AUTH_SOCK')):
+            # First use in this thread, or forked since then.
+            self._load_agent_keys()
+        elif (fingerprint not in local.keys
+              and time.time() - local.loaded_at > self.refresh_interval):
+            local.agent.close()
+            self._load_agent_keys()
+        return local.keys.get(fingerprint)
+
+
+key_index = KeyIndex()
+
+
 class CustomHostConnectionCache(HostConnectionCache):
     '''
     fabric.network.HostConnectionCache that awares of OpenSSH's config file.
@@ -63,16 +132,43 @@ class CustomHostConnectionCache(HostConnectionCache):
             with open(config_file) as f:
                 self.ssh_config.parse(f)
 
-    def connect(self, key, logger=None):
+    def open(self, key, logger=None):
+        '''
+        Returns a new connected paramiko.SSHClient for key
+        without remembering it in this cache.
+        '''
         logger = logger or local_logger
         user, host, port = normalize(key)
         logger.debug('user: {}, host: {}, port: {}'.format(user, host, port))
-        key = normalize_to_string(key)
         identity_config = self.ssh_config.lookup(host)
         identity_files = identity_config.get('identityfile')
-        self[key] = wrap_connect(user, host, port,
-                                 cache=self,
-                                 identity_files=identity_files)
+        return wrap_connect(user, host, port,
+                            cache=self,
+                            identity_files=identity_files)
+
+    def connect(self, key, logger=None):
+        self[normalize_to_string(key)] = self.open(key, logger=logger)
+
+
+def open_socket(host, port, timeout):
+    '''
+    Like socket.create_connection(), recording "dns" and "tcp" phases.
+    '''
+    with profiling.phase('dns'):
+        addresses = socket.getaddrinfo(host, int(port), 0,
+                                       socket.SOCK_STREAM)
+    error = None
+    with profiling.phase('tcp'):
+        for (family, socktype, proto, _, address) in addresses:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+                return sock
+            except socket.error as e:
+                sock.close()
+                error = e
+    raise error
 
 
 def wrap_connect(user, host, port, cache,
@@ -94,41 +190,55 @@ def wrap_connect(user, host, port, cache,
     password = get_password(user, host, port)
     tries = 0
     sock = None
-    agent = paramiko.Agent()
-    agent_keys = agent.get_keys()
-    key_dict = {}
-    for key in agent_keys:
-        fp = hexlify(key.get_fingerprint())
-        key_dict[fp] = key
+
+    # Try first what worked last time, saving failed attempts
+    # (and sshd's MaxAuthTries).
+    identity_cache = IdentityCache()
+    auth_key = '{}@{}:{}'.format(user, host, port)
+    learned = identity_cache.get(auth_key)
+    if learned and learned['identity_file'] in identity_files:
+        learned_file = learned['identity_file']
+        identity_files = ([learned_file]
+                          + [f for f in identity_files if f != learned_file])
+    else:
+        learned = None
 
     for identity_file in identity_files:
-        pubkey_line = open('{}.pub'.format(identity_file)).readline().rstrip()
-        fingerprint = get_fingerprint(pubkey_line)
+        fingerprint = key_index.identity_fingerprint(identity_file)
         logger.debug('using identity "{}"(fp: {})'.format(identity_file, fingerprint))
-        pkey = key_dict.get(fingerprint)
+        pkey = key_index.agent_key(fingerprint)
         if not pkey:
             readable = ':'.join(a+b for a,b in zip(fingerprint[::2], fingerprint[1::2]))
             logger.info('Agent does not know a key for {} "{}"'.format(host, readable))
             continue
         try:
             tries += 1
+            sock = None
             if seek_gateway:
                 sock = network.get_gateway(host, port, cache, replace=tries > 0)
-            client.connect(
-                hostname=host,
-                port=int(port),
-                username=user,
-                password=None,
-                pkey=pkey,
-                key_filename=identity_file,
-                timeout=env.timeout,
-                allow_agent=not env.no_agent,
-                look_for_keys=not env.no_keys,
-                sock=sock
-            )
+            if sock is None:
+                # Opened here instead of by paramiko to tell how long
+                # name lookup and TCP take (See profiling.py).
+                sock = open_socket(host, port, env.timeout)
+            with profiling.phase('ssh handshake'):
+                client.connect(
+                    hostname=host,
+                    port=int(port),
+                    username=user,
+                    password=None,
+                    pkey=pkey,
+                    key_filename=identity_file,
+                    timeout=env.timeout,
+                    allow_agent=not env.no_agent,
+                    look_for_keys=not env.no_keys,
+                    sock=sock
+                )
             connected = True
             if env.keepalive:
                 client.get_transport().set_keepalive(env.keepalive)
+            if (not learned or learned['identity_file'] != identity_file
+                or time.time() - learned['timestamp'] > 24 * 3600):
+                identity_cache.put(auth_key, identity_file, fingerprint)
 
             return client
         # BadHostKeyException corresponds to key mismatch, i.e. what on the
@@ -142,6 +252,12 @@ def wrap_connect(user, host, port, cache,
             ssh.PasswordRequiredException,
             ssh.SSHException
         ), e:
+            if (learned and identity_file == learned['identity_file']
+                and e.__class__ is ssh.AuthenticationException):
+                # What worked last time does not anymore; try the others.
+                identity_cache.invalidate(auth_key)
+                learned = None
+                continue
             msg = str(e)
             # If we get SSHExceptionError and the exception message indicates
             # SSH protocol banner read failures, assume it's caused by the
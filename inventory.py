@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Host inventory for check_updates.py.
+
+Hosts and host groups come from one of these sources ("--inventory"):
+
+ * hosts.py with get_hosts() and get_host_groups() (the default)
+ * a JSON or YAML (requires PyYAML) file, either a list of hosts or
+   {"hosts": [...], "groups": {"name": [...]}}
+ * "ssh-config[:PATH]": "Host" entries of ~/.ssh/config (or PATH)
+   without wildcards
+
+Loaded inventories are kept per source and reused until the source file
+changes (its mtime), so long-lived processes (See api.py) don't reload
+them every time. Each inventory is indexed once when loaded, so resolving
+many arguments against many hosts does not scan the whole host list
+for each argument.
+'''
+
+import bisect
+import fnmatch
+import json
+import os
+import re
+import threading
+
+
+SSH_CONFIG_SOURCE = 'ssh-config'
+REGEX_PREFIX = 're:'
+_GLOB_CHARS = '*?['
+# Substrings shorter than this are looked up by scanning all hosts.
+_NGRAM = 3
+
+
+class InventoryError(Exception):
+    pass
+
+
+def _ngrams(text):
+    return set(text[i:i + _NGRAM] for i in range(len(text) - _NGRAM + 1))
+
+
+class Inventory(object):
+    '''
+    hosts is a list of host names, groups maps group names to hosts.
+    Hosts only found in groups are not in hosts; like with get_hosts()
+    of hosts.py, they are checked only when their group is named.
+    Lookups return hosts in the order of hosts.
+    '''
+    def __init__(self, hosts, groups=None):
+        self.groups = dict(groups or {})
+        self.hosts = []
+        self.host_set = set()
+        for host in hosts:
+            if host not in self.host_set:
+                self.host_set.add(host)
+                self.hosts.append(host)
+        self._positions = dict((host, i) for (i, host)
+                               in enumerate(self.hosts))
+        self._sorted = sorted(self.hosts)
+        # Suffixes are prefixes of reversed names.
+        self._reversed = sorted(host[::-1] for host in self.hosts)
+        self._ngram_index = {}
+        for host in self.hosts:
+            for ngram in _ngrams(host):
+                self._ngram_index.setdefault(ngram, set()).add(host)
+
+    def __contains__(self, host):
+        return host in self.host_set
+
+    def _ordered(self, hosts):
+        return sorted(hosts, key=self._positions.get)
+
+    @staticmethod
+    def _starting_with(sorted_names, prefix):
+        start = bisect.bisect_left(sorted_names, prefix)
+        matches = []
+        for name in sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(name)
+        return matches
+
+    def find_prefix(self, prefix):
+        return self._ordered(self._starting_with(self._sorted, prefix))
+
+    def find_suffix(self, suffix):
+        return self._ordered(name[::-1] for name in
+                             self._starting_with(self._reversed,
+                                                 suffix[::-1]))
+
+    def find_substring(self, part):
+        if len(part) < _NGRAM:
+            return [host for host in self.hosts if part in host]
+        candidates = None
+        for ngram in _ngrams(part):
+            found = self._ngram_index.get(ngram, set())
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return []
+        return self._ordered(host for host in candidates if part in host)
+
+    def find_glob(self, pattern):
+        # "web*" and "*.example.com" are answered by the indexes alone.
+        body = pattern[:-1]
+        if pattern.endswith('*') and not any(c in body for c in _GLOB_CHARS):
+            return self.find_prefix(body)
+        body = pattern[1:]
+        if pattern.startswith('*') and not any(c in body for c in _GLOB_CHARS):
+            return self.find_suffix(body)
+        return [host for host in self.hosts
+                if fnmatch.fnmatchcase(host, pattern)]
+
+    def find_regex(self, pattern):
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            raise InventoryError('Invalid regex "{}": {}'.format(pattern, e))
+        return [host for host in self.hosts if regex.search(host)]
+
+    def resolve(self, names, allow_unregistered=False):
+        '''
+        Returns hosts for names, each being a group name, a host name,
+        a glob, a regex prefixed with "re:" or a part of a single host name.
+        Unknown names are taken as host names when allow_unregistered is
+        set. Raises InventoryError otherwise, or when a part of a host name
+        matches multiple hosts.
+        '''
+        hosts = []
+        for name in names:
+            if name in self.groups:
+                hosts.extend(self.groups[name])
+            elif name in self.host_set:
+                hosts.append(name)
+            elif name.startswith(REGEX_PREFIX):
+                matched = self.find_regex(name[len(REGEX_PREFIX):])
+                if not matched:
+                    raise InventoryError('No hosts match "{}"'.format(name))
+                hosts.extend(matched)
+            elif any(c in name for c in _GLOB_CHARS):
+                matched = self.find_glob(name)
+                if not matched:
+                    raise InventoryError('No hosts match "{}"'.format(name))
+                hosts.extend(matched)
+            else:
+                filtered = self.find_substring(name)
+                if len(filtered) == 1:
+                    hosts.append(filtered[0])
+                elif len(filtered) > 1:
+                    raise InventoryError('Multiple candidates for "{}"'
+                                         .format(name))
+                elif allow_unregistered:
+                    hosts.append(name)
+                else:
+                    raise InventoryError('No idea how to handle "{}"'
+                                         .format(name))
+        return hosts
+
+
+def _from_data(data, path):
+    if isinstance(data, list):
+        return Inventory(data)
+    if not isinstance(data, dict):
+        raise InventoryError('Unexpected content in {}'.format(path))
+    return Inventory(data.get('hosts') or [], data.get('groups'))
+
+
+def _load_json(path):
+    try:
+        with open(path) as f:
+            return _from_data(json.load(f), path)
+    except (IOError, ValueError) as e:
+        raise InventoryError('Failed to load {}: {}'.format(path, e))
+
+
+def _load_yaml(path):
+    try:
+        import yaml
+    except ImportError:
+        raise InventoryError('PyYAML is required to load {}'.format(path))
+    try:
+        with open(path) as f:
+            return _from_data(yaml.safe_load(f), path)
+    except (IOError, yaml.YAMLError) as e:
+        raise InventoryError('Failed to load {}: {}'.format(path, e))
+
+
+def _load_ssh_config(path):
+    hosts = []
+    try:
+        with open(path) as f:
+            for line in f:
+                words = line.split()
+                if not words or words[0].lower() != 'host':
+                    continue
+                hosts.extend(word for word in words[1:]
+                             if not any(c in word for c in '*?!'))
+    except IOError as e:
+        raise InventoryError('Failed to load {}: {}'.format(path, e))
+    return Inventory(hosts)
+
+
+def _load_hosts_module():
+    # Prepare those function by yourself.
+    import hosts
+    return Inventory(hosts.get_hosts(), hosts.get_host_groups())
+
+
+def _hosts_module_path():
+    import hosts
+    path = hosts.__file__
+    if path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+        path = path[:-1]
+    return path
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def load_inventory(source=None):
+    '''
+    Returns the Inventory of source (See the docstring of this module),
+    hosts.py when None. Raises InventoryError when it can't be loaded.
+    '''
+    if not source:
+        try:
+            path = _hosts_module_path()
+        except ImportError as e:
+            raise InventoryError('Failed to load hosts.py: {}'.format(e))
+        loader = _load_hosts_module
+    elif source == SSH_CONFIG_SOURCE or source.startswith(
+            SSH_CONFIG_SOURCE + ':'):
+        path = (source[len(SSH_CONFIG_SOURCE) + 1:]
+                or os.path.expanduser('~/.ssh/config'))
+        loader = lambda: _load_ssh_config(path)
+    elif source.endswith(('.yaml', '.yml')):
+        path = source
+        loader = lambda: _load_yaml(path)
+    else:
+        path = source
+        loader = lambda: _load_json(path)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as e:
+        raise InventoryError('Failed to load {}: {}'.format(path, e))
+    key = (source, path)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(key)
+        if snapshot and snapshot[0] == mtime:
+            return snapshot[1]
+        if snapshot and not source:
+            # hosts.py changed since it was imported.
+            import hosts
+            reload(hosts)
+        inventory = loader()
+        _snapshots[key] = (mtime, inventory)
+        return inventory
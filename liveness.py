@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Fleet-wide liveness pre-scan.
+
+Probes the ssh port of every target host concurrently before any check
+is dispatched, so that dead hosts don't occupy a worker for a whole
+connection timeout. Hosts found down are remembered for a short while
+(See NegativeCache) so that repeated runs skip them immediately.
+'''
+
+import json
+import os
+import Queue
+import random
+import socket
+import threading
+import time
+
+from utils import CACHE_DIR, atomic_write
+
+
+DEFAULT_TIMEOUT = 3
+DEFAULT_WORKERS = 128
+DEFAULT_NEGATIVE_TTL = 300
+# Seconds a rebooting host may keep accepting connections before
+# it goes down.
+DEFAULT_REBOOT_GRACE = 60
+DEFAULT_REBOOT_TIMEOUT = 600
+
+
+def is_port_open(host, port, timeout=DEFAULT_TIMEOUT):
+    '''
+    Returns True when a TCP connection to (host, port) succeeds within
+    timeout. Unlike socket.setdefaulttimeout(), the timeout only applies
+    to this socket, so this is safe to call from multiple threads.
+    '''
+    try:
+        sock = socket.create_connection((host, int(port)), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+
+class NegativeCache(object):
+    '''
+    On-disk record of hosts recently found down: {key: timestamp}.
+    Entries older than ttl seconds are ignored and dropped on save.
+    '''
+    def __init__(self, path=None, ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = path or os.path.join(CACHE_DIR, 'down_hosts.json')
+        self.ttl = ttl
+        self.entries = {}
+        if ttl > 0 and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                self.entries = {}
+
+    def is_down(self, key, now=None):
+        now = now or time.time()
+        timestamp = self.entries.get(key)
+        return timestamp is not None and now - timestamp < self.ttl
+
+    def update(self, up, down, now=None):
+        '''
+        Forgets hosts in "up", remembers hosts in "down" and saves.
+        '''
+        if self.ttl <= 0:
+            return
+        now = now or time.time()
+        for key in up:
+            self.entries.pop(key, None)
+        for key in down:
+            self.entries[key] = now
+        self.entries = dict((key, timestamp)
+                            for (key, timestamp) in self.entries.items()
+                            if now - timestamp < self.ttl)
+        atomic_write(self.path, json.dumps(self.entries))
+
+
+class ScanResult(object):
+    def __init__(self, up, down, cached, elapsed):
+        # Keys of hosts that accepted a connection, in the given order.
+        self.up = up
+        # Keys of hosts that did not, including cached ones.
+        self.down = down
+        # Keys of hosts skipped thanks to NegativeCache (a set).
+        self.cached = cached
+        # Seconds spent on the scan.
+        self.elapsed = elapsed
+
+
+def scan(targets, timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS,
+         negative_cache=None):
+    '''
+    targets is a list of (key, host, port).
+    Probes all of them concurrently and returns ScanResult.
+    '''
+    start = time.time()
+    cached = set()
+    queue = Queue.Queue()
+    for (key, host, port) in targets:
+        if negative_cache and negative_cache.is_down(key, now=start):
+            cached.add(key)
+        else:
+            queue.put((key, host, port))
+    alive = {}
+
+    def worker():
+        while True:
+            try:
+                (key, host, port) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            alive[key] = is_port_open(host, port, timeout)
+
+    threads = []
+    for _ in range(min(workers, queue.qsize())):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    up = [key for (key, _, _) in targets if alive.get(key)]
+    down = [key for (key, _, _) in targets if key in cached
+            or alive.get(key) is False]
+    if negative_cache:
+        negative_cache.update(up, [key for key in down if key not in cached])
+    return ScanResult(up, down, cached, time.time() - start)
+
+
+class RebootWatch(object):
+    '''
+    What wait_for_reboot() saw of a single host.
+    '''
+    def __init__(self, key, host, port, rebooted_at, delay):
+        self.key = key
+        self.host = host
+        self.port = port
+        self.rebooted_at = rebooted_at
+        # When the port was first found closed, and open again after that.
+        self.down_at = None
+        self.up_at = None
+        self.delay = delay
+        self.next_probe = rebooted_at + delay
+
+    @property
+    def downtime(self):
+        '''
+        Seconds the host was down, or None when it did not come back.
+        '''
+        if self.up_at is None:
+            return None
+        return self.up_at - (self.down_at or self.rebooted_at)
+
+
+def wait_for_reboot(targets, timeout=DEFAULT_REBOOT_TIMEOUT,
+                    grace=DEFAULT_REBOOT_GRACE, probe_timeout=DEFAULT_TIMEOUT,
+                    initial_delay=1, max_delay=30, jitter=0.5,
+                    workers=DEFAULT_WORKERS):
+    '''
+    targets is a list of (key, host, port, rebooted_at), where rebooted_at
+    is the time.time() when the host was told to reboot.
+    Waits for each host to go down and accept connections again,
+    giving up timeout seconds after rebooted_at. A host still up after
+    grace seconds is assumed to have come back between two probes.
+
+    Hosts due for a probe are probed together with scan(). After each
+    probe the host's delay doubles up to max_delay, randomized by
+    +/- jitter so that hosts rebooted together don't keep being probed
+    together. Returns a dict mapping keys to RebootWatch.
+    '''
+    watches = dict((key, RebootWatch(key, host, port, rebooted_at,
+                                     initial_delay))
+                   for (key, host, port, rebooted_at) in targets)
+    while True:
+        now = time.time()
+        pending = [watch for watch in watches.values()
+                   if watch.up_at is None
+                   and now < watch.rebooted_at + timeout]
+        if not pending:
+            return watches
+        due = [watch for watch in pending if watch.next_probe <= now]
+        if due:
+            result = scan([(watch.key, watch.host, watch.port)
+                           for watch in due],
+                          timeout=probe_timeout, workers=workers)
+            up = set(result.up)
+            now = time.time()
+            for watch in due:
+                if watch.key in up:
+                    if (watch.down_at is not None
+                        or now - watch.rebooted_at > grace):
+                        watch.up_at = now
+                        continue
+                elif watch.down_at is None:
+                    watch.down_at = now
+                    # Start over; booting may take only a few seconds.
+                    watch.delay = initial_delay
+                watch.next_probe = now + watch.delay * random.uniform(
+                    1 - jitter, 1 + jitter)
+                watch.delay = min(watch.delay * 2, max_delay)
+            continue
+        wake_up = min([watch.next_probe for watch in pending]
+                      + [watch.rebooted_at + timeout for watch in pending])
+        time.sleep(max(0, wake_up - now))
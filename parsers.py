@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Parsers for outputs of remote package manager commands.
+'''
+
+from collections import namedtuple
+import re
+
+# check_update_local.py runs on hosts on its own, so the yum parser
+# lives there.
+from check_update_local import parse_yum_check_update, strip_arch
+
+
+def combine_yum_results(security_result, plain_result):
+    '''
+    Combines parse_yum_check_update() results of runs with and without
+    "--security" into (updates, sec_updates, packages, versions).
+    plain_result may be None when security_result has the summary.
+    sec_updates is None when unknown.
+    '''
+    if plain_result:
+        (updates, _, packages, versions) = plain_result
+    else:
+        (updates, _, packages, versions) = security_result
+    if not security_result:
+        # e.g. yum-plugin-security is not installed.
+        sec_updates = None
+    elif security_result[1] is None:
+        # No summary line. The list is limited to security updates anyway.
+        sec_updates = len(security_result[2])
+    else:
+        sec_updates = security_result[1]
+    return (updates, sec_updates, packages, versions)
+
+
+# One per package "apt-get -s upgrade" would install, e.g.
+# Inst libssl1.0.0 [1.0.1e-2+deb7u4] (1.0.1e-2+deb7u7
+#     Debian-Security:7.0/oldstable [amd64])
+# (on a single line).
+# The "[current version]" is missing for new packages.
+_APT_INST = re.compile(r'Inst (\S+) (?:\[([^\]]*)\] )?\((\S+)(?: ([^\[)]*))?')
+_APT_KEPT_BACK = 'The following packages have been kept back:'
+# Headers of wrapped package lists. Used only when there are no "Inst"
+# lines, e.g. with aptitude.
+_APT_LIST_HEADERS = ('The following packages will be upgraded:',
+                     'The following NEW packages will be installed:')
+
+
+class AptPackage(namedtuple('AptPackage', ['name', 'current', 'candidate',
+                                           'origin', 'security'])):
+    '''
+    A package "apt-get -s upgrade" reported. current is None for new
+    packages, candidate is None for held back ("kept back") ones.
+    Versions and origin are None when only the name was listed.
+    '''
+    __slots__ = ()
+
+
+def iter_apt_simulation(lines):
+    '''
+    Parses the output of "apt-get -s upgrade" (an iterable of lines)
+    in a single pass, yielding an AptPackage for each package to be
+    installed, upgraded or held back.
+    '''
+    section = None
+    listed = []
+    has_inst = False
+    for line in lines:
+        if line.startswith('Inst '):
+            match = _APT_INST.match(line)
+            if not match:
+                continue
+            has_inst = True
+            section = None
+            origin = (match.group(4) or '').strip() or None
+            yield AptPackage(match.group(1), match.group(2),
+                             match.group(3), origin,
+                             bool(origin) and 'security' in origin.lower())
+        elif line.startswith(' '):
+            if section == _APT_KEPT_BACK:
+                for name in line.split():
+                    yield AptPackage(name, None, None, None, False)
+            elif section:
+                listed.extend(line.split())
+        else:
+            line = line.strip()
+            if line == _APT_KEPT_BACK or line in _APT_LIST_HEADERS:
+                section = line
+            else:
+                section = None
+    if not has_inst:
+        for name in listed:
+            yield AptPackage(name, None, None, None, False)
+
+
+def apt_packages_and_versions(listed):
+    '''
+    Converts AptPackage objects into (packages, versions) like the ones
+    parse_yum_check_update() returns. Held back packages have no version.
+    '''
+    packages = []
+    versions = {}
+    for package in listed:
+        packages.append(package.name)
+        versions[package.name] = package.candidate
+    return (packages, versions)
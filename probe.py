@@ -0,0 +1,340 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Single-round-trip probe for check_updates.py.
+
+Instead of asking a remote host one question per ssh command
+("command -v apt-get", "test -e apt-check", "apt-check", ...),
+build one self-contained shell payload that answers all of them at once
+and prints "key=value" lines. The caller parses those lines into a dict.
+'''
+
+import parsers
+
+PROBE_MARKER = 'check_updates_probe'
+# Ends multi-line values written as "key<<EOF_MARKER".
+EOF_MARKER = '__CHECK_UPDATES_EOF__'
+
+APT_CHECK_FILE = '/usr/lib/update-notifier/apt-check'
+REBOOT_REQUIRED_FILE = '/var/run/reboot-required'
+
+# Written by "check_update_local.py --agent" when it runs on the host.
+AGENT_STATE_FILE = '/var/lib/check_update_local/state'
+# Minutes. Twice check_update_local.py's default --agent-interval.
+AGENT_STATE_MAX_AGE = 120
+# check_update_local.py reports errors as numbers in [60001, 60100].
+AGENT_ERROR_MIN = 60001
+
+# Placeholders (%(...)s) are filled by build_probe_script().
+# Keep this POSIX sh compatible; some hosts don't have bash as /bin/sh.
+# Options are set first, where benchmark.py's fake hosts look for them.
+_PROBE_TEMPLATE = r'''
+prefer_aptitude=%(prefer_aptitude)d
+refresh=%(refresh)d
+show_packages=%(show_packages)d
+use_agent_state=%(use_agent_state)d
+echo "%(marker)s=1"
+pm=
+if [ $prefer_aptitude = 1 ] && command -v aptitude >/dev/null 2>&1; then
+    pm=aptitude
+elif command -v apt-get >/dev/null 2>&1; then
+    pm=apt-get
+elif command -v yum >/dev/null 2>&1; then
+    pm=yum
+fi
+echo "pm=$pm"
+echo "kernel=$(uname -r)"
+check=$pm
+# Unless the agent reported an error (e.g. no yum security plugin);
+# then check as if there was no agent.
+if [ $use_agent_state = 1 ] && [ -n "$(find %(agent_state)s \
+        -mmin -%(agent_state_max_age)d 2>/dev/null)" ] \
+        && awk -F= '$1 != "timestamp" && $2 + 0 >= %(agent_error_min)d \
+                    {bad = 1} END {exit bad}' %(agent_state)s; then
+    # The agent already knows everything.
+    echo "agent_state<<%(eof)s"
+    cat %(agent_state)s
+    echo "%(eof)s"
+    check=
+fi
+case "$check" in
+apt-get|aptitude)
+    if [ $refresh = 1 ]; then
+        apt-get update >/dev/null 2>&1 || echo "refresh_failed=1"
+    fi
+    if [ -x %(apt_check)s ]; then
+        echo "apt_check=1"
+        counts=$(%(apt_check)s 2>&1)
+        echo "apt_check_status=$?"
+        echo "counts=$counts"
+    else
+        echo "apt_check=0"
+    fi
+    if [ -e %(reboot_required)s ]; then
+        echo "reboot=1"
+    else
+        echo "reboot=0"
+    fi
+    if [ $show_packages = 1 ]; then
+        # "Inst" lines of apt-get list all packages, even with aptitude.
+        echo "apt_simulation<<%(eof)s"
+        apt-get -s upgrade 2>/dev/null
+        echo "%(eof)s"
+    fi
+    ;;
+yum)
+    # yum returns 0 (no updates), 100 (updates) or 1 (error).
+    # See check_updates_centos() about when the second run is needed.
+    out=$(yum --security check-update 2>&1)
+    echo "yum_security_status=$?"
+    echo "yum_security_output<<%(eof)s"
+    echo "$out"
+    echo "%(eof)s"
+    if [ $show_packages = 1 ] \
+           || ! echo "$out" | grep -q 'needed for security'; then
+        out=$(yum check-update 2>&1)
+        echo "yum_status=$?"
+        echo "yum_output<<%(eof)s"
+        echo "$out"
+        echo "%(eof)s"
+    fi
+    echo "kernel_latest=$(rpm -q --last kernel 2>/dev/null \
+        | awk 'NR == 1 {print $1}')"
+    ;;
+esac
+'''
+
+
+# Files that change whenever installed packages or local package metadata
+# change. Their mtimes/sizes plus the running kernel make up the
+# "fingerprint" of a host: same fingerprint, same check result.
+# Globs are expanded by the remote shell. yum keeps metadata of each
+# repository in its own directory, /var/cache/yum/$basearch/$releasever/
+# <repo>/ (/var/cache/yum/<repo>/ on older yum), without touching the
+# directories above when it is refreshed, so repomd.xml of each
+# repository is looked at instead.
+FINGERPRINT_FILES = ['/var/lib/dpkg/status',
+                     '/var/lib/apt/lists',
+                     '/var/lib/rpm/Packages',
+                     '/var/lib/rpm/rpmdb.sqlite',
+                     '/var/cache/yum/*/*/*/repomd.xml',
+                     '/var/cache/yum/*/repomd.xml',
+                     REBOOT_REQUIRED_FILE]
+
+FINGERPRINT_SCRIPT = r'''
+for f in %s; do
+    [ -e "$f" ] && stat -c '%%n:%%Y:%%s' "$f"
+done
+uname -r
+''' % ' '.join(FINGERPRINT_FILES)
+
+
+# Detects host facts cached by cache.FactsCache, in one command.
+FACTS_SCRIPT = r'''
+for c in aptitude apt-get yum; do
+    if command -v $c >/dev/null 2>&1; then echo "$c=1"; else echo "$c=0"; fi
+done
+if [ -x %(apt_check)s ]; then echo "apt_check=1"; else echo "apt_check=0"; fi
+if [ -e /etc/debian_version ]; then
+    echo "distro_family=debian"
+elif [ -e /etc/redhat-release ]; then
+    echo "distro_family=redhat"
+fi
+echo "kernel=$(uname -r)"
+''' % {'apt_check': APT_CHECK_FILE}
+
+
+# apt-check and, for --show-packages, the package list in one command.
+# apt-check prints counts like "6;2" to stderr without a newline, so one
+# is printed before the marker.
+APT_CHECK_AND_SIMULATE_SCRIPT = r'''
+%(apt_check)s 2>&1
+status=$?
+echo
+echo "%(eof)s $status"
+apt-get -s upgrade 2>&1
+''' % {'apt_check': APT_CHECK_FILE, 'eof': EOF_MARKER}
+
+
+def build_probe_script(prefer_aptitude=False, refresh=False,
+                       show_packages=False):
+    '''
+    Returns a shell script that detects the package manager, counts
+    (security) updates, checks reboot status and optionally lists
+    packages, all in one remote invocation.
+    The state file of check_update_local.py's agent is used instead of
+    running apt-check/yum when it is fresh, unless refresh or
+    show_packages is set.
+    '''
+    return _PROBE_TEMPLATE % {'marker': PROBE_MARKER,
+                              'eof': EOF_MARKER,
+                              'prefer_aptitude': int(bool(prefer_aptitude)),
+                              'refresh': int(bool(refresh)),
+                              'show_packages': int(bool(show_packages)),
+                              'use_agent_state': int(not (refresh
+                                                          or show_packages)),
+                              'agent_state': AGENT_STATE_FILE,
+                              'agent_state_max_age': AGENT_STATE_MAX_AGE,
+                              'agent_error_min': AGENT_ERROR_MIN,
+                              'apt_check': APT_CHECK_FILE,
+                              'reboot_required': REBOOT_REQUIRED_FILE}
+
+
+def parse_key_values(output):
+    '''
+    Parses "key=value" lines into a dict, ignoring other lines.
+    Lines between "key<<EOF_MARKER" and "EOF_MARKER" become
+    the multi-line value of key.
+    '''
+    info = {}
+    multiline_key = None
+    multiline_value = []
+    for line in output.splitlines():
+        if multiline_key:
+            if line.strip() == EOF_MARKER:
+                info[multiline_key] = '\n'.join(multiline_value)
+                multiline_key = None
+                multiline_value = []
+            else:
+                multiline_value.append(line)
+            continue
+        line = line.strip()
+        if line.endswith('<<' + EOF_MARKER):
+            multiline_key = line[:-len('<<' + EOF_MARKER)]
+            continue
+        if '=' not in line:
+            continue
+        (key, value) = line.split('=', 1)
+        info[key] = value.strip()
+    return info
+
+
+def parse_apt_check_and_simulate_output(output):
+    '''
+    Splits the output of APT_CHECK_AND_SIMULATE_SCRIPT into
+    (return code of apt-check as a string or None, output of apt-check,
+    an iterator of parsers.AptPackage of the rest).
+    '''
+    lines = iter(output.splitlines())
+    apt_check_lines = []
+    status = None
+    for line in lines:
+        # Also found right after output without a newline.
+        position = line.find(EOF_MARKER + ' ')
+        if position >= 0:
+            apt_check_lines.append(line[:position])
+            status = line[position + len(EOF_MARKER) + 1:].strip()
+            break
+        apt_check_lines.append(line)
+    # Parses the rest of lines lazily, continuing where we stopped.
+    return (status, '\n'.join(apt_check_lines).strip(),
+            parsers.iter_apt_simulation(lines))
+
+
+def parse_facts_output(output):
+    '''
+    Converts the output of FACTS_SCRIPT into a dict for cache.FactsCache.
+    '''
+    info = parse_key_values(output)
+    return {'has_aptitude': info.get('aptitude') == '1',
+            'has_apt_get': info.get('apt-get') == '1',
+            'has_yum': info.get('yum') == '1',
+            'has_apt_check': info.get('apt_check') == '1',
+            'distro_family': info.get('distro_family'),
+            'kernel': info.get('kernel')}
+
+
+def parse_probe_output(output):
+    '''
+    Parses "key=value" lines emitted by the probe script into a dict.
+    Returns None when the output does not look like a probe result
+    (e.g. the remote shell printed an error before running it).
+    '''
+    info = parse_key_values(output)
+    if info.get(PROBE_MARKER) != '1':
+        return None
+    return info
+
+
+def _yum_result(info, prefix):
+    if info.get(prefix + '_status') not in ('0', '100'):
+        return None
+    return parsers.parse_yum_check_update(info.get(prefix + '_output', ''))
+
+
+def _interpret_agent_state(pm, state):
+    values = parse_key_values(state)
+    try:
+        (updates, sec_updates, reboot_required) = [
+            int(values[key])
+            for key in ('updates', 'sec_updates', 'reboot_required')]
+    except (KeyError, ValueError):
+        raise ValueError('broken agent state "{}"'.format(state))
+    error_code = max(updates, sec_updates, reboot_required)
+    if error_code >= AGENT_ERROR_MIN:
+        raise ValueError('check_update_local.py agent reported error {}'
+                         .format(error_code))
+    apt_command = pm if pm in ('apt-get', 'aptitude') else None
+    return (apt_command, updates, sec_updates, bool(reboot_required), None,
+            None)
+
+
+def interpret_probe(info, show_packages=False):
+    '''
+    Converts a parsed probe dict into
+    (apt_command, updates, sec_updates, reboot_required, packages, versions).
+
+    apt_command is None on redhat-like hosts.
+    reboot_required follows check_reboot_required_centos() semantics:
+    True, False or None (== unknown).
+    packages is None unless the probe was asked to list them
+    (show_packages must be same as the one given to build_probe_script()).
+    versions maps packages to the versions they would be upgraded to
+    (None when unknown). It is None when packages is.
+
+    Raises ValueError with a human readable reason on failure.
+    '''
+    pm = info.get('pm')
+    if not pm:
+        raise ValueError('does not have apt or yum')
+    if 'agent_state' in info:
+        return _interpret_agent_state(pm, info['agent_state'])
+    packages = None
+    versions = None
+    if 'apt_simulation' in info:
+        (packages, versions) = parsers.apt_packages_and_versions(
+            parsers.iter_apt_simulation(info['apt_simulation'].splitlines()))
+    if pm in ('apt-get', 'aptitude'):
+        if info.get('refresh_failed') == '1':
+            raise ValueError('apt-get update failed')
+        if info.get('apt_check') != '1':
+            raise ValueError('apt-check is not available')
+        if info.get('apt_check_status') != '0':
+            raise ValueError('apt-check failed')
+        try:
+            (updates, sec_updates) = [int(x) for x
+                                      in info.get('counts', '').split(';')]
+        except ValueError:
+            raise ValueError('unexpected apt-check output "{}"'
+                             .format(info.get('counts')))
+        reboot_required = info.get('reboot') == '1'
+        return (pm, updates, sec_updates, reboot_required, packages, versions)
+
+    security_result = _yum_result(info, 'yum_security')
+    plain_result = _yum_result(info, 'yum')
+    if not security_result and not plain_result:
+        raise ValueError('yum failed with return_code "{}"'
+                         .format(info.get('yum_status')))
+    (updates, sec_updates, packages, versions) = parsers.combine_yum_results(
+        security_result, plain_result)
+    if not show_packages:
+        packages = None
+        versions = None
+    latest = info.get('kernel_latest')
+    current = info.get('kernel')
+    if latest and current:
+        reboot_required = current not in latest
+    else:
+        reboot_required = None
+    return (None, updates, sec_updates, reboot_required, packages, versions)
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Per-host phase timing for check_updates.py ("--profile").
+
+Code working on a host wraps each step in phase():
+
+    with profiling.phase('apt-check'):
+        conn.run('/usr/lib/update-notifier/apt-check')
+
+Seconds spent are added up per phase name for the host the current
+thread (or forked process) is working on, and take() hands them over
+when the host is finished (See results.HostResult.phases).
+A phase within another one (e.g. "dns" and "tcp" of fabwrap.py within
+"connect") is not counted in the outer one, so that no second is
+counted twice. report() summarizes them over all hosts.
+'''
+
+from __future__ import print_function
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+PERCENTILES = (50, 90, 99)
+DEFAULT_TOP = 10
+
+_local = threading.local()
+
+
+def _phases():
+    phases = getattr(_local, 'phases', None)
+    if phases is None:
+        phases = _local.phases = {}
+    return phases
+
+
+def _nested():
+    # Seconds spent in phases within each phase in progress, innermost
+    # last.
+    nested = getattr(_local, 'nested', None)
+    if nested is None:
+        nested = _local.nested = []
+    return nested
+
+
+@contextmanager
+def phase(name):
+    nested = _nested()
+    nested.append(0.0)
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        within = nested.pop()
+        if nested:
+            nested[-1] += seconds
+        phases = _phases()
+        phases[name] = phases.get(name, 0.0) + seconds - within
+
+
+def reset():
+    '''
+    Forgets phases recorded so far in this thread.
+    Call before starting to work on a host.
+    '''
+    _local.phases = {}
+
+
+def take():
+    '''
+    Returns {phase name: seconds} recorded in this thread since the last
+    reset() or take(), and starts over.
+    '''
+    phases = _phases()
+    reset()
+    return phases
+
+
+def percentile(sorted_values, p):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    '''
+    if not sorted_values:
+        return None
+    rank = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def summarize(results, top=DEFAULT_TOP):
+    '''
+    results are results.HostResult objects. Returns a dict like:
+
+        {"hosts": 120,
+         "phases": {"apt-check": {"count": 80, "total": 40.1, "max": 3.2,
+                                  "p50": 0.4, "p90": 0.9, "p99": 2.8}, ...},
+         "slowest": [{"host": "...", "elapsed": 12.3,
+                      "phases": {...}}, ...]}
+    '''
+    by_phase = {}
+    for result in results:
+        for (name, seconds) in (result.phases or {}).items():
+            by_phase.setdefault(name, []).append(seconds)
+    phases = {}
+    for (name, values) in by_phase.items():
+        values.sort()
+        stats = {'count': len(values),
+                 'total': sum(values),
+                 'max': values[-1]}
+        for p in PERCENTILES:
+            stats['p{}'.format(p)] = percentile(values, p)
+        phases[name] = stats
+    timed = [result for result in results if result.elapsed is not None]
+    timed.sort(key=lambda result: result.elapsed, reverse=True)
+    slowest = [{'host': result.host,
+                'elapsed': result.elapsed,
+                'phases': result.phases or {}}
+               for result in timed[:top]]
+    return {'hosts': len(results), 'phases': phases, 'slowest': slowest}
+
+
+def report(summary):
+    '''
+    Prints what summarize() returned.
+    '''
+    print('Profile of {} hosts (seconds):'.format(summary['hosts']))
+    header = ['phase', 'count'] + ['p{}'.format(p) for p in PERCENTILES]
+    header += ['max', 'total']
+    print('{:<24}{:>7}'.format(*header[:2])
+          + ''.join('{:>9}'.format(h) for h in header[2:]))
+    phases = summary['phases']
+    for name in sorted(phases, key=lambda name: phases[name]['total'],
+                       reverse=True):
+        stats = phases[name]
+        values = [stats['p{}'.format(p)] for p in PERCENTILES]
+        values += [stats['max'], stats['total']]
+        print('{:<24}{:>7}'.format(name, stats['count'])
+              + ''.join('{:>9.3f}'.format(v) for v in values))
+    if summary['slowest']:
+        print('Slowest hosts:')
+    for entry in summary['slowest']:
+        worst = sorted(entry['phases'].items(), key=lambda item: item[1],
+                       reverse=True)[:3]
+        print('  {:<30}{:>9.3f}  ({})'.format(
+            entry['host'], entry['elapsed'],
+            ', '.join('{} {:.3f}'.format(name, seconds)
+                      for (name, seconds) in worst)))
+
+
+def export(summary, results, path):
+    '''
+    Writes what summarize() returned and phases of every host to path.
+    '''
+    data = dict(summary)
+    data['all'] = [{'host': result.host,
+                    'elapsed': result.elapsed,
+                    'phases': result.phases or {}}
+                   for result in results]
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Thin "connection" objects that per-host checks talk through.
+
+FabricConnection delegates to fabric.api (run/sudo/exists), relying on
+Fabric's global env like the rest of check_updates.py does.
+SSHConnection runs commands over an already connected paramiko client,
+without touching env.host_string, so it can be used from threads.
+'''
+
+from __future__ import print_function
+
+from fabric.api import run, sudo
+from fabric.contrib.files import exists
+from fabric.state import env
+from fabric.utils import abort
+
+import pipes
+
+
+class CommandResult(str):
+    '''
+    Mimics the string Fabric's run()/sudo() returns.
+    '''
+    def __new__(cls, stdout, return_code):
+        obj = super(CommandResult, cls).__new__(cls, stdout)
+        obj.stdout = stdout
+        obj.return_code = return_code
+        obj.succeeded = return_code == 0
+        obj.failed = not obj.succeeded
+        return obj
+
+
+def exec_command(transport, command):
+    '''
+    Runs command on a new channel of a paramiko Transport and returns
+    (output, return_code), with stderr merged into output.
+    '''
+    channel = transport.open_session()
+    try:
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        output = channel.makefile('rb').read()
+        return_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    return (output, return_code)
+
+
+class FabricConnection(object):
+    '''
+    Connection for the host Fabric is currently working on (env.host).
+    '''
+    @property
+    def host(self):
+        return env.host
+
+    @property
+    def host_string(self):
+        return env.host_string
+
+    @property
+    def port(self):
+        return int(env.port)
+
+    @property
+    def args(self):
+        return env.args
+
+    def run(self, command, **kwargs):
+        return run(command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return sudo(command, **kwargs)
+
+    def exists(self, path):
+        return exists(path)
+
+
+class SSHConnection(object):
+    '''
+    Connection backed by a paramiko SSHClient.
+
+    sudo() runs "sudo -n", so password-less sudo is required.
+    '''
+    def __init__(self, client, host, port, args, shell='/bin/bash -l -c',
+                 host_string=None):
+        self.client = client
+        self.host = host
+        self.port = int(port)
+        # As given by the user, e.g. "user@host:port". Used as a key.
+        self.host_string = host_string or host
+        self.args = args
+        self.shell = shell
+
+    def _wrap(self, command):
+        return '{} {}'.format(self.shell,
+                              pipes.quote('export LANG=C; ' + command))
+
+    def _exec_command(self, command):
+        '''
+        Returns (output, return_code) of command. stderr is merged into
+        output like Fabric does by default.
+        '''
+        return exec_command(self.client.get_transport(), command)
+
+    def _execute(self, command, warn_only=False, quiet=False):
+        (stdout, return_code) = self._exec_command(command)
+        # Fabric strips the output too.
+        result = CommandResult(stdout.strip(), return_code)
+        if not quiet:
+            for line in result.splitlines():
+                print('[{}] out: {}'.format(self.host, line))
+        if result.failed and not (warn_only or quiet):
+            abort('{}: "{}" failed with return_code "{}"'
+                  .format(self.host, command, return_code))
+        return result
+
+    def run(self, command, warn_only=False, quiet=False):
+        return self._execute(self._wrap(command),
+                             warn_only=warn_only, quiet=quiet)
+
+    def sudo(self, command, warn_only=False, quiet=False):
+        return self._execute('sudo -n ' + self._wrap(command),
+                             warn_only=warn_only, quiet=quiet)
+
+    def exists(self, path):
+        return self.run('test -e {}'.format(pipes.quote(path)),
+                        quiet=True).succeeded
+
+    def close(self):
+        self.client.close()
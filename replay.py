@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Record and replay remote command outputs ("--record" and "--replay").
+
+While recording, every run()/sudo()/exists() of each host is saved with
+its output and return code, as well as hosts that could not be
+connected. Replaying serves those recordings instead of ssh sessions,
+so whole fleet checks (and the parsers behind them) can be re-run
+offline, e.g. to reproduce a bug with real-world outputs or to measure
+parser throughput on huge ones.
+
+Archives are gzipped JSON like:
+
+    {"version": 1, "recorded_at": 1400000000.0,
+     "hosts": {"web1": {"down": null,
+                        "commands": [["run", "uname -r", "3.2.0-4-amd64", 0],
+                                     ["exists", "/var/run/reboot-required",
+                                      "", 1], ...]},
+               "db1": {"down": "Timed out trying to connect ...",
+                       "commands": []}}}
+'''
+
+from __future__ import print_function
+
+from fabric.exceptions import NetworkError
+from fabric.network import normalize
+from fabric.utils import abort
+
+import gzip
+import json
+import threading
+import time
+
+from remote import CommandResult
+
+
+ARCHIVE_VERSION = 1
+
+
+class ReplayError(Exception):
+    pass
+
+
+# Outputs are bytes in whatever encoding the host uses. Latin-1 maps
+# each byte to one code point, so they survive JSON unchanged.
+def _to_text(data):
+    return data.decode('latin-1') if isinstance(data, str) else data
+
+
+def _to_bytes(text):
+    return text.encode('latin-1') if isinstance(text, unicode) else text
+
+
+class Recorder(object):
+    '''
+    Collects commands of connections made by connector() and save()s them.
+    Thread-safe; not shared with forked processes, so recording
+    requires the thread engine.
+    '''
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, host_string):
+        return self.hosts.setdefault(host_string,
+                                     {'down': None, 'commands': []})
+
+    def add(self, host_string, kind, command, output, return_code):
+        with self.lock:
+            self._host(host_string)['commands'].append(
+                [kind, _to_text(command), _to_text(output), return_code])
+
+    def host_down(self, host_string, message):
+        with self.lock:
+            self._host(host_string)['down'] = message
+
+    def connector(self, connect):
+        '''
+        Wraps a "connect" function (See engine.py) so that connections
+        it returns are recorded.
+        '''
+        def connect_and_record(host_string):
+            try:
+                conn = connect(host_string)
+            except NetworkError as e:
+                self.host_down(host_string, str(e))
+                raise
+            return RecordingConnection(conn, self)
+        return connect_and_record
+
+    def save(self, path):
+        with self.lock:
+            data = {'version': ARCHIVE_VERSION,
+                    'recorded_at': time.time(),
+                    'hosts': self.hosts}
+            f = gzip.open(path, 'wb')
+            try:
+                json.dump(data, f, separators=(',', ':'))
+            finally:
+                f.close()
+
+
+class RecordingConnection(object):
+    '''
+    Passes everything to conn, recording run(), sudo() and exists().
+    '''
+    def __init__(self, conn, recorder):
+        self.conn = conn
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        # host, host_string, port, args, close(), ...
+        return getattr(self.conn, name)
+
+    def _call(self, kind, command, warn_only=False, quiet=False):
+        # Let failures come back here to record them before aborting.
+        result = getattr(self.conn, kind)(command, warn_only=True,
+                                          quiet=quiet)
+        self.recorder.add(self.conn.host_string, kind, command,
+                          str(result.stdout), result.return_code)
+        if result.failed and not (warn_only or quiet):
+            abort('{}: "{}" failed with return_code "{}"'
+                  .format(self.conn.host, command, result.return_code))
+        return result
+
+    def run(self, command, warn_only=False, quiet=False):
+        return self._call('run', command, warn_only=warn_only, quiet=quiet)
+
+    def sudo(self, command, warn_only=False, quiet=False):
+        return self._call('sudo', command, warn_only=warn_only, quiet=quiet)
+
+    def exists(self, path):
+        found = self.conn.exists(path)
+        self.recorder.add(self.conn.host_string, 'exists', path, '',
+                          0 if found else 1)
+        return found
+
+
+class ReplayConnection(object):
+    '''
+    Serves recorded outputs of a host instead of running commands.
+    A command run more often than it was recorded gets its last output
+    again. Raises ReplayError for commands never recorded.
+    '''
+    def __init__(self, host_string, commands, args):
+        (_, self.host, port) = normalize(host_string)
+        self.port = int(port)
+        self.host_string = host_string
+        self.args = args
+        self.recorded = {}
+        for (kind, command, output, return_code) in commands:
+            self.recorded.setdefault((str(kind), _to_bytes(command)),
+                                     []).append((_to_bytes(output),
+                                                 return_code))
+        self.served = {}
+
+    def _lookup(self, kind, command):
+        key = (kind, command)
+        outputs = self.recorded.get(key)
+        if not outputs:
+            raise ReplayError('{}: {} "{}" was not recorded'
+                              .format(self.host, kind, command))
+        index = self.served.get(key, 0)
+        self.served[key] = index + 1
+        return outputs[min(index, len(outputs) - 1)]
+
+    def _execute(self, kind, command, warn_only=False, quiet=False):
+        (output, return_code) = self._lookup(kind, command)
+        result = CommandResult(output, return_code)
+        if not quiet:
+            for line in result.splitlines():
+                print('[{}] out: {}'.format(self.host, line))
+        if result.failed and not (warn_only or quiet):
+            abort('{}: "{}" failed with return_code "{}"'
+                  .format(self.host, command, return_code))
+        return result
+
+    def run(self, command, warn_only=False, quiet=False):
+        return self._execute('run', command, warn_only=warn_only, quiet=quiet)
+
+    def sudo(self, command, warn_only=False, quiet=False):
+        return self._execute('sudo', command, warn_only=warn_only,
+                             quiet=quiet)
+
+    def exists(self, path):
+        return self._lookup('exists', path)[1] == 0
+
+    def close(self):
+        pass
+
+
+class Replay(object):
+    '''
+    A loaded archive. Raises ReplayError when path can't be loaded.
+    '''
+    def __init__(self, path):
+        try:
+            f = gzip.open(path, 'rb')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError) as e:
+            raise ReplayError('Failed to load {}: {}'.format(path, e))
+        if (not isinstance(data, dict)
+            or data.get('version') != ARCHIVE_VERSION):
+            raise ReplayError('Unsupported archive {}'.format(path))
+        self.path = path
+        self.recorded_at = data.get('recorded_at')
+        self.hosts = data.get('hosts') or {}
+
+    def connector(self, args):
+        '''
+        Returns a "connect" function (See engine.py) whose connections
+        carry args. Hosts that were down while recording, or not recorded
+        at all, raise NetworkError like unreachable hosts do.
+        '''
+        def connect(host_string):
+            host = self.hosts.get(host_string)
+            if host is None:
+                raise NetworkError('{} is not recorded in {}'
+                                   .format(host_string, self.path))
+            if host['down']:
+                raise NetworkError(host['down'])
+            return ReplayConnection(host_string, host['commands'], args)
+        return connect
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Per-host results of check_updates.py and the "--format jsonl" writer.
+
+Package names and versions are interned in Tables shared by the results
+of a run, and each HostResult keeps its packages as an array of their
+numbers, so that a name pending on 10k hosts is kept once instead of
+10k times. Each run starts new tables (See new_tables()), and those of
+earlier runs go away with the last of their results, so long-lived
+processes (See api.py) don't keep every name and version ever seen.
+to_columns() lays out many results as parallel lists for compact
+serialization.
+'''
+
+from array import array
+import json
+import threading
+
+
+# Version number of packages whose version is unknown.
+UNKNOWN_VERSION = -1
+
+_FIELDS = ('host', 'apt_command', 'updates', 'sec_updates',
+           'reboot_required', 'source', 'upgraded', 'rebooted',
+           'rebooted_at', 'downtime', 'phases', 'started', 'elapsed',
+           'error')
+
+
+class Interner(object):
+    '''
+    Numbers distinct strings in the order they are first seen,
+    keeping a single copy of each. Safe to share between threads.
+    '''
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def id(self, value):
+        number = self._ids.get(value)
+        if number is None:
+            with self._lock:
+                number = self._ids.get(value)
+                if number is None:
+                    number = len(self.values)
+                    self.values.append(value)
+                    self._ids[value] = number
+        return number
+
+    def get(self, value):
+        '''
+        Returns the number of value, or None when it was never seen.
+        '''
+        return self._ids.get(value)
+
+    def __getitem__(self, number):
+        return self.values[number]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Tables(object):
+    '''
+    Package names and versions results refer to by number.
+    '''
+    __slots__ = ('package_names', 'versions')
+
+    def __init__(self):
+        self.package_names = Interner()
+        self.versions = Interner()
+
+
+_tables = Tables()
+
+
+def new_tables():
+    '''
+    Makes results created from now on use new, empty Tables.
+    Results created before keep using (and keeping alive) theirs.
+    Call at the start of each run.
+    '''
+    global _tables
+    _tables = Tables()
+    return _tables
+
+
+class HostResult(object):
+    '''
+    What happened to a single host.
+
+    host is the host string as given to check_updates.py.
+    apt_command is None on redhat-like hosts.
+    sec_updates may be None (unknown) on redhat-like hosts.
+    reboot_required is True, False or None (== unknown).
+    packages is None unless they were asked for. versions then maps them
+    to the versions they would be upgraded to (None when unknown).
+    Both are built on access from package_ids and version_ids,
+    arrays of numbers in tables.package_names and tables.versions
+    (UNKNOWN_VERSION when unknown), which is what is actually kept.
+    source tells where the counts came from: "check", "cache" (--max-age)
+    or "fingerprint" (--incremental).
+    started is a time.time() value and elapsed is in seconds.
+    rebooted_at is when the host was told to reboot, and downtime is how
+    many seconds it was down when it was waited for.
+    phases maps names of steps to seconds spent in them (See profiling.py).
+    error is None when the host was checked successfully.
+    '''
+    __slots__ = _FIELDS + ('tables', 'package_ids', 'version_ids')
+
+    def __init__(self, host, apt_command=None, updates=None,
+                 sec_updates=None, reboot_required=None, packages=None,
+                 versions=None, source='check', started=None, elapsed=None,
+                 error=None):
+        self.host = host
+        self.apt_command = apt_command
+        self.updates = updates
+        self.sec_updates = sec_updates
+        self.reboot_required = reboot_required
+        self.tables = _tables
+        self.packages = packages
+        self.versions = versions
+        self.source = source
+        self.started = started
+        self.elapsed = elapsed
+        self.error = error
+        self.upgraded = False
+        self.rebooted = False
+        self.rebooted_at = None
+        self.downtime = None
+        self.phases = {}
+
+    @property
+    def packages(self):
+        if self.package_ids is None:
+            return None
+        names = self.tables.package_names.values
+        return [names[number] for number in self.package_ids]
+
+    @packages.setter
+    def packages(self, packages):
+        self.tables = _tables
+        if packages is None:
+            self.package_ids = None
+        else:
+            package_names = self.tables.package_names
+            self.package_ids = array('i', [package_names.id(name)
+                                           for name in packages])
+        self.version_ids = None
+
+    @property
+    def versions(self):
+        if self.version_ids is None:
+            return None
+        names = self.tables.package_names.values
+        values = self.tables.versions.values
+        return dict((names[package_id],
+                     None if version_id == UNKNOWN_VERSION
+                     else values[version_id])
+                    for (package_id, version_id)
+                    in zip(self.package_ids, self.version_ids))
+
+    @versions.setter
+    def versions(self, versions):
+        '''
+        Versions of packages not in packages are ignored.
+        '''
+        if versions is None or self.package_ids is None:
+            self.version_ids = None
+            return
+        names = self.tables.package_names.values
+        interned = self.tables.versions
+        version_ids = array('i')
+        for package_id in self.package_ids:
+            version = versions.get(names[package_id])
+            version_ids.append(UNKNOWN_VERSION if version is None
+                               else interned.id(version))
+        self.version_ids = version_ids
+
+    # Numbers are only meaningful in this process. Forked workers
+    # (Fabric's parallel mode) hand results over by name.
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for name in _FIELDS:
+            setattr(self, name, state[name])
+        self.packages = state['packages']
+        self.versions = state['versions']
+
+    @classmethod
+    def from_cache_entry(cls, host, entry, source='cache'):
+        '''
+        Makes a result out of a cache.ResultCache entry.
+        '''
+        return cls(host, apt_command=entry['apt_command'],
+                   updates=entry['updates'],
+                   # Older entries have '?' for unknown.
+                   sec_updates=(None if entry['sec_updates'] == '?'
+                                else entry['sec_updates']),
+                   reboot_required=entry['reboot_required'],
+                   packages=entry['packages'],
+                   versions=entry.get('versions'), source=source)
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def has_updates(self):
+        '''
+        True when the host has (security) updates. Unknown counts
+        (None) don't count.
+        '''
+        return (self.updates or 0) > 0 or (self.sec_updates or 0) > 0
+
+    def needs_attention(self):
+        '''
+        True when the host has updates or may need a reboot.
+        '''
+        # Note: reboot_required == None means 'Unknown'.
+        return bool(self.succeeded
+                    and (self.has_updates()
+                         or self.reboot_required
+                         or self.reboot_required is None))
+
+    def to_dict(self):
+        return {'host': self.host,
+                'apt_command': self.apt_command,
+                'updates': self.updates,
+                'sec_updates': self.sec_updates,
+                'reboot_required': self.reboot_required,
+                'packages': self.packages,
+                'versions': self.versions,
+                'source': self.source,
+                'upgraded': self.upgraded,
+                'rebooted': self.rebooted,
+                'rebooted_at': self.rebooted_at,
+                'downtime': self.downtime,
+                'phases': self.phases,
+                'started': self.started,
+                'elapsed': self.elapsed,
+                'error': self.error}
+
+
+class JsonlWriter(object):
+    '''
+    Writes one JSON object per line, flushing after each so that readers
+    of a pipe see every host as soon as it is finished.
+    Safe to share between threads, but not between processes: lines
+    longer than PIPE_BUF written by several processes may interleave.
+    Hence forked processes leave writing to their parent.
+
+    record tells what the line is about, as a host may be written more
+    than once: "check", "upgrade" (--rolling or --ask-upgrade) or
+    "verify" (--verify-reboot).
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, result, record='check'):
+        data = result.to_dict()
+        data['record'] = record
+        line = json.dumps(data, sort_keys=True) + '\n'
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+def to_columns(results):
+    '''
+    Lays out HostResult objects as a dict of lists, one item per result
+    for each field of HostResult.to_dict() except packages and versions.
+    Packages of all results are concatenated instead:
+
+        {"host": ["web1", "web2", "web3"], "updates": [2, 1, 0], ...,
+         "package_names": ["bash", "openssl"], "version_names": ["4.2"],
+         "package_counts": [2, 1, -1], "version_counts": [2, -1, -1],
+         "package_ids": [1, 0, 1], "version_ids": [-1, 0]}
+
+    The first package_counts[i] items of package_ids after those of
+    earlier results belong to the i-th result, and so do the first
+    version_counts[i] items of version_ids, -1 meaning packages
+    (versions) is None. Numbers refer to package_names and
+    version_names, which only contain what is used.
+    The dict is plain enough for json.dump().
+    '''
+    columns = dict((name, []) for name in _FIELDS)
+    # Keyed by names; results may come from different Tables.
+    package_numbers = {}
+    version_numbers = {}
+    package_names = []
+    version_names = []
+    package_counts = []
+    version_counts = []
+    package_ids = []
+    version_ids = []
+    for result in results:
+        for name in _FIELDS:
+            columns[name].append(getattr(result, name))
+        if result.package_ids is None:
+            package_counts.append(-1)
+            version_counts.append(-1)
+            continue
+        package_counts.append(len(result.package_ids))
+        tables = result.tables
+        for package_id in result.package_ids:
+            name = tables.package_names[package_id]
+            if name not in package_numbers:
+                package_numbers[name] = len(package_names)
+                package_names.append(name)
+            package_ids.append(package_numbers[name])
+        if result.version_ids is None:
+            version_counts.append(-1)
+            continue
+        version_counts.append(len(result.version_ids))
+        for version_id in result.version_ids:
+            if version_id == UNKNOWN_VERSION:
+                version_ids.append(UNKNOWN_VERSION)
+                continue
+            version = tables.versions[version_id]
+            if version not in version_numbers:
+                version_numbers[version] = len(version_names)
+                version_names.append(version)
+            version_ids.append(version_numbers[version])
+    columns.update({'package_names': package_names,
+                    'version_names': version_names,
+                    'package_counts': package_counts,
+                    'version_counts': version_counts,
+                    'package_ids': package_ids,
+                    'version_ids': version_ids})
+    return columns
+
+
+def from_columns(columns):
+    '''
+    Makes HostResult objects back out of what to_columns() returned.
+    '''
+    tables = _tables
+    package_ids = [tables.package_names.id(name)
+                   for name in columns['package_names']]
+    version_ids = [tables.versions.id(version)
+                   for version in columns['version_names']]
+    results = []
+    package_offset = 0
+    version_offset = 0
+    for (i, (package_count, version_count)) in enumerate(
+            zip(columns['package_counts'], columns['version_counts'])):
+        result = HostResult(None)
+        for name in _FIELDS:
+            setattr(result, name, columns[name][i])
+        result.tables = tables
+        if package_count >= 0:
+            result.package_ids = array('i', [
+                package_ids[number] for number in columns['package_ids'][
+                    package_offset:package_offset + package_count]])
+            package_offset += package_count
+        if version_count >= 0:
+            result.version_ids = array('i', [
+                UNKNOWN_VERSION if number == UNKNOWN_VERSION
+                else version_ids[number] for number in columns['version_ids'][
+                    version_offset:version_offset + version_count]])
+            version_offset += version_count
+        results.append(result)
+    return results
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Rolling upgrades for check_updates.py ("--rolling").
+
+Instead of upgrading and rebooting all selected hosts at once, upgrade
+at most batch_size hosts at a time, reboot at most max_rebooting hosts
+of each host group at a time, and don't start the next batch before
+rebooted hosts accept ssh sessions again. Stops early when the ratio of
+failed hosts exceeds max_failure_rate.
+'''
+
+from fabric.exceptions import NetworkError
+from fabric.network import normalize
+
+import threading
+import time
+
+import engine
+import liveness
+
+
+DEFAULT_BATCH_SIZE = 5
+DEFAULT_MAX_REBOOTING = 1
+DEFAULT_HEALTH_TIMEOUT = liveness.DEFAULT_REBOOT_TIMEOUT
+POLL_INTERVAL = 5
+
+
+class RollingResult(object):
+    def __init__(self, host):
+        self.host = host
+        self.upgraded = False
+        self.rebooted = False
+        self.rebooted_at = None
+        # Seconds the host was down when it was waited for.
+        self.downtime = None
+        # None when everything went well.
+        self.error = None
+
+
+class GroupGate(object):
+    '''
+    Lets at most max_rebooting hosts of each group in at a time.
+    groups maps group names to hosts, like hosts.get_host_groups().
+    Hosts in no group are not limited.
+    '''
+    def __init__(self, groups, max_rebooting=DEFAULT_MAX_REBOOTING):
+        self.semaphores = {}
+        self.host_groups = {}
+        for (group, hosts) in groups.items():
+            self.semaphores[group] = threading.BoundedSemaphore(max_rebooting)
+            for host in hosts:
+                self.host_groups.setdefault(host, []).append(group)
+        for group_names in self.host_groups.values():
+            # Always acquire in the same order; hosts in several groups
+            # must not deadlock each other.
+            group_names.sort()
+
+    def acquire(self, host):
+        for group in self.host_groups.get(host, []):
+            self.semaphores[group].acquire()
+
+    def release(self, host):
+        for group in reversed(self.host_groups.get(host, [])):
+            self.semaphores[group].release()
+
+
+def wait_until_healthy(host_string, connect, rebooted_at,
+                       timeout=DEFAULT_HEALTH_TIMEOUT):
+    '''
+    Waits for a rebooting host to go down and to accept ssh sessions
+    again. Returns the downtime in seconds, or None when the host did not
+    come back within timeout seconds after rebooted_at.
+    '''
+    (_, host, port) = normalize(host_string)
+    watch = liveness.wait_for_reboot([(host_string, host, port, rebooted_at)],
+                                     timeout=timeout)[host_string]
+    if watch.downtime is None:
+        return None
+    # sshd may accept connections a bit before it can open sessions.
+    while True:
+        try:
+            conn = connect(host_string)
+        except NetworkError:
+            conn = None
+        if conn:
+            try:
+                if conn.run('true', warn_only=True, quiet=True).succeeded:
+                    return watch.downtime
+            finally:
+                conn.close()
+        if time.time() >= rebooted_at + timeout:
+            return None
+        time.sleep(POLL_INTERVAL)
+
+
+class RollingUpgrade(object):
+    '''
+    upgrade(conn) upgrades a host and returns True on success.
+    needs_upgrade(host) and needs_reboot(conn, upgraded) tell what
+    to do with each host.
+    connect(host_string) returns a connection (See engine.py).
+    With health_timeout None, rebooted hosts are not waited for.
+    '''
+    def __init__(self, connect, upgrade, needs_upgrade, needs_reboot,
+                 groups=None, batch_size=DEFAULT_BATCH_SIZE,
+                 max_rebooting=DEFAULT_MAX_REBOOTING,
+                 health_timeout=DEFAULT_HEALTH_TIMEOUT,
+                 max_failure_rate=None, report=None):
+        self.connect = connect
+        self.upgrade = upgrade
+        self.needs_upgrade = needs_upgrade
+        self.needs_reboot = needs_reboot
+        self.gate = GroupGate(groups or {}, max_rebooting)
+        self.batch_size = batch_size
+        self.health_timeout = health_timeout
+        self.max_failure_rate = max_failure_rate
+        # report(RollingResult) is called as soon as each host is done.
+        self.report = report or (lambda result: None)
+
+    def _roll(self, conn):
+        result = RollingResult(conn.host_string)
+        if self.needs_upgrade(conn.host_string):
+            if not self.upgrade(conn):
+                result.error = 'Upgrade failed.'
+                return result
+            result.upgraded = True
+        if not self.needs_reboot(conn, result.upgraded):
+            return result
+        self.gate.acquire(conn.host_string)
+        try:
+            result.rebooted_at = time.time()
+            try:
+                conn.sudo('reboot', warn_only=True, quiet=True)
+            except Exception:
+                # The session may be gone before "reboot" returns.
+                pass
+            result.rebooted = True
+            if self.health_timeout is None:
+                return result
+            result.downtime = wait_until_healthy(
+                conn.host_string, self.connect, result.rebooted_at,
+                self.health_timeout)
+            if result.downtime is None:
+                result.error = ('Host did not come back within {} sec.'
+                                .format(self.health_timeout))
+        finally:
+            self.gate.release(conn.host_string)
+        return result
+
+    def _failed(self, host_string, message):
+        result = RollingResult(host_string)
+        result.error = message
+        return result
+
+    def too_many_failures(self, results):
+        if self.max_failure_rate is None or not results:
+            return False
+        failed = len([result for result in results if result.error])
+        return float(failed) / len(results) > self.max_failure_rate
+
+    def run(self, hosts):
+        '''
+        Returns (RollingResult of each finished host, hosts not started).
+        '''
+        results = []
+        for start in range(0, len(hosts), self.batch_size):
+            if self.too_many_failures(results):
+                return (results, hosts[start:])
+            batch = hosts[start:start + self.batch_size]
+            for (_, result) in engine.iter_threaded(
+                    self._roll, batch, jobs=self.batch_size,
+                    connect=self.connect, on_failure=self._failed):
+                self.report(result)
+                results.append(result)
+        return (results, [])
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of aggregate.py.
+
+    $ python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregate
+import results
+from results import HostResult
+
+
+def _result(host, versions=None, **kwargs):
+    packages = None if versions is None else sorted(versions)
+    return HostResult(host, apt_command='apt-get',
+                      updates=len(packages or ()), sec_updates=0,
+                      reboot_required=False, packages=packages,
+                      versions=versions, **kwargs)
+
+
+class PackageIndexTest(unittest.TestCase):
+    def setUp(self):
+        results.new_tables()
+        self.index = aggregate.PackageIndex(
+            groups={'web': ['web1', 'web2'], 'db': ['db1'],
+                    'all': ['web1', 'web2', 'db1']})
+        for result in [
+                _result('web1', {'openssl': '1.0.1e-2+deb7u7',
+                                 'bash': '4.2+dfsg-0.1+deb7u3'}),
+                _result('web2', {'openssl': '1.0.1e-2+deb7u7'}),
+                _result('db1', {'openssl': None, 'postgresql': '9.1.15'}),
+                # Up to date.
+                _result('db2', {}),
+                # Checked without --show-packages.
+                _result('mail'),
+                HostResult('down', error='Host is down.')]:
+            self.index.add(result)
+
+    def test_counts(self):
+        self.assertEqual(self.index.results, 6)
+        self.assertEqual(self.index.indexed, 4)
+        self.assertEqual(self.index.hosts, ['web1', 'web2', 'db1'])
+        self.assertEqual(len(self.index), 3)
+        self.assertIn('openssl', self.index)
+        self.assertNotIn('zsh', self.index)
+        self.assertEqual(self.index.count('openssl'), 3)
+        self.assertEqual(self.index.count('zsh'), 0)
+
+    def test_top(self):
+        # Ties are broken by name.
+        self.assertEqual(self.index.top(), [('openssl', 3), ('bash', 1),
+                                            ('postgresql', 1)])
+        self.assertEqual(self.index.top(1), [('openssl', 3)])
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('openssl'),
+                         {'package': 'openssl',
+                          'hosts': ['web1', 'web2', 'db1'],
+                          'versions': {'1.0.1e-2+deb7u7': 2, None: 1},
+                          'groups': {'web': 2, 'db': 1, 'all': 3}})
+        self.assertEqual(self.index.lookup('zsh'), None)
+
+    def test_results_of_other_tables(self):
+        results.new_tables()
+        self.index.add(_result('web3', {'openssl': '1.0.1t-1+deb7u1',
+                                        'zsh': '5.0.7'}))
+        self.assertEqual(self.index.count('openssl'), 4)
+        self.assertEqual(self.index.lookup('openssl')['versions'],
+                         {'1.0.1e-2+deb7u7': 2, '1.0.1t-1+deb7u1': 1,
+                          None: 1})
+        self.assertEqual(self.index.lookup('zsh')['versions'], {'5.0.7': 1})
+
+    def test_empty(self):
+        index = aggregate.PackageIndex()
+        index.add(HostResult('down', error='Host is down.'))
+        self.assertEqual(index.top(), [])
+        self.assertEqual(index.lookup('openssl'), None)
+        self.assertNotIn('openssl', index)
+
+
+class ReportTest(unittest.TestCase):
+    def test_report(self):
+        results.new_tables()
+        index = aggregate.PackageIndex(groups={'web': ['web1', 'web2']})
+        index.add(_result('web1', {'openssl': '1.0', 'bash': '4.2'}))
+        index.add(_result('web2', {'openssl': None}))
+        index.add(HostResult('down', error='Host is down.'))
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            aggregate.report(index, top=1, names=['openssl', 'zsh'])
+            printed = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed[:2], ['Packages: 2 pending on 2 of 2 hosts',
+                                       '(1 hosts failed or were not listed)'])
+        self.assertEqual(printed[3].split(), ['openssl', '2', '1.0', '(1),',
+                                              '?', '(1)'])
+        self.assertEqual(printed[4].split(), ['web', '(2)'])
+        self.assertEqual(printed[5:], ['openssl: 2 hosts',
+                                       '  versions: 1.0 (1), ? (1)',
+                                       '  groups: web (2)',
+                                       '  hosts: web1, web2',
+                                       'zsh: not pending on any host'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests that benchmark.py's FakeHost answers check_updates.py the way
+real hosts do, by checking it with the commands and parsers of
+check_updates.py.
+
+    $ python -m unittest discover tests
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api
+import benchmark
+import cache
+import check_updates
+import probe
+from remote import SSHConnection
+
+
+class _FakeHostConnection(SSHConnection):
+    '''
+    SSHConnection whose commands are answered by a benchmark.FakeHost.
+    '''
+    def __init__(self, fake_host, args):
+        super(_FakeHostConnection, self).__init__(None, 'fake', 22, args)
+        self.fake_host = fake_host
+        self.commands = []
+
+    def _exec_command(self, command):
+        self.commands.append(command)
+        return self.fake_host.respond(command)
+
+
+def _fake_host(redhat, packages=3, sec_updates=1, reboot_required=True):
+    host = benchmark.FakeHost(0, redhat, random.Random(0))
+    host.packages = ['package{}'.format(i) for i in range(packages)]
+    host.sec_updates = sec_updates
+    host.reboot_required = reboot_required
+    return host
+
+
+class FakeHostTest(unittest.TestCase):
+    def setUp(self):
+        # Facts of fake hosts don't belong to the user's cache.
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = self.directory
+
+    def tearDown(self):
+        cache.CACHE_DIR = self.cache_dir
+        shutil.rmtree(self.directory)
+
+    def _check(self, fake_host, **options):
+        options.setdefault('forget_facts', True)
+        conn = _FakeHostConnection(fake_host, api.make_options(**options))
+        return (check_updates.check_host(conn), conn.commands)
+
+    def test_debian(self):
+        self.assertEqual(self._check(_fake_host(False))[0],
+                         ('apt-get', (3, 1, True, None, None)))
+
+    def test_debian_show_packages(self):
+        (checked, commands) = self._check(_fake_host(False),
+                                          show_packages=True)
+        self.assertEqual(checked, (
+            'apt-get', (3, 1, True, ['package0', 'package1', 'package2'],
+                        {'package0': '1.0-2', 'package1': '1.0-2',
+                         'package2': '1.0-2'})))
+        self.assertTrue([command for command in commands
+                         if probe.EOF_MARKER in command])
+
+    def test_debian_up_to_date(self):
+        self.assertEqual(self._check(_fake_host(False, packages=0,
+                                                sec_updates=0,
+                                                reboot_required=False),
+                                     show_packages=True)[0],
+                         ('apt-get', (0, 0, False, [], {})))
+
+    def test_redhat(self):
+        self.assertEqual(self._check(_fake_host(True))[0],
+                         (None, (3, 1, True, None, None)))
+
+    def test_redhat_show_packages(self):
+        (apt_command, (updates, sec_updates, reboot_required, packages,
+                       versions)) = self._check(_fake_host(True),
+                                                show_packages=True)[0]
+        self.assertEqual((updates, sec_updates, reboot_required),
+                         (3, 1, True))
+        self.assertEqual(packages, ['package0', 'package1', 'package2'])
+        self.assertEqual(set(versions.values()), set(['1.0-1.el6']))
+
+    def test_probe(self):
+        for redhat in (False, True):
+            for show_packages in (False, True):
+                (checked, commands) = self._check(
+                    _fake_host(redhat, reboot_required=False),
+                    probe=True, show_packages=show_packages)
+                self.assertEqual(checked[1][:3], (3, 1, False))
+                self.assertEqual(checked[1][3] is not None, show_packages)
+                # A single round trip.
+                self.assertEqual(len(commands), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
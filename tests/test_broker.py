@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of broker.py against a local paramiko server standing in for
+ssh hosts.
+
+    $ python -m unittest discover tests
+'''
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import broker
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    '''
+    Answers "echo WORDS" with WORDS, and anything else with return
+    code 127.
+    '''
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._respond,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _respond(self, channel, command):
+        # Answering before paramiko acknowledged the request closes the
+        # channel on the client (See also benchmark.py's latency).
+        time.sleep(0.05)
+        if command.startswith('echo '):
+            channel.sendall(command[len('echo '):])
+            channel.send_exit_status(0)
+        else:
+            channel.sendall('{}: command not found'.format(command))
+            channel.send_exit_status(127)
+        channel.close()
+
+
+class _Host(object):
+    '''
+    A paramiko server on a local port, and an opener for
+    broker.SessionBroker counting the connections made to it.
+    '''
+    host_key = None
+
+    def __init__(self):
+        if _Host.host_key is None:
+            _Host.host_key = paramiko.RSAKey.generate(1024)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        self.host_string = 'test@127.0.0.1:{}'.format(self.port)
+        self.opened = []
+        self.transports = []
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                (client, _) = self.listener.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_ServerInterface())
+            self.transports.append(transport)
+
+    def open(self, host_string):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect('127.0.0.1', port=self.port, username='test',
+                       password='test', look_for_keys=False,
+                       allow_agent=False)
+        self.opened.append(client)
+        return client
+
+    def close(self):
+        self.listener.close()
+        for client in self.opened:
+            client.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class SessionBrokerTest(unittest.TestCase):
+    def setUp(self):
+        self.host = _Host()
+        self.broker = broker.SessionBroker(opener=self.host.open)
+
+    def tearDown(self):
+        self.broker.close()
+        self.host.close()
+
+    def test_execute(self):
+        self.assertEqual(self.broker.execute(self.host.host_string,
+                                             'echo 3.2.0-4-amd64'),
+                         ('3.2.0-4-amd64', 0))
+        self.assertEqual(self.broker.execute(self.host.host_string, 'nope'),
+                         ('nope: command not found', 127))
+
+    def test_reuses_session(self):
+        for _ in range(3):
+            self.broker.execute(self.host.host_string, 'echo 1')
+        self.assertEqual(len(self.host.opened), 1)
+        self.assertEqual(len(self.broker.sessions), 1)
+
+    def test_reopens_dead_session(self):
+        self.broker.execute(self.host.host_string, 'echo 1')
+        self.host.opened[0].close()
+        self.assertEqual(self.broker.execute(self.host.host_string, 'echo 2'),
+                         ('2', 0))
+        self.assertEqual(len(self.host.opened), 2)
+        self.assertEqual(len(self.broker.sessions), 1)
+
+    def _two_hosts(self):
+        other = _Host()
+        self.addCleanup(other.close)
+        self.broker.opener = lambda host_string: (
+            other if host_string == other.host_string
+            else self.host).open(host_string)
+        return other
+
+    def test_evicts_idle_sessions_not_in_use(self):
+        other = self._two_hosts()
+        self.broker.execute(self.host.host_string, 'echo 1')
+        in_use = self.broker._checkout(other.host_string)
+        self.broker.evict_idle(now=time.time()
+                               + self.broker.idle_timeout + 1)
+        self.assertEqual(list(self.broker.sessions.values()), [in_use])
+        self.assertFalse(self.host.opened[0].get_transport())
+        self.broker._checkin(in_use)
+
+    def test_evicts_least_recently_used(self):
+        other = self._two_hosts()
+        self.broker.max_sessions = 1
+        self.broker.execute(self.host.host_string, 'echo 1')
+        self.broker.execute(other.host_string, 'echo 2')
+        self.assertEqual(list(self.broker.sessions),
+                         [broker.normalize_to_string(other.host_string)])
+        self.assertFalse(self.host.opened[0].get_transport())
+
+    def test_failed_connection_while_another_waits(self):
+        entered = threading.Event()
+        release = threading.Event()
+        failures = []
+
+        def opener(host_string):
+            if not failures:
+                failures.append(host_string)
+                entered.set()
+                release.wait(5)
+                raise socket.error('Connection refused')
+            return self.host.open(host_string)
+        self.broker.opener = opener
+
+        def first():
+            try:
+                self.broker.execute(self.host.host_string, 'echo 1')
+            except socket.error:
+                pass
+        thread = threading.Thread(target=first)
+        thread.start()
+        entered.wait(5)
+        waiting = []
+        second = threading.Thread(target=lambda: waiting.append(
+            self.broker.execute(self.host.host_string, 'echo 2')))
+        second.start()
+        key = broker.normalize_to_string(self.host.host_string)
+        # Until the second request waits for the same session.
+        while self.broker.sessions[key].users < 2:
+            time.sleep(0.01)
+        release.set()
+        thread.join(5)
+        second.join(5)
+        self.assertEqual(waiting, [('2', 0)])
+        # The new client is the one kept, not one of a removed session.
+        self.assertEqual(len(self.host.opened), 1)
+        self.assertIs(self.broker.sessions[key].client, self.host.opened[0])
+        self.assertEqual(self.broker.sessions[key].users, 0)
+
+
+class BrokerServerTest(unittest.TestCase):
+    def setUp(self):
+        self.host = _Host()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'broker.sock')
+        self.server = broker._Server(self.path, broker._RequestHandler)
+        self.server.broker = broker.SessionBroker(opener=self.host.open)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = broker.BrokerClient(self.path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.broker.close()
+        self.host.close()
+        shutil.rmtree(self.directory)
+
+    def test_exec_round_trip(self):
+        self.assertTrue(self.client.is_available())
+        self.client.connect(self.host.host_string)
+        self.assertEqual(self.client.execute(self.host.host_string,
+                                             'echo caf\xc3\xa9'),
+                         ('caf\xc3\xa9', 0))
+        self.assertEqual(len(self.host.opened), 1)
+
+    def test_unavailable(self):
+        self.assertFalse(broker.BrokerClient(
+            os.path.join(self.directory, 'missing.sock')).is_available())
+
+    def test_connect_failure_is_network_error(self):
+        def opener(host_string):
+            raise socket.error('Connection refused')
+        self.server.broker.opener = opener
+        connect = broker.broker_connector(self.client, None)
+        with self.assertRaises(broker.NetworkError):
+            connect(self.host.host_string)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of inventory.py.
+
+    $ python -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory
+from inventory import Inventory, InventoryError
+
+
+HOSTS = ['web1.example.com', 'web2.example.com', 'db1.example.com',
+         'mail.example.org']
+GROUPS = {'web': ['web1.example.com', 'web2.example.com'],
+          # db2 is only found in this group.
+          'db': ['db1.example.com', 'db2.example.com']}
+
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.inventory = Inventory(HOSTS, GROUPS)
+
+    def test_groups(self):
+        self.assertEqual(self.inventory.resolve(['web']),
+                         ['web1.example.com', 'web2.example.com'])
+        self.assertEqual(self.inventory.resolve(['db', 'mail.example.org']),
+                         ['db1.example.com', 'db2.example.com',
+                          'mail.example.org'])
+
+    def test_hosts_only_in_groups(self):
+        # Like get_hosts() of hosts.py, "all" is hosts alone.
+        self.assertEqual(self.inventory.hosts, HOSTS)
+        self.assertNotIn('db2.example.com', self.inventory)
+        self.assertEqual(self.inventory.resolve(['db']),
+                         ['db1.example.com', 'db2.example.com'])
+        # Only reachable through its group...
+        self.assertEqual(self.inventory.find_glob('db*'), ['db1.example.com'])
+        with self.assertRaises(InventoryError):
+            self.inventory.resolve(['db2.example.com'])
+        # ...or as an unregistered host.
+        self.assertEqual(self.inventory.resolve(['db2.example.com'],
+                                                allow_unregistered=True),
+                         ['db2.example.com'])
+
+    def test_duplicate_hosts(self):
+        self.assertEqual(Inventory(['a', 'b', 'a']).hosts, ['a', 'b'])
+
+    def test_globs_and_regexes(self):
+        self.assertEqual(self.inventory.resolve(['web*']),
+                         ['web1.example.com', 'web2.example.com'])
+        self.assertEqual(self.inventory.resolve(['*.org']),
+                         ['mail.example.org'])
+        self.assertEqual(self.inventory.resolve(['*1.*']),
+                         ['web1.example.com', 'db1.example.com'])
+        self.assertEqual(self.inventory.resolve(['re:^(db|mail)']),
+                         ['db1.example.com', 'mail.example.org'])
+        with self.assertRaises(InventoryError):
+            self.inventory.resolve(['re:('])
+        with self.assertRaises(InventoryError):
+            self.inventory.resolve(['ftp*'])
+
+    def test_parts_of_names(self):
+        self.assertEqual(self.inventory.resolve(['mail']),
+                         ['mail.example.org'])
+        self.assertEqual(self.inventory.resolve(['b2']),
+                         ['web2.example.com'])
+        with self.assertRaises(InventoryError):
+            self.inventory.resolve(['example.com'])
+        with self.assertRaises(InventoryError):
+            self.inventory.resolve(['nowhere'])
+
+
+class LoadInventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, content, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_json(self):
+        path = self._write('hosts.json', json.dumps({'hosts': HOSTS,
+                                                     'groups': GROUPS}))
+        loaded = inventory.load_inventory(path)
+        self.assertEqual(loaded.hosts, HOSTS)
+        self.assertEqual(loaded.groups, GROUPS)
+        self.assertIs(inventory.load_inventory(path), loaded)
+
+    def test_json_list(self):
+        path = self._write('hosts.json', json.dumps(HOSTS))
+        self.assertEqual(inventory.load_inventory(path).hosts, HOSTS)
+
+    def test_reloaded_when_changed(self):
+        path = self._write('hosts.json', json.dumps(['a']), mtime=1000)
+        self.assertEqual(inventory.load_inventory(path).hosts, ['a'])
+        self._write('hosts.json', json.dumps(['a', 'b']), mtime=2000)
+        self.assertEqual(inventory.load_inventory(path).hosts, ['a', 'b'])
+
+    def test_ssh_config(self):
+        path = self._write('config', 'Host web1 web2\n'
+                           '    User admin\n'
+                           'Host *.internal !bastion\n'
+                           'host db1\n')
+        self.assertEqual(inventory.load_inventory('ssh-config:' + path).hosts,
+                         ['web1', 'web2', 'db1'])
+
+    def test_errors(self):
+        with self.assertRaises(InventoryError):
+            inventory.load_inventory(os.path.join(self.directory, 'missing'))
+        with self.assertRaises(InventoryError):
+            inventory.load_inventory(self._write('broken.json', '{'))
+        with self.assertRaises(InventoryError):
+            inventory.load_inventory(self._write('number.json', '1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of parsers.py, probe.py and check_update_local.py against captured
+outputs of package managers (See fixtures/).
+
+    $ python -m unittest discover tests
+'''
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import check_update_local
+import parsers
+import probe
+
+
+def _fixture(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures', name)
+    with open(path) as f:
+        return f.read()
+
+
+class YumCheckUpdateTest(unittest.TestCase):
+    def test_security_summary(self):
+        (updates, sec_updates, packages,
+         versions) = parsers.parse_yum_check_update(
+             _fixture('yum_security_summary.txt'))
+        self.assertEqual((updates, sec_updates), (14, 3))
+        self.assertEqual(packages, ['bash', 'openssl', 'python-paramiko'])
+        self.assertEqual(versions['openssl'], '1.0.1e-16.el6_5.14')
+
+    def test_no_security_needed(self):
+        self.assertEqual(parsers.parse_yum_check_update(
+            _fixture('yum_no_security_needed.txt')), (5, 0, [], {}))
+
+    def test_security_without_summary(self):
+        self.assertEqual(parsers.parse_yum_check_update(
+            _fixture('yum_security_no_summary.txt')),
+            (1, None, ['openssl'], {'openssl': '0.9.8e-27.el5_10.1'}))
+
+    def test_plain_listing(self):
+        (updates, sec_updates, packages,
+         versions) = parsers.parse_yum_check_update(_fixture('yum_plain.txt'))
+        # Wrapped names and any arch count; obsoleted ones don't.
+        self.assertEqual(packages, ['NetworkManager-openconnect-gnome',
+                                    'bash', 'kernel', 'openssl-libs',
+                                    'tzdata'])
+        self.assertEqual((updates, sec_updates), (5, None))
+        self.assertEqual(versions['NetworkManager-openconnect-gnome'],
+                         '1.2.4-1.el7')
+        self.assertEqual(versions['openssl-libs'], '1:1.0.1e-51.el7_2.5')
+
+    def test_combine_without_security_plugin(self):
+        plain = parsers.parse_yum_check_update(_fixture('yum_plain.txt'))
+        (updates, sec_updates, packages,
+         _) = parsers.combine_yum_results(None, plain)
+        self.assertEqual((updates, sec_updates, len(packages)),
+                         (5, None, 5))
+
+    def test_combine_without_summary(self):
+        security = parsers.parse_yum_check_update(
+            _fixture('yum_security_no_summary.txt'))
+        plain = parsers.parse_yum_check_update(_fixture('yum_plain.txt'))
+        self.assertEqual(parsers.combine_yum_results(security, plain)[:2],
+                         (5, 1))
+
+    def test_strip_arch(self):
+        self.assertEqual(parsers.strip_arch('openssl.x86_64'), 'openssl')
+        self.assertEqual(parsers.strip_arch('bash.armv7hl'), 'bash')
+        self.assertEqual(parsers.strip_arch('bash'), 'bash')
+
+
+class _FakeRedhatTester(check_update_local.RedhatTester):
+    def __init__(self, outputs):
+        super(_FakeRedhatTester, self).__init__()
+        self.outputs = outputs
+        self.ran = []
+
+    def needs_reboot(self):
+        return False
+
+    def _run_check_update(self, cmd):
+        self.ran.append(cmd)
+        output = self.outputs[cmd]
+        if output is None:
+            raise RuntimeError('Failed to run "{0}"'.format(cmd))
+        return output
+
+
+class LocalYumCountsTest(unittest.TestCase):
+    '''
+    check_update_local.py counts the same outputs the same way.
+    '''
+    def test_security_summary(self):
+        tester = _FakeRedhatTester(
+            {'yum --security check-update':
+             _fixture('yum_security_summary.txt')})
+        self.assertEqual(tester.get_update_counts(), (14, 3))
+
+    def test_security_without_summary(self):
+        tester = _FakeRedhatTester(
+            {'yum --security check-update':
+             _fixture('yum_security_no_summary.txt'),
+             'yum check-update': _fixture('yum_plain.txt')})
+        self.assertEqual(tester.get_update_counts(), (5, 1))
+
+    def test_without_security_plugin(self):
+        tester = _FakeRedhatTester(
+            {'yum --security check-update': None,
+             'yum check-update': _fixture('yum_plain.txt')})
+        self.assertEqual(tester.get_update_counts(), (5, None))
+
+    def test_status_runs_yum_once(self):
+        tester = _FakeRedhatTester(
+            {'yum --security check-update':
+             _fixture('yum_security_summary.txt')})
+        self.assertEqual(tester.get_status(), {'updates': 14,
+                                               'sec_updates': 3,
+                                               'reboot_required': 0})
+        self.assertEqual(tester.ran, ['yum --security check-update'])
+
+    def test_failed_status_runs_yum_once(self):
+        tester = _FakeRedhatTester({'yum --security check-update': None,
+                                    'yum check-update': None})
+        error = check_update_local.ERROR_EXCEPTION_RAISED
+        self.assertEqual(tester.get_status(), {'updates': error,
+                                               'sec_updates': error,
+                                               'reboot_required': 0})
+        self.assertEqual(tester.ran, ['yum --security check-update',
+                                      'yum check-update'])
+
+    def test_format_status(self):
+        status = {'updates': 14, 'sec_updates': 3, 'reboot_required': 1}
+        self.assertEqual(json.loads(
+            check_update_local.format_status(status, 'json')), status)
+        self.assertEqual(check_update_local.format_status(status, 'keyvalue'),
+                         'updates=14\nsec_updates=3\nreboot_required=1')
+
+
+class AptSimulationTest(unittest.TestCase):
+    def test_inst_and_kept_back(self):
+        listed = list(parsers.iter_apt_simulation(
+            _fixture('apt_simulation.txt').splitlines()))
+        self.assertEqual([package.name for package in listed],
+                         ['linux-image-amd64', 'bash', 'libssl1.0.0'])
+        (packages, versions) = parsers.apt_packages_and_versions(listed)
+        self.assertEqual(versions, {'linux-image-amd64': None,
+                                    'bash': '4.2+dfsg-0.1+deb7u3',
+                                    'libssl1.0.0': '1.0.1e-2+deb7u7'})
+        self.assertEqual([package.security for package in listed],
+                         [False, True, False])
+
+
+class AptCheckAndSimulateTest(unittest.TestCase):
+    '''
+    apt-check prints its counts to stderr without a newline.
+    '''
+    def _output(self, between):
+        return ('6;2' + between + probe.EOF_MARKER + ' 0\n'
+                + _fixture('apt_simulation.txt'))
+
+    def test_script_output(self):
+        (status, counts, listed) = probe.parse_apt_check_and_simulate_output(
+            self._output('\n'))
+        self.assertEqual((status, counts), ('0', '6;2'))
+        self.assertEqual([package.name for package in listed],
+                         ['linux-image-amd64', 'bash', 'libssl1.0.0'])
+
+    def test_marker_after_counts(self):
+        (status, counts, listed) = probe.parse_apt_check_and_simulate_output(
+            self._output(''))
+        self.assertEqual((status, counts), ('0', '6;2'))
+        self.assertEqual(len(list(listed)), 3)
+
+    def test_failed(self):
+        (status, counts, listed) = probe.parse_apt_check_and_simulate_output(
+            'E: Error: BrokenCount > 0\n{} 1\n'.format(probe.EOF_MARKER))
+        self.assertEqual((status, counts), ('1', 'E: Error: BrokenCount > 0'))
+        self.assertEqual(list(listed), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of profiling.py.
+
+    $ python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import profiling
+
+
+class _Clock(object):
+    '''
+    Stands in for the time module in profiling.py.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class PhaseTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.time = profiling.time
+        profiling.time = self.clock
+        profiling.reset()
+
+    def tearDown(self):
+        profiling.time = self.time
+
+    def test_nested_phases_are_counted_once(self):
+        # Like "dns", "tcp" and "ssh handshake" of fabwrap.py within
+        # "connect" of engine.py.
+        with profiling.phase('connect'):
+            self.clock.now += 1
+            with profiling.phase('dns'):
+                self.clock.now += 2
+            with profiling.phase('tcp'):
+                self.clock.now += 3
+                with profiling.phase('ssh handshake'):
+                    self.clock.now += 4
+        with profiling.phase('apt-check'):
+            self.clock.now += 5
+        phases = profiling.take()
+        self.assertEqual(phases, {'connect': 1.0, 'dns': 2.0, 'tcp': 3.0,
+                                  'ssh handshake': 4.0, 'apt-check': 5.0})
+        self.assertEqual(sum(phases.values()), 15.0)
+
+    def test_repeated_phases_add_up(self):
+        for seconds in (1, 2):
+            with profiling.phase('reboot check'):
+                self.clock.now += seconds
+        self.assertEqual(profiling.take(), {'reboot check': 3.0})
+        self.assertEqual(profiling.take(), {})
+
+    def test_failed_phase_is_counted(self):
+        with self.assertRaises(ValueError):
+            with profiling.phase('connect'):
+                self.clock.now += 1
+                with profiling.phase('tcp'):
+                    self.clock.now += 2
+                    raise ValueError
+        self.assertEqual(profiling.take(), {'connect': 1.0, 'tcp': 2.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
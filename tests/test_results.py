@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of results.py: interned packages, their tables and the layouts
+results are handed over in.
+
+    $ python -m unittest discover tests
+'''
+
+import json
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import results
+from results import HostResult
+
+
+def _result(host, packages=None, versions=None, **kwargs):
+    return HostResult(host, apt_command='apt-get', updates=len(packages or ()),
+                      sec_updates=0, reboot_required=False,
+                      packages=packages, versions=versions, **kwargs)
+
+
+class InternedPackagesTest(unittest.TestCase):
+    def setUp(self):
+        results.new_tables()
+
+    def test_packages_and_versions(self):
+        result = _result('web1', ['openssl', 'bash'],
+                         {'openssl': '1.0.1e-2+deb7u7', 'bash': None})
+        self.assertEqual(result.packages, ['openssl', 'bash'])
+        self.assertEqual(result.versions, {'openssl': '1.0.1e-2+deb7u7',
+                                           'bash': None})
+        self.assertEqual(_result('web2', ['openssl']).versions, None)
+        self.assertEqual(_result('web3').packages, None)
+
+    def test_names_are_shared(self):
+        first = _result('web1', ['openssl', 'bash'])
+        second = _result('web2', ['bash', 'openssl'])
+        self.assertIs(first.tables, second.tables)
+        self.assertEqual(sorted(first.package_ids),
+                         sorted(second.package_ids))
+        self.assertEqual(len(first.tables.package_names), 2)
+
+    def test_new_tables(self):
+        old = _result('web1', ['openssl'], {'openssl': '1.0'})
+        old_tables = old.tables
+        tables = results.new_tables()
+        new = _result('web2', ['bash'], {'bash': '4.2'})
+        self.assertIs(new.tables, tables)
+        self.assertIsNot(old.tables, tables)
+        # Earlier results keep reading their own tables.
+        self.assertEqual(old.versions, {'openssl': '1.0'})
+        self.assertEqual(old_tables.package_names.values, ['openssl'])
+        self.assertEqual(tables.package_names.values, ['bash'])
+
+    def test_pickle(self):
+        result = _result('web1', ['openssl'], {'openssl': '1.0'})
+        results.new_tables()
+        copied = pickle.loads(pickle.dumps(result, 2))
+        self.assertEqual(copied.to_dict(), result.to_dict())
+        self.assertIs(copied.tables, results._tables)
+
+
+class ColumnsTest(unittest.TestCase):
+    def setUp(self):
+        results.new_tables()
+
+    def _round_trip(self, original):
+        columns = json.loads(json.dumps(results.to_columns(original)))
+        return results.from_columns(columns)
+
+    def test_round_trip(self):
+        original = [
+            _result('web1', ['openssl', 'bash'],
+                    {'openssl': '1.0.1e-2+deb7u7', 'bash': None}),
+            # Without versions, unlike with all of them unknown.
+            _result('web2', ['openssl']),
+            _result('web3', ['bash'], {'bash': None}),
+            _result('web4'),
+            _result('web5', []),
+            HostResult('web6', error='Host is down.')]
+        copied = self._round_trip(original)
+        self.assertEqual([result.to_dict() for result in copied],
+                         [result.to_dict() for result in original])
+        self.assertEqual(copied[1].versions, None)
+        self.assertEqual(copied[2].versions, {'bash': None})
+
+    def test_results_of_several_tables(self):
+        old = _result('web1', ['openssl', 'bash'],
+                      {'openssl': '1.0', 'bash': '4.2'})
+        results.new_tables()
+        new = _result('web2', ['bash'], {'bash': '4.3'})
+        columns = results.to_columns([old, new])
+        self.assertEqual(columns['package_names'], ['openssl', 'bash'])
+        self.assertEqual(columns['version_names'], ['1.0', '4.2', '4.3'])
+        copied = self._round_trip([old, new])
+        self.assertEqual([result.versions for result in copied],
+                         [old.versions, new.versions])
+
+
+if __name__ == '__main__':
+    unittest.main()
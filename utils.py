@@ -1,7 +1,37 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import tempfile
+
+
+# Where check_updates.py keeps its local state between runs.
+CACHE_DIR = os.path.expanduser('~/.cache/check_updates')
+
+
+def atomic_write(path, data):
+    '''
+    Writes data to path so that readers see either the old or the new
+    content, never a partial one. Safe with parallel writers; the last
+    rename wins.
+    '''
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker may have created it in the meantime.
+            if not os.path.isdir(directory):
+                raise
+    (fd, tmp_path) = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
 
 # http://code.activestate.com/recipes/577058/
 def query_yes_no(question, default="yes"):